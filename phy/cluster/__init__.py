@@ -3,6 +3,7 @@
 
 """Manual clustering facilities."""
 
+from ._cache import ClusterCache
 from ._utils import ClusterMeta
 from .clustering import Clustering
 from .supervisor import Supervisor
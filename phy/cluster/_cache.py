@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""Cache of per-cluster data."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import OrderedDict
+import logging
+from threading import Lock, Thread
+
+from phy.io.array import _ClusteringListener
+from phy.io.memcache import _nbytes
+from phy.utils._misc import _fullname
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Cluster cache
+#------------------------------------------------------------------------------
+
+class ClusterCache(_ClusteringListener):
+    """Cache the values of a function of a cluster id.
+
+    Modified clusters always get new ids (see `Clustering.new_cluster_id()`),
+    so that an entry never needs to be invalidated. When clusters are
+    deleted, their entries are moved to a spill area, and they are
+    resurrected when an undo or redo brings these clusters back, instead of
+    being recomputed.
+
+    Parameters
+    ----------
+
+    f : function
+        A function `cluster_id => value`.
+    precompute : bool
+        Whether to compute the values of the new clusters in a background
+        thread after every clustering change.
+    spill_size : int
+        Maximum size of the spill area, in bytes. The oldest spilled entries
+        are discarded first. The spill area is unbounded if None.
+
+    """
+    _clustering_attrs = ()
+
+    def __init__(self, f, precompute=False, spill_size=256 * 1024 ** 2):
+        self.f = f
+        self.name = _fullname(f)
+        # Used as the column name in the cluster view.
+        self.__name__ = getattr(f, '__name__', self.name)
+        self.precompute = precompute
+        self.spill_size = spill_size
+        self._entries = {}
+        self._spilled = OrderedDict()
+        self._spilled_nbytes = 0
+        self._deleted = set()
+        self._lock = Lock()
+        self._threads = []
+        self.hits = 0
+        self.misses = 0
+        self.resurrections = 0
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def spilled(self):
+        """List of clusters in the spill area."""
+        return list(self._spilled)
+
+    # Spill area
+    # -------------------------------------------------------------------------
+
+    def _spill(self, cluster_id):
+        if cluster_id not in self._entries:
+            return
+        value = self._entries.pop(cluster_id)
+        size = _nbytes(value)
+        self._spilled[cluster_id] = (size, value)
+        self._spilled_nbytes += size
+        # Discard the oldest entries if needed.
+        while (self.spill_size is not None and
+               self._spilled_nbytes > self.spill_size and self._spilled):
+            _, (size, _) = self._spilled.popitem(last=False)
+            self._spilled_nbytes -= size
+
+    def _resurrect(self, cluster_id):
+        if cluster_id not in self._spilled:
+            return False
+        size, value = self._spilled.pop(cluster_id)
+        self._spilled_nbytes -= size
+        self._entries[cluster_id] = value
+        self.resurrections += 1
+        return True
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def __call__(self, cluster_id):
+        with self._lock:
+            if cluster_id in self._entries:
+                self.hits += 1
+                return self._entries[cluster_id]
+            if self._resurrect(cluster_id):
+                return self._entries[cluster_id]
+            self.misses += 1
+        # NOTE: the function is called outside of the lock so that the
+        # background thread does not block the caller.
+        value = self.f(cluster_id)
+        with self._lock:
+            self._entries[cluster_id] = value
+        return value
+
+    def on_cluster(self, up):
+        """Update the cache after a clustering change."""
+        with self._lock:
+            for cluster_id in up.deleted:
+                self._deleted.add(cluster_id)
+                self._spill(cluster_id)
+            to_compute = []
+            for cluster_id in up.added:
+                self._deleted.discard(cluster_id)
+                if (cluster_id not in self._entries and
+                        not self._resurrect(cluster_id)):
+                    to_compute.append(cluster_id)
+        if self.precompute and to_compute:
+            self._start_precompute(to_compute)
+
+    def _precompute(self, cluster_ids):
+        for cluster_id in cluster_ids:
+            with self._lock:
+                if (cluster_id in self._deleted or
+                        cluster_id in self._entries):
+                    continue
+            try:
+                value = self.f(cluster_id)
+            except Exception as e:  # pragma: no cover
+                logger.debug("Error while precomputing `%s(%d)`: %s.",
+                             self.name, cluster_id, str(e))
+                continue
+            with self._lock:
+                if cluster_id not in self._deleted:
+                    self._entries[cluster_id] = value
+
+    def _start_precompute(self, cluster_ids):
+        thread = Thread(target=self._precompute, args=(cluster_ids,))
+        thread.daemon = True
+        thread.start()
+        self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+
+    def wait(self):
+        """Wait for the background precomputations to finish."""
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    resurrections=self.resurrections,
+                    n_items=len(self._entries),
+                    n_spilled=len(self._spilled),
+                    spilled_nbytes=self._spilled_nbytes,
+                    )
@@ -14,6 +14,7 @@ from phy.utils._types import _as_array, _is_array_like
 from phy.io.array import (_unique,
                           _spikes_in_clusters,
                           _spikes_per_cluster,
+                          SpikesPerCluster,
                           )
 from ._utils import UpdateInfo
 from ._history import History
@@ -161,12 +162,15 @@ class Clustering(EventEmitter):
         self._undo_stack = History(base_item=(None, None, None))
         # Spike -> cluster mapping.
         self._spike_clusters = _as_array(spike_clusters)
-        self._spikes_per_cluster = {}
+        self._spikes_per_cluster = SpikesPerCluster()
         self._n_spikes = len(self._spike_clusters)
         self._spike_ids = np.arange(self._n_spikes).astype(np.int64)
-        # We can pass the precomputed spikes_per_cluster dictionary for
+        # We can pass the precomputed spikes_per_cluster structure for
         # performance reasons.
-        self._update_cluster_ids(to_add=spikes_per_cluster)
+        if isinstance(spikes_per_cluster, SpikesPerCluster):
+            self._spikes_per_cluster = spikes_per_cluster
+            spikes_per_cluster = None
+        self._update_cluster_ids(to_add=spikes_per_cluster, check=True)
         self._new_cluster_id_0 = int(new_cluster_id or
                                      self._spike_clusters.max() + 1)
         self._new_cluster_id = self._new_cluster_id_0
@@ -184,6 +188,8 @@ class Clustering(EventEmitter):
         self._undo_stack.clear()
         self._spike_clusters = self._spike_clusters_base
         self._new_cluster_id = self._new_cluster_id_0
+        self._spikes_per_cluster = _spikes_per_cluster(self._spike_clusters)
+        self._update_cluster_ids(check=True)
 
     @property
     def spike_clusters(self):
@@ -192,7 +198,7 @@ class Clustering(EventEmitter):
 
     @property
     def spikes_per_cluster(self):
-        """A dictionary {cluster_id: spike_ids}."""
+        """A `SpikesPerCluster` mapping {cluster_id: spike_ids}."""
         return self._spikes_per_cluster
 
     @property
@@ -233,27 +239,36 @@ class Clustering(EventEmitter):
     # Actions
     #--------------------------------------------------------------------------
 
-    def _update_cluster_ids(self, to_remove=None, to_add=None):
-        # Update the list of non-empty cluster ids.
-        self._cluster_ids = _unique(self._spike_clusters)
+    def _update_cluster_ids(self, to_remove=None, to_add=None, check=False):
+        spc = self._spikes_per_cluster
+        # Without explicit changes, check the structure against the
+        # spike_clusters array.
+        check = check or (to_remove is None and not to_add)
         # Clusters to remove.
         if to_remove is not None:
-            for clu in to_remove:
-                self._spikes_per_cluster.pop(clu, None)
+            spc.remove(to_remove)
         # Clusters to add.
         if to_add:
-            for clu, spk in to_add.items():
-                self._spikes_per_cluster[clu] = spk
+            spc.update(to_add)
+        # Update the list of non-empty cluster ids.
+        if check:
+            self._cluster_ids = _unique(self._spike_clusters)
+        else:
+            # OPTIM: the cluster ids are given by the spikes_per_cluster
+            # structure after incremental updates.
+            self._cluster_ids = spc.cluster_ids[spc.cluster_ids >= 0]
         # If spikes_per_cluster is invalid, recompute the entire
-        # spikes_per_cluster array.
-        coherent = np.all(np.in1d(self._cluster_ids,
-                                  sorted(self._spikes_per_cluster),
-                                  ))
+        # spikes_per_cluster structure.
+        coherent = spc.n_spikes == self._n_spikes
+        if coherent and check:
+            ids = spc.cluster_ids
+            coherent = np.array_equal(ids[ids >= 0], self._cluster_ids)
         if not coherent:
             logger.debug("Recompute spikes_per_cluster manually: "
                          "this is long.")
             sc = self._spike_clusters
             self._spikes_per_cluster = _spikes_per_cluster(sc)
+            self._cluster_ids = _unique(sc)
 
     def _do_assign(self, spike_ids, new_spike_clusters):
         """Make spike-cluster assignments after the spike selection has
@@ -290,7 +305,7 @@ class Clustering(EventEmitter):
 
         # We make the assignments.
         self._spike_clusters[spike_ids] = new_spike_clusters
-        # OPTIM: we update spikes_per_cluster manually.
+        # OPTIM: we update spikes_per_cluster incrementally.
         new_spc = _spikes_per_cluster(new_spike_clusters, spike_ids)
         self._update_cluster_ids(to_remove=old_clusters, to_add=new_spc)
         return up
@@ -312,7 +327,7 @@ class Clustering(EventEmitter):
         # Assign the clusters.
         self.spike_clusters[spike_ids] = to
         # Update the list of non-empty cluster ids.
-        # OPTIM: we update spikes_per_cluster manually.
+        # OPTIM: we update spikes_per_cluster incrementally.
         self._update_cluster_ids(to_remove=cluster_ids,
                                  to_add={to: spike_ids})
         return up
@@ -14,9 +14,11 @@ import logging
 import numpy as np
 from six import string_types
 
+from ._cache import ClusterCache
 from ._history import GlobalHistory
 from ._utils import create_cluster_meta
 from .clustering import Clustering
+from phy.io.array import Selector, SubsamplingIndex
 from phy.utils import EventEmitter
 from phy.gui.actions import Actions
 from phy.gui.widgets import Table
@@ -149,6 +151,7 @@ class Supervisor(EventEmitter):
 
         self._best = None
         self._current_similarity_values = {}
+        self._selector = None
 
         # Load default shortcuts, and override with any user shortcuts.
         self.shortcuts = self.default_shortcuts.copy()
@@ -160,8 +163,15 @@ class Supervisor(EventEmitter):
         self.clustering = Clustering(spike_clusters,
                                      spikes_per_cluster=spc,
                                      new_cluster_id=new_cluster_id)
+        # The cached structure is adopted by Clustering if it is coherent
+        # with spike_clusters: there is no need to save it again.
+        self._spc_changed = spc is not self.clustering.spikes_per_cluster
         # Cache the spikes_per_cluster array.
         self._save_spikes_per_cluster()
+        # Cache the quality of the clusters: modified clusters get new ids,
+        # and the values of deleted clusters are restored by undo and redo.
+        if quality is not None:
+            self.quality = ClusterCache(quality).attach(self.clustering)
 
         self.cluster_groups = cluster_groups or {}
         self.cluster_meta = create_cluster_meta(self.cluster_groups)
@@ -173,6 +183,9 @@ class Supervisor(EventEmitter):
         def on_cluster(up):
             """Register the next cluster in the list before the cluster
             view is updated."""
+            if up.added or up.deleted:
+                # spikes_per_cluster needs to be saved again.
+                self._spc_changed = True
             if not up.added or not hasattr(self, 'cluster_view'):
                 return
             cluster = up.added[0]
@@ -189,11 +202,14 @@ class Supervisor(EventEmitter):
     # -------------------------------------------------------------------------
 
     def _save_spikes_per_cluster(self):
-        if self.context:
-            self.context.save('spikes_per_cluster',
-                              self.clustering.spikes_per_cluster,
-                              kind='pickle',
-                              )
+        # Skip the rewrite when the clustering has not changed.
+        if not self.context or not self._spc_changed:
+            return
+        self.context.save('spikes_per_cluster',
+                          self.clustering.spikes_per_cluster,
+                          kind='arrays',
+                          )
+        self._spc_changed = False
 
     def _register_logging(self):
         # Log the actions.
@@ -569,6 +585,21 @@ class Supervisor(EventEmitter):
     def selected(self):
         return self.cluster_view.selected + self.similarity_view.selected
 
+    @property
+    def selector(self):
+        """Selector of the spikes of the clusters.
+
+        It uses a subsampling index of the spikes, which is built on first
+        use and then kept in sync with the clustering.
+
+        """
+        if self._selector is None:
+            index = SubsamplingIndex().attach(self.clustering)
+            self._selector = Selector(
+                lambda c: self.clustering.spikes_per_cluster[c],
+                subsampling_index=index)
+        return self._selector
+
     # Clustering actions
     # -------------------------------------------------------------------------
 
@@ -702,3 +733,7 @@ class Supervisor(EventEmitter):
         self.emit('request_save', spike_clusters, groups, *labels)
         # Cache the spikes_per_cluster array.
         self._save_spikes_per_cluster()
+        # Cache the quality of the clusters: modified clusters get new ids,
+        # and the values of deleted clusters are restored by undo and redo.
+        if quality is not None:
+            self.quality = ClusterCache(quality).attach(self.clustering)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Test cluster cache."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phy.io.mock import artificial_spike_clusters
+from .._cache import ClusterCache
+from ..clustering import Clustering
+
+
+#------------------------------------------------------------------------------
+# Test cluster cache
+#------------------------------------------------------------------------------
+
+def _make_cache(clustering, **kwargs):
+    _calls = []
+
+    def spikes(cluster_id):
+        _calls.append(cluster_id)
+        return clustering.spikes_per_cluster[cluster_id].copy()
+
+    cache = ClusterCache(spikes, **kwargs).attach(clustering)
+    return cache, _calls
+
+
+def test_cluster_cache_1():
+    spike_clusters = artificial_spike_clusters(100, 5)
+    clustering = Clustering(spike_clusters)
+    cache, _calls = _make_cache(clustering)
+
+    ae(cache(0), np.nonzero(spike_clusters == 0)[0])
+    cache(0)
+    cache(1)
+    assert _calls == [0, 1]
+    assert cache.stats['hits'] == 1
+    assert 0 in cache
+
+    # Merge: the entries of the deleted clusters are spilled.
+    up = clustering.merge([0, 1])
+    assert 0 not in cache
+    assert cache.spilled == [0, 1]
+    cache(up.added[0])
+    assert _calls == [0, 1, 5]
+
+    # Undo: the entries of the previous clusters are resurrected.
+    clustering.undo()
+    assert 0 in cache
+    assert 5 not in cache
+    ae(cache(0), np.nonzero(spike_clusters == 0)[0])
+    assert _calls == [0, 1, 5]
+    assert cache.stats['resurrections'] == 2
+
+    # Redo.
+    clustering.redo()
+    cache(5)
+    assert _calls == [0, 1, 5]
+
+
+def test_cluster_cache_precompute():
+    spike_clusters = artificial_spike_clusters(100, 5)
+    clustering = Clustering(spike_clusters)
+    cache, _calls = _make_cache(clustering, precompute=True)
+
+    up = clustering.split(np.arange(10))
+    cache.wait()
+    assert sorted(_calls) == sorted(up.added)
+    for cluster_id in up.added:
+        assert cluster_id in cache
+
+
+def test_cluster_cache_spill_size():
+    spike_clusters = artificial_spike_clusters(100, 5)
+    clustering = Clustering(spike_clusters)
+    cache, _calls = _make_cache(clustering, spill_size=0)
+    cache(0)
+    clustering.merge([0, 1])
+    assert not cache.spilled
+    clustering.undo()
+    cache(0)
+    assert _calls == [0, 0]
@@ -493,3 +493,43 @@ def test_clustering_long():
     clustering.assign(my_spikes, clusters)
     clu = clustering.spike_clusters[my_spikes]
     ae(clu - clu[0], clusters)
+
+
+def test_clustering_spikes_per_cluster():
+    n_spikes = 1000
+    n_clusters = 10
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    clustering = Clustering(spike_clusters)
+
+    def _check():
+        spc = clustering.spikes_per_cluster
+        ae(spc.cluster_ids, clustering.cluster_ids)
+        ae(spc.spike_clusters(n_spikes), clustering.spike_clusters)
+
+    _check()
+    clustering.merge([0, 1])
+    _check()
+    clustering.split(np.arange(0, 500, 3))
+    _check()
+    clustering.merge(clustering.cluster_ids[:3])
+    _check()
+    clustering.undo()
+    _check()
+    clustering.undo()
+    _check()
+    clustering.redo()
+    _check()
+
+    # Pass the precomputed structure.
+    spc = clustering.spikes_per_cluster.copy()
+    clustering = Clustering(clustering.spike_clusters,
+                            spikes_per_cluster=spc)
+    assert clustering.spikes_per_cluster is spc
+    _check()
+
+    # An incoherent structure is recomputed.
+    spc.remove([spc.cluster_ids[0]])
+    clustering = Clustering(clustering.spike_clusters,
+                            spikes_per_cluster=spc)
+    assert clustering.spikes_per_cluster is not spc
+    _check()
@@ -11,6 +11,7 @@ import numpy as np
 from numpy.testing import assert_array_equal as ae
 
 from .. import supervisor as _supervisor
+from .._cache import ClusterCache
 from ..supervisor import (Supervisor,
                           )
 from phy.io import Context
@@ -126,6 +127,35 @@ def test_supervisor_merge(supervisor):
     assert mc.selected == [31, 11]
 
 
+def test_supervisor_quality_cache(supervisor):
+    mc = supervisor
+    quality = mc.quality
+    assert isinstance(quality, ClusterCache)
+    assert quality.__name__ == 'quality'
+    assert 30 in quality
+
+    mc.merge([30, 20])
+    assert 31 in quality
+    assert 30 in quality.spilled
+
+    # The quality of the restored clusters is not recomputed.
+    mc.undo()
+    assert 30 in quality
+    assert quality.resurrections >= 2
+
+
+def test_supervisor_selector(supervisor):
+    mc = supervisor
+    selector = mc.selector
+    assert selector is mc.selector
+    ae(selector.select_spikes([30, 20], 10), [5, 6])
+
+    # The subsampling index is updated after a merge.
+    mc.merge([30, 20])
+    assert 31 in selector.subsampling_index
+    ae(selector.select_spikes([31], 10), [5, 6])
+
+
 def test_supervisor_merge_move(supervisor):
     """Check that merge then move selects the next cluster in the original
     cluster view, not the updated cluster view."""
@@ -14,6 +14,7 @@ from phy.gui import GUI
 from phy.io.mock import (artificial_traces,
                          artificial_spike_clusters,
                          )
+from phy.io import SpikeTimeIndex
 from phy.utils import Bunch
 from phy.utils._color import ColorSelector
 
@@ -48,6 +49,18 @@ def test_trace_view(tempdir, qtbot):
                                )
     assert len(list(sw))
 
+    # Only iterate over the spikes of the selected clusters.
+    sw = _iter_spike_waveforms(interval=[0., 1.],
+                               traces_interval=traces,
+                               model=m,
+                               supervisor=s,
+                               n_samples_waveforms=ns,
+                               get_best_channels=lambda cluster_id: ch,
+                               color_selector=cs,
+                               spike_time_index=SpikeTimeIndex(st, sc),
+                               )
+    assert all(w.spike_cluster == 0 for w in sw)
+
     def get_traces(interval):
         out = Bunch(data=select_traces(traces, interval, sample_rate=sr),
                     color=(.75,) * 4,
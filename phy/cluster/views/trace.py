@@ -41,16 +41,23 @@ def _iter_spike_waveforms(interval=None,
                           get_best_channels=None,
                           show_all_spikes=False,
                           color_selector=None,
+                          spike_time_index=None,
                           ):
     m = model
     p = supervisor
     cs = color_selector
     sr = m.sample_rate
-    a, b = m.spike_times.searchsorted(interval)
+    if spike_time_index is not None and not show_all_spikes:
+        # Only look at the spikes of the selected clusters.
+        spike_ids = spike_time_index.spikes_in_interval(
+            interval, cluster_ids=supervisor.selected)
+    else:
+        a, b = m.spike_times.searchsorted(interval)
+        spike_ids = range(a, b)
     s0, s1 = int(round(interval[0] * sr)), int(round(interval[1] * sr))
     ns = n_samples_waveforms
     k = ns // 2
-    for i in range(a, b):
+    for i in spike_ids:
         t = m.spike_times[i]
         c = m.spike_clusters[i]
         # Skip non-selected spikes if requested.
@@ -4,4 +4,7 @@
 """Input/output."""
 
 from .context import Context
-from .array import Selector, select_spikes
+from .array import Selector, SubsamplingIndex, select_spikes
+from .traces import RawTraces, read_raw_traces
+from .spike_times import SpikeTimeIndex
+from .warmup import WarmCachePlugin, warm_caches
@@ -16,7 +16,9 @@ import os.path as op
 import numpy as np
 
 from phy.utils import _as_scalar, _as_scalars
-from phy.utils._types import _as_array, _is_array_like
+from phy.utils._types import _as_array, _is_array_like, _is_integer
+from .compressed import CompressedArray, write_compressed_array
+from .traces import RawTraces
 
 logger = logging.getLogger(__name__)
 
@@ -217,19 +219,29 @@ def get_closest_clusters(cluster_id, cluster_ids, sim_func, max_n=None):
 # -----------------------------------------------------------------------------
 
 def read_array(path, mmap_mode=None):
-    """Read a .npy array."""
+    """Read a .npy array, or open a chunked compressed .cbin array."""
     file_ext = op.splitext(path)[1]
     if file_ext == '.npy':
         return np.load(path, mmap_mode=mmap_mode)
+    elif file_ext == '.cbin':
+        # NOTE: the chunks are decompressed lazily, on access.
+        return CompressedArray(path)
     raise NotImplementedError("The file extension `{}` ".format(file_ext) +
                               "is not currently supported.")
 
 
-def write_array(path, arr):
-    """Write an array to a .npy file."""
+def write_array(path, arr, **kwargs):
+    """Write an array to a .npy file, or to a chunked compressed .cbin file.
+
+    Keyword arguments are passed to `write_compressed_array()` with .cbin
+    files.
+
+    """
     file_ext = op.splitext(path)[1]
     if file_ext == '.npy':
         return np.save(path, arr)
+    elif file_ext == '.cbin':
+        return write_compressed_array(path, arr, **kwargs)
     raise NotImplementedError("The file extension `{}` ".format(file_ext) +
                               "is not currently supported.")
 
@@ -274,7 +286,13 @@ def _fill_index(arr, item):
 
 class ConcatenatedArrays(object):
     """This object represents a concatenation of several memory-mapped
-    arrays."""
+    arrays.
+
+    The column selection and the scaling are done in the reads of the
+    individual arrays, directly into a single preallocated output array.
+    The output is `float32` when integer arrays are scaled.
+
+    """
     def __init__(self, arrs, cols=None, scaling=None):
         assert isinstance(arrs, list)
         self.arrs = arrs
@@ -283,8 +301,12 @@ class ConcatenatedArrays(object):
         self.offsets = np.concatenate([[0], np.cumsum([arr.shape[0]
                                                        for arr in arrs])],
                                       axis=0)
-        self.dtype = arrs[0].dtype if arrs else None
-        self.scaling = scaling
+        self.scaling = scaling if scaling != 1 else None
+        dtype = np.dtype(arrs[0].dtype) if arrs else None
+        if (dtype is not None and self.scaling is not None and
+                not np.issubdtype(dtype, np.floating)):
+            dtype = np.dtype(np.float32)
+        self.dtype = dtype
 
     @property
     def shape(self):
@@ -297,28 +319,118 @@ class ConcatenatedArrays(object):
     def _get_recording(self, index):
         """Return the recording that contains a given index."""
         assert index >= 0
-        recs = np.nonzero((index - self.offsets[:-1]) >= 0)[0]
-        if len(recs) == 0:  # pragma: no cover
-            # If the index is greater than the total size,
-            # return the last recording.
-            return len(self.arrs) - 1
+        return int(self._get_recordings(index))
+
+    def _get_recordings(self, indices):
+        """Return the recordings that contain the given indices."""
         # Return the last recording such that the index is greater than
-        # its offset.
-        return recs[-1]
+        # its offset. If the index is greater than the total size,
+        # return the last recording.
+        recs = np.searchsorted(self.offsets, indices, side='right') - 1
+        return np.clip(recs, 0, len(self.arrs) - 1)
+
+    def _split_cols(self, item):
+        """Compose the column selection of an item with `cols`.
+
+        Return the item without its column selection, and the columns to
+        select in the underlying arrays.
+
+        """
+        if (isinstance(item, tuple) and len(item) >= 2 and
+                self.arrs[0].ndim >= 2):
+            cols = (item[1] if self.cols is None
+                    else np.asarray(self.cols)[item[1]])
+            return (item[0],) + item[2:], cols
+        if self.cols is None:
+            return item, slice(None, None, None)
+        return item, self.cols
+
+    def _empty(self, n, item, cols):
+        """Allocate the output array for `n` rows."""
+        empty = np.empty((0,) + self.arrs[0].shape[1:], dtype=self.dtype)
+        shape = _fill_index(empty, item)[..., cols].shape[1:]
+        return np.empty((n,) + shape, dtype=self.dtype)
+
+    def _read(self, rec, rows, item, cols, out):
+        """Read some rows of a recording into a preallocated array.
+
+        The rest of the index, the column selection, and the scaling are
+        applied in the same pass. With `RawTraces`, only the requested
+        columns are read from disk.
+
+        """
+        arr = self.arrs[rec]
+        if isinstance(arr, RawTraces) and out.dtype == arr.dtype:
+            if isinstance(cols, slice) and cols == slice(None, None, None):
+                cols = None
+            elif _is_integer(cols):
+                cols, out = [cols], out[:, None]
+            arr.get(rows, cols, out=out)
+            if self.scaling is not None:
+                out *= out.dtype.type(self.scaling)
+            return
+        chunk = _fill_index(arr[rows], item)[..., cols]
+        if self.scaling is not None:
+            np.multiply(chunk, out.dtype.type(self.scaling), out=out,
+                        casting='unsafe')
+        else:
+            out[...] = chunk
+
+    def _get_indices(self, item, cols):
+        """Gather arbitrary integer indices in the first dimension.
+
+        The indices are bucketed per recording, each bucket is loaded
+        from its array in a single fancy-indexing call, and the chunks
+        are scattered into a preallocated output array.
+
+        """
+        indices = np.asarray(item[0] if isinstance(item, tuple) else item)
+        if indices.dtype == np.bool_:
+            indices = np.nonzero(indices)[0]
+        indices = indices.astype(np.int64)
+        assert indices.ndim == 1
+        n = self.offsets[-1]
+        # Support negative indices.
+        indices = np.where(indices < 0, indices + n, indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= n):
+            raise IndexError("Some indices are out of bounds "
+                             "for a virtual array with "
+                             "{} elements.".format(n))
+        recs = self._get_recordings(indices)
+        # NOTE: this sort is stable and linear if the indices are already
+        # sorted, which is the common case with spike ids.
+        order = np.argsort(recs, kind='mergesort')
+        bounds = np.searchsorted(recs[order], np.arange(len(self.arrs) + 1))
+        out = self._empty(len(indices), item, cols)
+        for rec in np.nonzero(np.diff(bounds))[0]:
+            idx = order[bounds[rec]:bounds[rec + 1]]
+            if len(idx) == len(indices):
+                # All indices are in the same recording: no scattering.
+                self._read(rec, indices - self.offsets[rec], item, cols, out)
+                break
+            chunk = self._empty(len(idx), item, cols)
+            self._read(rec, indices[idx] - self.offsets[rec], item, cols,
+                       chunk)
+            out[idx] = chunk
+        return out
 
     def _get(self, item):
-        cols = self.cols if self.cols is not None else slice(None, None, None)
+        item, cols = self._split_cols(item)
+        # Arbitrary integer indices in the first dimension.
+        first = item[0] if isinstance(item, tuple) else item
+        if isinstance(first, (list, np.ndarray)):
+            return self._get_indices(item, cols)
         # Get the start and stop indices of the requested item.
         start, stop = _start_stop(item)
-        # Return the concatenation of all arrays.
-        if start is None and stop is None:
-            return np.concatenate(self.arrs, axis=0)[..., cols]
+        full = start is None and stop is None
         if start is None:
             start = 0
         if stop is None:
             stop = self.offsets[-1]
         if stop < 0:
             stop = self.offsets[-1] + stop
+        stop = min(stop, self.offsets[-1])
+        stop = max(start, stop)
         # Get the recording indices of the first and last item.
         rec_start = self._get_recording(start)
         rec_stop = self._get_recording(stop)
@@ -326,30 +438,24 @@ class ConcatenatedArrays(object):
         # Find the start and stop relative to the arrays.
         start_rel = start - self.offsets[rec_start]
         stop_rel = stop - self.offsets[rec_stop]
-        # Single array case.
-        if rec_start == rec_stop:
-            # Apply the rest of the index.
-            out = _fill_index(self.arrs[rec_start][start_rel:stop_rel], item)
-            out = out[..., cols]
-            return out
-        chunk_start = self.arrs[rec_start][start_rel:]
-        chunk_stop = self.arrs[rec_stop][:stop_rel]
-        # Concatenate all chunks.
-        l = [chunk_start]
-        if rec_stop - rec_start >= 2:
+        if not full and rec_stop - rec_start >= 2:
             logger.warn("Loading a full virtual array: this might be slow "
                         "and something might be wrong.")
-            l += [self.arrs[r][...] for r in range(rec_start + 1,
-                                                   rec_stop)]
-        l += [chunk_stop]
-        # Apply the rest of the index.
-        return _fill_index(np.concatenate(l, axis=0), item)[..., cols]
+        # Write all chunks directly in a preallocated array, applying the
+        # rest of the index, the columns, and the scaling on each chunk.
+        out = self._empty(stop - start, item, cols)
+        pos = 0
+        for rec in range(rec_start, rec_stop + 1):
+            i = start_rel if rec == rec_start else 0
+            j = stop_rel if rec == rec_stop else self.arrs[rec].shape[0]
+            self._read(rec, slice(i, j), item, cols, out[pos:pos + j - i])
+            pos += j - i
+        assert pos == len(out)
+        return out
 
     def __getitem__(self, item):
         out = self._get(item)
         assert out is not None
-        if self.scaling is not None and self.scaling != 1:
-            out = out * self.scaling
         return out
 
     def __len__(self):
@@ -469,33 +575,286 @@ def _spikes_in_clusters(spike_clusters, clusters):
     return np.nonzero(np.in1d(spike_clusters, clusters))[0]
 
 
-def _spikes_per_cluster(spike_clusters, spike_ids=None):
-    """Return a dictionary {cluster: list_of_spikes}."""
-    if spike_clusters is None or not len(spike_clusters):
-        return {}
+def _group_spikes(spike_clusters, spike_ids=None, keys=None):
+    """Group spikes by cluster.
+
+    Return `(clusters, offsets, spikes)` where `clusters` contains the sorted
+    unique cluster ids, and the spikes of `clusters[i]` are
+    `spikes[offsets[i]:offsets[i + 1]]` in increasing order (or in the order
+    of `keys` if specified).
+
+    """
+    spike_clusters = np.asarray(spike_clusters, dtype=np.int64)
     if spike_ids is None:
         spike_ids = np.arange(len(spike_clusters)).astype(np.int64)
-    # NOTE: this sort method is stable, so spike ids are increasing
-    # among any cluster. Therefore we don't have to sort again down here,
-    # when creating the spikes_in_clusters dictionary.
-    rel_spikes = np.argsort(spike_clusters, kind='mergesort')
-    abs_spikes = spike_ids[rel_spikes]
+    spike_ids = np.asarray(spike_ids, dtype=np.int64)
+    assert spike_ids.shape == spike_clusters.shape
+    if not len(spike_clusters):
+        return (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                np.zeros(0, dtype=np.int64))
+    if keys is not None:
+        rel_spikes = np.lexsort((keys, spike_clusters))
+    elif len(spike_ids) >= 2 and np.all(spike_ids[1:] > spike_ids[:-1]):
+        # NOTE: this sort method is stable, so spike ids are increasing
+        # among any cluster when they are initially sorted.
+        rel_spikes = np.argsort(spike_clusters, kind='mergesort')
+    else:
+        rel_spikes = np.lexsort((spike_ids, spike_clusters))
+    spikes = spike_ids[rel_spikes]
     spike_clusters = spike_clusters[rel_spikes]
 
-    diff = np.empty_like(spike_clusters)
-    diff[0] = 1
-    diff[1:] = np.diff(spike_clusters)
+    idx = np.nonzero(np.diff(spike_clusters))[0] + 1
+    offsets = np.concatenate([[0], idx, [len(spikes)]]).astype(np.int64)
+    clusters = spike_clusters[offsets[:-1]]
+    return clusters, offsets, spikes
+
+
+class SpikesPerCluster(object):
+    """Compact mapping `{cluster_id: sorted_spike_ids}`.
+
+    All spike ids are stored in a single array, grouped by cluster, and a
+    cluster table contains the start and stop offsets of every cluster in
+    that array. This object supports the read-only dictionary interface.
+
+    Removing clusters leaves holes in the spike array, and new clusters are
+    appended at its end, so that updates after a merge or a split only cost
+    O(number of changed spikes). The array is compacted when the holes
+    become too large.
+
+    """
+    def __init__(self, spike_clusters=None, spike_ids=None):
+        self._spikes = np.zeros(0, dtype=np.int64)
+        self._size = 0  # number of used items in self._spikes
+        self._clusters = np.zeros(0, dtype=np.int64)  # sorted
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._stops = np.zeros(0, dtype=np.int64)
+        if spike_clusters is not None and len(spike_clusters):
+            clusters, offsets, spikes = _group_spikes(spike_clusters,
+                                                      spike_ids)
+            self._spikes = spikes
+            self._size = len(spikes)
+            self._clusters = clusters
+            self._starts = offsets[:-1].copy()
+            self._stops = offsets[1:].copy()
+
+    @staticmethod
+    def from_dict(d):
+        """Create a SpikesPerCluster instance from a dictionary."""
+        spc = SpikesPerCluster()
+        spc.update(d)
+        return spc
+
+    # Dictionary interface
+    # -------------------------------------------------------------------------
+
+    def _index(self, cluster):
+        i = np.searchsorted(self._clusters, cluster)
+        if i < len(self._clusters) and self._clusters[i] == cluster:
+            return i
+        return None
+
+    def __getitem__(self, cluster):
+        i = self._index(cluster)
+        if i is None:
+            raise KeyError(cluster)
+        return self._spikes[self._starts[i]:self._stops[i]]
+
+    def get(self, cluster, default=None):
+        i = self._index(cluster)
+        if i is None:
+            return default
+        return self._spikes[self._starts[i]:self._stops[i]]
+
+    def __contains__(self, cluster):
+        return self._index(cluster) is not None
+
+    def __len__(self):
+        return len(self._clusters)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """Sorted list of cluster ids."""
+        return [int(c) for c in self._clusters]
+
+    def values(self):
+        return [self._spikes[i:j] for i, j in zip(self._starts, self._stops)]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def to_dict(self):
+        """Return a `{cluster_id: spike_ids}` dictionary."""
+        return {c: spikes.copy() for c, spikes in self.items()}
+
+    def copy(self):
+        spc = SpikesPerCluster()
+        spc.__setstate__(self.__getstate__())
+        return spc
+
+    # Array properties
+    # -------------------------------------------------------------------------
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of cluster ids."""
+        return self._clusters
+
+    @property
+    def counts(self):
+        """Number of spikes in every cluster, in the order of `cluster_ids`."""
+        return self._stops - self._starts
 
-    idx = np.nonzero(diff > 0)[0]
-    clusters = spike_clusters[idx]
+    @property
+    def n_spikes(self):
+        """Total number of spikes."""
+        return int(self.counts.sum())
+
+    def head(self, cluster_ids, n=None):
+        """Return the concatenation of the first `n` spikes of some clusters,
+        in the order of `cluster_ids`, or of all their spikes if `n` is
+        None."""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        idx = np.searchsorted(self._clusters, cluster_ids)
+        idx = np.clip(idx, 0, max(0, len(self._clusters) - 1))
+        found = (self._clusters[idx] == cluster_ids if len(self._clusters)
+                 else np.zeros(len(cluster_ids), dtype=np.bool_))
+        if not np.all(found):
+            raise KeyError(cluster_ids[~found].tolist())
+        starts = self._starts[idx]
+        counts = self._stops[idx] - starts
+        if n is not None:
+            counts = np.minimum(counts, n)
+        # Vectorized concatenation of the prefixes of all clusters.
+        offsets = np.cumsum(counts) - counts
+        pos = np.arange(counts.sum()) + np.repeat(starts - offsets, counts)
+        return self._spikes[pos]
+
+    def spike_clusters(self, n_spikes=None):
+        """Return the spike-cluster assignment."""
+        n_spikes = n_spikes if n_spikes is not None else self.n_spikes
+        out = np.empty(n_spikes, dtype=np.int64)
+        spikes = np.concatenate(self.values() or [[]]).astype(np.int64)
+        out[spikes] = np.repeat(self._clusters, self.counts)
+        return out
 
-    # NOTE: we don't have to sort abs_spikes[...] here because the argsort
-    # using 'mergesort' above is stable.
-    spikes_in_clusters = {clusters[i]: abs_spikes[idx[i]:idx[i + 1]]
-                          for i in range(len(clusters) - 1)}
-    spikes_in_clusters[clusters[-1]] = abs_spikes[idx[-1]:]
+    # Updates
+    # -------------------------------------------------------------------------
+
+    def _reserve(self, n):
+        """Make sure there is room for n additional spikes."""
+        if self._size + n <= len(self._spikes):
+            return
+        capacity = max(self._size + n, 2 * len(self._spikes), 16)
+        spikes = np.empty(capacity, dtype=np.int64)
+        spikes[:self._size] = self._spikes[:self._size]
+        self._spikes = spikes
+
+    def remove(self, clusters):
+        """Remove some clusters."""
+        clusters = np.asarray(list(clusters), dtype=np.int64)
+        if not len(clusters):
+            return
+        keep = ~np.in1d(self._clusters, clusters)
+        self._clusters = self._clusters[keep]
+        self._starts = self._starts[keep]
+        self._stops = self._stops[keep]
+        # Compact the spike array when more than half of it is unused.
+        if self._size > 2 * max(1024, self.n_spikes):
+            self.compact()
+
+    def add(self, spike_ids, spike_clusters, keys=None):
+        """Add spikes to clusters.
+
+        Spikes belonging to existing clusters are merged with these clusters.
+        By default, the spikes are sorted by increasing id within every
+        cluster. Another order within the new clusters can be specified
+        with `keys`.
+
+        """
+        clusters, offsets, spikes = _group_spikes(spike_clusters, spike_ids,
+                                                  keys=keys)
+        if not len(clusters):
+            return
+        existing = np.in1d(clusters, self._clusters)
+        if np.any(existing):
+            if keys is not None:
+                raise ValueError("Custom orders are not supported when "
+                                 "adding spikes to existing clusters.")
+            # Rare case: some clusters already exist. We merge the existing
+            # and new spikes of these clusters.
+            old = [self[c] for c in clusters[existing]]
+            new = np.concatenate(old + [spikes])
+            new_clusters = np.concatenate(
+                [np.repeat(clusters[existing], [len(o) for o in old]),
+                 np.repeat(clusters, np.diff(offsets))])
+            self.remove(clusters[existing])
+            return self.add(new, new_clusters)
+        # Append the new spikes at the end of the spike array.
+        n = len(spikes)
+        self._reserve(n)
+        self._spikes[self._size:self._size + n] = spikes
+        starts = self._size + offsets[:-1]
+        stops = self._size + offsets[1:]
+        self._size += n
+        # Insert the new clusters in the sorted cluster table.
+        all_clusters = np.concatenate((self._clusters, clusters))
+        order = np.argsort(all_clusters, kind='mergesort')
+        self._clusters = all_clusters[order]
+        self._starts = np.concatenate((self._starts, starts))[order]
+        self._stops = np.concatenate((self._stops, stops))[order]
+
+    def update(self, other):
+        """Add clusters from a dictionary or a SpikesPerCluster instance."""
+        if isinstance(other, SpikesPerCluster):
+            spikes = np.concatenate(other.values() or [[]])
+            clusters = np.repeat(other.cluster_ids, other.counts)
+        else:
+            spikes = [np.asarray(v, dtype=np.int64) for v in other.values()]
+            clusters = np.repeat(np.asarray(list(other.keys()),
+                                            dtype=np.int64),
+                                 [len(v) for v in spikes])
+            spikes = np.concatenate(spikes or [[]])
+        self.add(spikes.astype(np.int64), clusters)
+
+    def compact(self):
+        """Remove the holes in the spike array."""
+        counts = self.counts
+        spikes = np.concatenate(self.values() or [[]]).astype(np.int64)
+        self._spikes = spikes
+        self._size = len(spikes)
+        self._stops = np.cumsum(counts).astype(np.int64)
+        self._starts = self._stops - counts
+
+    # Pickling
+    # -------------------------------------------------------------------------
+
+    def __getstate__(self):
+        """Only pickle the compacted arrays."""
+        self.compact()
+        return {'spikes': self._spikes,
+                'clusters': self._clusters,
+                'offsets': np.append(self._starts, self._size),
+                }
+
+    def __setstate__(self, state):
+        self._spikes = state['spikes']
+        self._size = len(self._spikes)
+        self._clusters = state['clusters']
+        self._starts = state['offsets'][:-1]
+        self._stops = state['offsets'][1:]
+
+    def __repr__(self):
+        return '<SpikesPerCluster: {} clusters, {} spikes>'.format(
+            len(self), self.n_spikes)
 
-    return spikes_in_clusters
+
+def _spikes_per_cluster(spike_clusters, spike_ids=None):
+    """Return a `SpikesPerCluster` mapping {cluster: list_of_spikes}."""
+    if spike_clusters is None or not len(spike_clusters):
+        return SpikesPerCluster()
+    return SpikesPerCluster(spike_clusters, spike_ids=spike_ids)
 
 
 def _flatten_per_cluster(per_cluster):
@@ -520,9 +879,9 @@ def grouped_mean(arr, spike_clusters):
     spike_clusters_rel = _index_of(spike_clusters, cluster_ids)
     spike_counts = np.bincount(spike_clusters_rel)
     assert len(spike_counts) == len(cluster_ids)
-    t = np.zeros(len(cluster_ids))
     # Compute the sum with possible repetitions.
-    np.add.at(t, spike_clusters_rel, arr)
+    t = np.bincount(spike_clusters_rel, weights=arr,
+                    minlength=len(cluster_ids))
     return t / spike_counts
 
 
@@ -542,6 +901,13 @@ def regular_subset(spikes, n_spikes_max=None, offset=0):
     return my_spikes
 
 
+def _n_spikes_per_cluster(max_n_spikes_per_cluster, n_clusters):
+    """Decrease the number of spikes per cluster when there are more
+    clusters."""
+    n = int(max_n_spikes_per_cluster * exp(-.1 * (n_clusters - 1)))
+    return max(1, n)
+
+
 def select_spikes(cluster_ids=None,
                   max_n_spikes_per_cluster=None,
                   spikes_per_cluster=None,
@@ -562,8 +928,7 @@ def select_spikes(cluster_ids=None,
         for cluster in cluster_ids:
             # Decrease the number of spikes per cluster when there
             # are more clusters.
-            n = int(max_n_spikes_per_cluster * exp(-.1 * (n_clusters - 1)))
-            n = max(1, n)
+            n = _n_spikes_per_cluster(max_n_spikes_per_cluster, n_clusters)
             spike_ids = spikes_per_cluster(cluster)
             if subset == 'regular':
                 # Regular subselection.
@@ -582,12 +947,138 @@ def select_spikes(cluster_ids=None,
     return _flatten_per_cluster(selection)
 
 
+def _hash_uniform(x, seed=0):
+    """Deterministic pseudo-random numbers in [0, 1) from integers.
+
+    This uses the splitmix64 finalizer, so that the random number associated
+    to a given integer does not depend on the other integers.
+
+    """
+    z = np.asarray(x).astype(np.uint64) + np.uint64(seed)
+    with np.errstate(over='ignore'):
+        z = z * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def _pyramid_levels(ranks, counts):
+    """Level of every spike in the regular sample pyramid of its cluster.
+
+    Level 0 contains the first spike, and level `L` contains the spikes with
+    a rank that is an odd multiple of `2 ** (L_max - L)`, so that the union
+    of the first levels is a regular subset of the cluster.
+
+    """
+    ranks = np.asarray(ranks, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    l_max = np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64)
+    # Number of trailing zeros of the rank (the lowest set bit).
+    low_bit = ranks & -ranks
+    tz = np.log2(np.maximum(low_bit, 1)).astype(np.int64)
+    return np.where(ranks == 0, 0, l_max - tz)
+
+
+class SubsamplingIndex(object):
+    """Precomputed, reproducible subsampling order of the spikes of every
+    cluster.
+
+    The spikes of every cluster are stored in sample order in a single
+    array (see `SpikesPerCluster`), so that selecting at most `n` spikes per
+    cluster is a prefix slice. With `stratified=True`, the order is a
+    regular pyramid: every prefix is made of regularly-spaced spikes, with
+    a pseudo-random choice within the last level. Otherwise, the order is a
+    pseudo-random permutation.
+
+    The order only depends on the spike ids of the cluster and on the seed,
+    so it is reproducible across sessions and after undo/redo. The index is
+    updated incrementally when clusters change.
+
+    """
+    def __init__(self, spikes_per_cluster=None, seed=0, stratified=True):
+        self.seed = seed
+        self.stratified = stratified
+        self._order = SpikesPerCluster()
+        if spikes_per_cluster:
+            self.add_clusters(spikes_per_cluster)
+
+    @property
+    def cluster_ids(self):
+        return self._order.cluster_ids
+
+    def __contains__(self, cluster):
+        return cluster in self._order
+
+    def add_clusters(self, spikes_per_cluster, cluster_ids=None):
+        """Add clusters from a mapping {cluster: sorted_spike_ids}."""
+        if cluster_ids is None:
+            cluster_ids = list(spikes_per_cluster.keys())
+        if not len(cluster_ids):
+            return
+        spikes = [np.asarray(spikes_per_cluster[c], dtype=np.int64)
+                  for c in cluster_ids]
+        counts = np.array([len(s) for s in spikes], dtype=np.int64)
+        spike_ids = np.concatenate(spikes)
+        clusters = np.repeat(np.asarray(cluster_ids, dtype=np.int64), counts)
+        keys = _hash_uniform(spike_ids, self.seed)
+        if self.stratified:
+            # Rank of every spike within its cluster.
+            starts = np.cumsum(counts) - counts
+            ranks = np.arange(len(spike_ids)) - np.repeat(starts, counts)
+            keys = keys + _pyramid_levels(ranks, np.repeat(counts, counts))
+        self._order.add(spike_ids, clusters, keys=keys)
+
+    def remove_clusters(self, cluster_ids):
+        self._order.remove(cluster_ids)
+
+    def on_cluster(self, up, spikes_per_cluster):
+        """Update the index after a clustering change."""
+        self.remove_clusters(up.deleted)
+        self.add_clusters(spikes_per_cluster, up.added)
+
+    def attach(self, clustering):
+        """Keep the index in sync with a `Clustering` instance."""
+        if not len(self._order):
+            self.add_clusters(clustering.spikes_per_cluster)
+
+        @clustering.connect
+        def on_cluster(up):
+            if up.added or up.deleted:
+                self.on_cluster(up, clustering.spikes_per_cluster)
+        return self
+
+    def select(self, cluster_ids, max_n_spikes_per_cluster=None):
+        """Return a sorted selection of spikes from the specified clusters
+        with at most `max_n_spikes_per_cluster` spikes per cluster (which
+        decreases when there are many clusters, as in `select_spikes()`)."""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        if not len(cluster_ids):
+            return np.array([], dtype=np.int64)
+        n = None
+        if max_n_spikes_per_cluster not in (None, 0):
+            n = _n_spikes_per_cluster(max_n_spikes_per_cluster,
+                                      len(cluster_ids))
+        try:
+            spike_ids = self._order.head(cluster_ids, n)
+        except KeyError as e:
+            raise KeyError("Clusters {} are not in the subsampling "
+                           "index.".format(e.args[0]))
+        return np.sort(spike_ids)
+
+
 class Selector(object):
     """This object is passed with the `select` event when clusters are
-    selected. It allows to make selections of spikes."""
-    def __init__(self, spikes_per_cluster):
+    selected. It allows to make selections of spikes.
+
+    When a `SubsamplingIndex` is specified, regular selections without
+    batches are prefix slices of the precomputed sample orders.
+
+    """
+    def __init__(self, spikes_per_cluster, subsampling_index=None):
         # NOTE: spikes_per_cluster is a function.
         self.spikes_per_cluster = spikes_per_cluster
+        self.subsampling_index = subsampling_index
 
     def select_spikes(self, cluster_ids=None,
                       max_n_spikes_per_cluster=None,
@@ -598,6 +1089,13 @@ class Selector(object):
             return None
         ns = max_n_spikes_per_cluster
         assert len(cluster_ids) >= 1
+        # Use the precomputed subsampling index if possible.
+        index = self.subsampling_index
+        if (index is not None and batch_size is None and
+                (subset or 'regular') == ('regular' if index.stratified
+                                          else 'random') and
+                all(c in index for c in cluster_ids)):
+            return index.select(cluster_ids, max_n_spikes_per_cluster=ns)
         # Select a subset of the spikes.
         return select_spikes(cluster_ids,
                              spikes_per_cluster=self.spikes_per_cluster,
@@ -607,6 +1105,62 @@ class Selector(object):
                              )
 
 
+# -----------------------------------------------------------------------------
+# Clustering listener
+# -----------------------------------------------------------------------------
+
+def _merged_parents(up):
+    """Return `{new_cluster: parents}` for the new clusters of a clustering
+    change that are unions of whole old clusters."""
+    children = defaultdict(set)
+    parents = defaultdict(set)
+    for old, new in up.descendants or ():
+        children[old].add(new)
+        parents[new].add(old)
+    return {new: sorted(olds) for new, olds in parents.items()
+            if all(children[old] == {new} for old in olds)}
+
+
+class _ClusteringListener(object):
+    """Base class of the per-cluster data kept in sync with a `Clustering`.
+
+    `attach()` connects `on_cluster()` to the `cluster` events of the
+    clustering. The attributes listed in `_clustering_attrs` are copied from
+    the clustering when attaching and before every event, since the
+    clustering may replace these objects. `_on_attach()` is called once,
+    after these attributes are copied.
+
+    Modified clusters always get new ids, and ids are never reused. The data
+    of a cluster never needs to be invalidated: the data of the deleted
+    clusters can be kept and reused when an undo brings them back.
+
+    """
+    clustering = None
+    _clustering_attrs = ('spikes_per_cluster',)
+
+    def _copy_clustering_attrs(self):
+        for name in self._clustering_attrs:
+            setattr(self, name, getattr(self.clustering, name))
+
+    def _on_attach(self):
+        pass
+
+    def on_cluster(self, up):
+        pass
+
+    def attach(self, clustering):
+        """Keep the object in sync with a `Clustering` instance."""
+        self.clustering = clustering
+        self._copy_clustering_attrs()
+        self._on_attach()
+
+        @clustering.connect
+        def on_cluster(up):
+            self._copy_clustering_attrs()
+            self.on_cluster(up)
+        return self
+
+
 # -----------------------------------------------------------------------------
 # Accumulator
 # -----------------------------------------------------------------------------
@@ -616,13 +1170,36 @@ def _flatten(l):
 
 
 class Accumulator(object):
-    """Accumulate arrays for concatenation."""
-    def __init__(self):
+    """Accumulate arrays for concatenation.
+
+    The arrays are concatenated in two passes. The first pass, when the
+    arrays are added, only registers their sizes and dtypes. The second
+    pass, when the concatenated array is requested, allocates a single
+    buffer and writes every array directly into its slice.
+
+    Parameters
+    ----------
+
+    dtype : dtype
+        If specified, the floating-point arrays are converted to this dtype
+        in the same pass (for example, `float32` for vertex attributes).
+    keep_dtype : tuple
+        Names of the arrays that should keep their own dtype.
+
+    """
+    def __init__(self, dtype=None, keep_dtype=()):
         self._data = defaultdict(list)
+        self._sizes = defaultdict(int)
+        self._dtypes = defaultdict(set)
+        self._dtype = dtype
+        self._keep_dtype = keep_dtype
 
     def add(self, name, val):
         """Add an array."""
         self._data[name].append(val)
+        if isinstance(val, np.ndarray) and val.ndim >= 1:
+            self._sizes[name] += val.shape[0]
+            self._dtypes[name].add(val.dtype)
 
     @property
     def names(self):
@@ -633,23 +1210,51 @@ class Accumulator(object):
         """Return the list of arrays for a given name."""
         return _flatten(self._data[name])
 
+    def _buffer(self, name):
+        """Allocate the output buffer, or return None if the arrays cannot
+        be written in a single buffer."""
+        l = self._data[name]
+        if not l or not all(isinstance(val, np.ndarray) and val.ndim >= 1
+                            for val in l):
+            return
+        shape = l[0].shape[1:]
+        if any(val.shape[1:] != shape for val in l):
+            return
+        dtype = np.result_type(*self._dtypes[name])
+        if (self._dtype is not None and name not in self._keep_dtype and
+                np.issubdtype(dtype, np.floating)):
+            dtype = self._dtype
+        return np.empty((self._sizes[name],) + shape, dtype=dtype)
+
     def __getitem__(self, name):
         """Concatenate all arrays with a given name."""
         l = self._data[name]
         # Process scalars: only return the first one and don't concatenate.
         if len(l) and not hasattr(l[0], '__len__'):
             return l[0]
-        return np.concatenate(l, axis=0)
+        out = self._buffer(name)
+        if out is None:
+            return np.concatenate(l, axis=0)
+        i = 0
+        for val in l:
+            n = val.shape[0]
+            out[i:i + n] = val
+            i += n
+        assert i == out.shape[0]
+        return out
 
 
-def _accumulate(data_list, no_concat=()):
+def _accumulate(data_list, no_concat=(), dtype=None, keep_dtype=()):
     """Concatenate a list of dicts `(name, array)`.
 
     You can specify some names which arrays should not be concatenated.
     This is necessary with lists of plots with different sizes.
 
+    The floating-point arrays can be converted to `dtype` while they are
+    concatenated, except the ones in `keep_dtype`.
+
     """
-    acc = Accumulator()
+    acc = Accumulator(dtype=dtype, keep_dtype=keep_dtype)
     for data in data_list:
         for name, val in data.items():
             acc.add(name, val)
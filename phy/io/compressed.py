@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""Chunked compressed arrays with random access."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import OrderedDict
+import json
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+from phy.utils._types import _is_integer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+
+#------------------------------------------------------------------------------
+# File format
+#------------------------------------------------------------------------------
+
+# The file is organized as follows:
+#
+#     [ magic | index position (uint64) | chunk 0 | chunk 1 | ... | index ]
+#
+# where the index is:
+#
+#     [ header size (uint64) | JSON header | chunk offsets (uint64) ]
+#
+# Every chunk contains `chunk_size` consecutive rows of the array (along the
+# first axis), and is compressed independently so that reading a slice only
+# decompresses the chunks it touches. With integer data, the rows are
+# delta-encoded along the first axis before compression. This is lossless
+# (integer overflows wrap around in both directions) and it improves the
+# compression ratio of electrophysiological traces significantly.
+
+_MAGIC = b'PHYCBIN1'
+_UINT64 = '<Q'
+_COMPRESSORS = {
+    'zlib': (lambda b, level: zlib.compress(b, level), zlib.decompress),
+}
+if lzma is not None:
+    _COMPRESSORS['lzma'] = (lambda b, level: lzma.compress(b, preset=level),
+                            lzma.decompress)
+_DEFAULT_LEVEL = {'zlib': 6, 'lzma': 1}
+
+
+def _encode_chunk(chunk, method=None, level=None, diff=False):
+    chunk = np.ascontiguousarray(chunk)
+    if diff and len(chunk) >= 2:
+        chunk = chunk.copy()
+        chunk[1:] = np.diff(chunk, axis=0)
+    compress, _ = _COMPRESSORS[method]
+    return compress(chunk.tobytes(), level)
+
+
+def _decode_chunk(buf, dtype=None, shape=None, method=None, diff=False):
+    _, decompress = _COMPRESSORS[method]
+    chunk = np.frombuffer(decompress(buf), dtype=dtype).reshape(shape)
+    if diff:
+        chunk = np.cumsum(chunk, axis=0, dtype=dtype)
+    return chunk
+
+
+def write_compressed_array(path, arr, chunk_size=None, method='zlib',
+                           level=None):
+    """Write an array as a sequence of independently compressed chunks.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to the output file.
+    arr : array-like
+        Array to compress (possibly memory-mapped). The chunks are taken along
+        the first axis.
+    chunk_size : int
+        Number of rows per chunk. By default, chunks are about 1 MB.
+    method : str
+        `zlib` or `lzma`.
+    level : int
+        Compression level.
+
+    """
+    if method not in _COMPRESSORS:
+        raise ValueError("The compression method should be one of "
+                         "{}.".format(', '.join(sorted(_COMPRESSORS))))
+    level = level if level is not None else _DEFAULT_LEVEL[method]
+    shape = tuple(int(s) for s in arr.shape)
+    dtype = np.dtype(arr.dtype)
+    assert len(shape) >= 1
+    row_size = dtype.itemsize * int(np.prod(shape[1:], dtype=np.int64))
+    if chunk_size is None:
+        chunk_size = max(1, (1 << 20) // max(1, row_size))
+    chunk_size = int(chunk_size)
+    assert chunk_size >= 1
+    diff = np.issubdtype(dtype, np.integer)
+    n = shape[0]
+
+    offsets = []
+    with open(path, 'wb') as f:
+        f.write(_MAGIC)
+        # Placeholder for the index position.
+        f.write(struct.pack(_UINT64, 0))
+        for i in range(0, n, chunk_size):
+            offsets.append(f.tell())
+            f.write(_encode_chunk(arr[i:i + chunk_size],
+                                  method=method, level=level, diff=diff))
+        offsets.append(f.tell())
+        index_pos = f.tell()
+        header = dict(shape=shape,
+                      dtype=dtype.str,
+                      chunk_size=chunk_size,
+                      method=method,
+                      diff=bool(diff),
+                      )
+        header = json.dumps(header).encode('utf-8')
+        f.write(struct.pack(_UINT64, len(header)))
+        f.write(header)
+        f.write(np.asarray(offsets, dtype='<u8').tobytes())
+        # Write the index position.
+        f.seek(len(_MAGIC))
+        f.write(struct.pack(_UINT64, index_pos))
+    ratio = (n * row_size) / float(max(1, offsets[-1]))
+    logger.debug("Wrote compressed array `%s` (%d chunks, ratio %.2f).",
+                 path, len(offsets) - 1, ratio)
+
+
+#------------------------------------------------------------------------------
+# Reader
+#------------------------------------------------------------------------------
+
+class CompressedArray(object):
+    """Read-only array stored as independently compressed chunks.
+
+    This object exposes `shape`, `dtype`, `ndim` and `__getitem__()` so that
+    it can be used wherever a memory-mapped array is expected, for example
+    with `ConcatenatedArrays` or `WaveformLoader`. Only the chunks touched
+    by a selection are decompressed. The last few decompressed chunks are
+    kept in memory to speed up consecutive accesses.
+
+    """
+    def __init__(self, path, n_cached_chunks=4):
+        self.path = path
+        self.n_cached_chunks = n_cached_chunks
+        self._chunks = OrderedDict()
+        with open(path, 'rb') as f:
+            magic = f.read(len(_MAGIC))
+            if magic != _MAGIC:
+                raise IOError("The file `{}` is not a ".format(path) +
+                              "compressed array.")
+            index_pos, = struct.unpack(_UINT64, f.read(8))
+            f.seek(index_pos)
+            header_size, = struct.unpack(_UINT64, f.read(8))
+            header = json.loads(f.read(header_size).decode('utf-8'))
+            self.shape = tuple(header['shape'])
+            self.dtype = np.dtype(header['dtype'])
+            self.chunk_size = header['chunk_size']
+            self.method = header['method']
+            self.diff = header['diff']
+            n_chunks = -(-self.shape[0] // self.chunk_size)
+            self.offsets = np.frombuffer(f.read(8 * (n_chunks + 1)),
+                                         dtype='<u8').astype(np.int64)
+        self.ndim = len(self.shape)
+        self.n_chunks = n_chunks
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk_bounds(self, chunk):
+        i = chunk * self.chunk_size
+        return i, min(i + self.chunk_size, self.shape[0])
+
+    def _read_chunk(self, chunk):
+        """Decompress a chunk, or return it from the chunk cache."""
+        out = self._chunks.pop(chunk, None)
+        if out is None:
+            i, j = self._chunk_bounds(chunk)
+            a, b = self.offsets[chunk], self.offsets[chunk + 1]
+            with open(self.path, 'rb') as f:
+                f.seek(a)
+                buf = f.read(b - a)
+            out = _decode_chunk(buf, dtype=self.dtype,
+                                shape=(j - i,) + self.shape[1:],
+                                method=self.method,
+                                diff=self.diff,
+                                )
+        # Keep the most recently used chunks at the end.
+        self._chunks[chunk] = out
+        while len(self._chunks) > self.n_cached_chunks:
+            self._chunks.popitem(last=False)
+        return out
+
+    def _get_range(self, start, stop, rest):
+        """Return rows in `[start, stop)`."""
+        out = None
+        if start >= stop:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)[rest]
+        c0, c1 = start // self.chunk_size, (stop - 1) // self.chunk_size
+        pos = 0
+        for chunk in range(c0, c1 + 1):
+            i, j = self._chunk_bounds(chunk)
+            a, b = max(start, i) - i, min(stop, j) - i
+            part = self._read_chunk(chunk)[a:b][rest]
+            if out is None:
+                out = np.empty((stop - start,) + part.shape[1:],
+                               dtype=self.dtype)
+            out[pos:pos + len(part)] = part
+            pos += len(part)
+        return out
+
+    def _get_indices(self, indices, rest):
+        """Return arbitrary rows."""
+        chunks = indices // self.chunk_size
+        # The indices are grouped by chunk with a single sort, so that
+        # every chunk is decoded once.
+        order = np.argsort(chunks, kind='mergesort')
+        sorted_chunks = chunks[order]
+        unique = np.unique(sorted_chunks)
+        ends = np.searchsorted(sorted_chunks, unique, side='right')
+        out = None
+        for chunk, start, end in zip(unique, np.r_[0, ends[:-1]], ends):
+            idx = order[start:end]
+            i, _ = self._chunk_bounds(chunk)
+            part = self._read_chunk(chunk)[indices[idx] - i][rest]
+            if out is None:
+                out = np.empty((len(indices),) + part.shape[1:],
+                               dtype=self.dtype)
+            out[idx] = part
+        if out is None:
+            out = np.zeros((0,) + self.shape[1:], dtype=self.dtype)[rest]
+        return out
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        rows, rest = item[0], (slice(None, None, None),) + item[1:]
+        n = self.shape[0]
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(n)
+            if step == 1:
+                return self._get_range(start, stop, rest)
+            rows = np.arange(start, stop, step)
+        if _is_integer(rows):
+            row = int(rows)
+            row = row + n if row < 0 else row
+            if not (0 <= row < n):
+                raise IndexError("Index {} is out of bounds.".format(row))
+            return self._get_range(row, row + 1, rest)[0]
+        rows = np.asarray(rows)
+        if rows.dtype == np.bool_:
+            rows = np.nonzero(rows)[0]
+        rows = rows.astype(np.int64)
+        rows = np.where(rows < 0, rows + n, rows)
+        if len(rows) and (rows.min() < 0 or rows.max() >= n):
+            raise IndexError("Some indices are out of bounds.")
+        return self._get_indices(rows, rest)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_chunks'] = OrderedDict()
+        return state
@@ -6,18 +6,27 @@
 # Imports
 #------------------------------------------------------------------------------
 
-from functools import wraps
+from functools import partial, wraps
 import inspect
+from itertools import islice
 import logging
+import multiprocessing
 import os
 import os.path as op
+import shutil
+import tempfile
 
-from six.moves.cPickle import dump, load
+import numpy as np
+from six.moves.cPickle import load
 
 from phy.utils import (_save_json, _load_json,
                        _load_pickle, _save_pickle,
                        _ensure_dir_exists, _fullname,)
 from phy.utils.config import phy_config_dir
+from .memcache import MemoryCache, LogStore, _hash_args
+from .store import (ArrayStore, save_concatenated, load_concatenated,
+                    _is_concatenable,
+                    )
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +35,93 @@ logger = logging.getLogger(__name__)
 # Context
 #------------------------------------------------------------------------------
 
+def _getargspec(f):
+    if hasattr(inspect, 'getfullargspec'):
+        return inspect.getfullargspec(f)
+    return inspect.getargspec(f)  # pragma: no cover
+
+
+def _func_code_hash(f):
+    """Hash of the code of a function, used to invalidate the cache when
+    the function changes."""
+    from joblib import hash
+    from joblib.func_inspect import get_func_code
+    return hash(get_func_code(f)[0])
+
+
+def _memmap_offset(arr):
+    """Return the offset in its file of the data of a memory-mapped array,
+    or None if the array does not map its file directly.
+
+    A view of a memmap (for example a slice) keeps the `offset` of the
+    memmap it comes from, so the offset is computed from the distance
+    between the data pointers of the view and of the original memmap.
+
+    """
+    if not (isinstance(arr, np.memmap) and arr.filename and
+            arr.flags.c_contiguous and arr.mode in ('r', 'r+')):
+        return None
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not isinstance(root, np.memmap) or root.base is not arr._mmap:
+        return None
+    return root.offset + (arr.ctypes.data - root.ctypes.data)
+
+
+class _SharedArray(object):
+    """Reference to an array stored in a file, passed to the worker processes
+    instead of the array itself."""
+    def __init__(self, arr, tmp_dir=None):
+        offset = _memmap_offset(arr)
+        if offset is not None:
+            # Memory-mapped arrays are passed by reference to their file.
+            self.path = arr.filename
+            self.offset = offset
+        else:
+            fd, self.path = tempfile.mkstemp(dir=tmp_dir, suffix='.dat')
+            os.close(fd)
+            self.offset = 0
+            np.ascontiguousarray(arr).tofile(self.path)
+        self.shape = arr.shape
+        self.dtype = arr.dtype.str
+
+    def load(self):
+        if not np.prod(self.shape):
+            return np.zeros(self.shape, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r',
+                         offset=self.offset, shape=self.shape)
+
+
+def _to_shared(obj, tmp_dir=None, min_size=None):
+    """Replace the large arrays in an object by `_SharedArray` instances."""
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        if obj.nbytes >= min_size or isinstance(obj, np.memmap):
+            return _SharedArray(obj, tmp_dir=tmp_dir)
+        return obj
+    elif isinstance(obj, (tuple, list)):
+        return type(obj)(_to_shared(o, tmp_dir, min_size) for o in obj)
+    elif isinstance(obj, dict):
+        return obj.__class__({k: _to_shared(v, tmp_dir, min_size)
+                              for k, v in obj.items()})
+    return obj
+
+
+def _from_shared(obj):
+    if isinstance(obj, _SharedArray):
+        return obj.load()
+    elif isinstance(obj, (tuple, list)):
+        return type(obj)(_from_shared(o) for o in obj)
+    elif isinstance(obj, dict):
+        return obj.__class__({k: _from_shared(v) for k, v in obj.items()})
+    return obj
+
+
+def _call_shared(f, item):
+    """Function executed in the worker processes."""
+    return f(_from_shared(item))
+
+
 def _cache_methods(obj, memcached, cached):  # pragma: no cover
     for name in memcached:
         f = getattr(obj, name)
@@ -37,8 +133,28 @@ def _cache_methods(obj, memcached, cached):  # pragma: no cover
 
 
 class Context(object):
-    """Handle function cacheing and parallel map with ipyparallel."""
-    def __init__(self, cache_dir, ipy_view=None, verbose=0):
+    """Handle function cacheing and parallel map.
+
+    Parameters
+    ----------
+
+    cache_dir : str
+        The cache directory.
+    ipy_view : ipyparallel view
+        Optional view for parallel processing.
+    verbose : int
+        Verbosity of the disk cache.
+    memcache_size : int
+        Maximum total size of the memory caches, in bytes. When the budget
+        is exceeded, the least recently used entries are evicted. By
+        default, the memory caches are unbounded.
+    memcache_spill : bool
+        Whether evicted entries are appended to the memcache files on disk,
+        so that they can be loaded again instead of being recomputed.
+
+    """
+    def __init__(self, cache_dir, ipy_view=None, verbose=0,
+                 memcache_size=None, memcache_spill=True):
         self.verbose = verbose
         # Make sure the cache directory exists.
         self.cache_dir = op.realpath(op.expanduser(cache_dir))
@@ -51,60 +167,121 @@ class Context(object):
         if not op.exists(path):
             os.mkdir(path)
 
-        self._set_memory(self.cache_dir)
+        self._store = ArrayStore(op.join(self.cache_dir, 'arrays'))
         self.ipy_view = ipy_view if ipy_view else None
+        self.memcache_size = memcache_size
+        self.memcache_spill = memcache_spill
         self._memcache = {}
 
-    def _set_memory(self, cache_dir):
-        # Try importing joblib.
+    def cache(self, f):
+        """Cache a function using the context's cache directory.
+
+        Arrays, and dicts or Bunches of arrays, are stored as raw `.npy`
+        files and are returned memory-mapped on subsequent calls. Other
+        results are pickled with joblib.
+
+        """
+        # NOTE: joblib hashes the arguments and the code of the function,
+        # and pickles the results that are not arrays.
         try:
-            from joblib import Memory
-            self._memory = Memory(cachedir=self.cache_dir,
-                                  mmap_mode=None,
-                                  verbose=self.verbose,
-                                  )
-            logger.debug("Initialize joblib cache dir at `%s`.",
-                         self.cache_dir)
+            from joblib import hash
         except ImportError:  # pragma: no cover
             logger.warn("Joblib is not installed. "
                         "Install it with `conda install joblib`.")
-            self._memory = None
-
-    def cache(self, f):
-        """Cache a function using the context's cache directory."""
-        if self._memory is None:  # pragma: no cover
-            logger.debug("Joblib is not installed: skipping cacheing.")
             return f
         assert f
+        name = _fullname(f)
         # NOTE: discard self in instance methods.
-        if 'self' in inspect.getargspec(f).args:
-            ignore = ['self']
-        else:
-            ignore = None
-        disk_cached = self._memory.cache(f, ignore=ignore)
+        args = _getargspec(f).args
+        ignore_self = (not inspect.ismethod(f) and
+                       len(args) >= 1 and args[0] == 'self')
+        code_hash = _func_code_hash(f)
+
+        def _key(args, kwargs):
+            key_args = args[1:] if ignore_self else args
+            return hash((code_hash, key_args, kwargs))
+
+        @wraps(f)
+        def disk_cached(*args, **kwargs):
+            """Cache the function on disk."""
+            key = _key(args, kwargs)
+            if (name, key) in self._store:
+                try:
+                    out = self._store.load(name, key)
+                    logger.debug("Load cached result of `%s`.", name)
+                    return out
+                except (IOError, OSError, ValueError, EOFError) as e:
+                    # NOTE: the entry may be removed by a concurrent write.
+                    logger.debug("Unable to load the cached result of "
+                                 "`%s`: %s.", name, str(e))
+            out = f(*args, **kwargs)
+            self._store.save(name, key, out)
+            return out
+
+        def is_cached(*args, **kwargs):
+            """Return whether a call is in the cache."""
+            return (name, _key(args, kwargs)) in self._store
+
+        disk_cached.is_cached = is_cached
         return disk_cached
 
     def load_memcache(self, name):
-        # Load the memcache from disk, if it exists.
-        path = op.join(self.cache_dir, 'memcache', name + '.pkl')
-        if op.exists(path):
-            logger.debug("Load memcache for `%s`.", name)
-            with open(path, 'rb') as fd:
-                cache = load(fd)
-        else:
-            cache = {}
+        """Open the memcache of a function. The entries saved on disk are
+        only loaded when they are requested."""
+        path = op.join(self.cache_dir, 'memcache', name)
+        store = LogStore(path)
+        # Import a memcache saved by a previous version.
+        if op.exists(path + '.pkl'):
+            logger.debug("Import memcache for `%s`.", name)
+            with open(path + '.pkl', 'rb') as fd:
+                for key, value in load(fd).items():
+                    store.append(key, value)
+            store.save_index()
+            os.remove(path + '.pkl')
+        cache = MemoryCache(name, store=store)
         self._memcache[name] = cache
         return cache
 
     def save_memcache(self):
+        """Append the new memcache entries to the memcache files."""
         for name, cache in self._memcache.items():
-            path = op.join(self.cache_dir, 'memcache', name + '.pkl')
             logger.debug("Save memcache for `%s`.", name)
-            with open(path, 'wb') as fd:
-                dump(cache, fd)
+            cache.flush()
+
+    # Memcache eviction
+    # -------------------------------------------------------------------------
 
-    def memcache(self, f):
-        """Cache a function in memory using an internal dictionary."""
+    def _enforce_memcache_size(self):
+        """Evict the least recently used entries across all memory caches
+        until the total size is within the budget."""
+        if self.memcache_size is None:
+            return
+        caches = list(self._memcache.values())
+        total = sum(cache.nbytes for cache in caches)
+        while total > self.memcache_size:
+            nonempty = [cache for cache in caches if len(cache)]
+            if not nonempty:
+                break
+            cache = min(nonempty, key=lambda cache: cache.oldest)
+            size = cache.nbytes
+            key, value = cache.popitem(persist=self.memcache_spill)
+            total -= size - cache.nbytes
+            logger.debug("Evict `%s%s` from the memcache.", cache.name, key)
+
+    def memcache_stats(self):
+        """Return the hits, misses, evictions, number of items, and size
+        of every memory cache."""
+        return {name: cache.stats for name, cache in self._memcache.items()}
+
+    def memcache(self, f=None, hash_arrays=False):
+        """Cache a function in memory using an internal dictionary.
+
+        With `hash_arrays=True`, NumPy array arguments are replaced by a hash
+        of their contents in the cache keys.
+
+        """
+        if f is None:
+            return lambda f: self.memcache(f, hash_arrays=hash_arrays)
         name = _fullname(f)
         cache = self.load_memcache(name)
 
@@ -112,14 +289,189 @@ class Context(object):
         def memcached(*args):
             """Cache the function in memory."""
             # The arguments need to be hashable. Much faster than using hash().
-            h = args
+            h = _hash_args(args) if hash_arrays else args
             out = cache.get(h, None)
             if out is None:
                 out = f(*args)
                 cache[h] = out
+            self._enforce_memcache_size()
             return out
+
+        def is_cached(*args):
+            """Return whether a call is in the memory cache or in the
+            memcache files."""
+            h = _hash_args(args) if hash_arrays else args
+            return h in cache or h in cache.store
+
+        def set_cached(out, *args, **kwargs):
+            """Put the result of a call in the memory cache.
+
+            With `persist=True`, the entry is also appended to the memcache
+            file right away.
+
+            """
+            h = _hash_args(args) if hash_arrays else args
+            cache[h] = out
+            if kwargs.get('persist', False):
+                cache.persist(h)
+            self._enforce_memcache_size()
+
+        # NOTE: the original function can be evaluated elsewhere (for example
+        # in another process) and its result put in the memory cache.
+        memcached.function = f
+        memcached.is_cached = is_cached
+        memcached.set_cached = set_cached
         return memcached
 
+    # Parallel map
+    # -------------------------------------------------------------------------
+
+    def map(self, f, iterable, n_jobs=None, chunk_size=None,
+            progress_reporter=None, shared_min_size=1 << 20):
+        """Apply a function to all items of an iterable, in parallel, and
+        return the list of results in order.
+
+        Parameters
+        ----------
+
+        f : function
+            A picklable function accepting a single argument.
+        iterable : iterable
+            The items to process.
+        n_jobs : int
+            Number of local processes. By default, the number of cores. With
+            `n_jobs=1`, the items are processed in the current process.
+            When the context has an `ipy_view`, it is used instead.
+        chunk_size : int
+            Number of items sent at once to a process. By default, every
+            process receives about four chunks.
+        progress_reporter : ProgressReporter
+            If specified, it is incremented after every processed item.
+        shared_min_size : int
+            NumPy arrays larger than this size (in bytes), and memory-mapped
+            arrays, within the items are not pickled: they are passed to
+            the processes through memory-mapped files.
+
+        """
+        items = list(iterable)
+        n = len(items)
+        if progress_reporter is not None:
+            progress_reporter.value_max = max(progress_reporter.value_max,
+                                              progress_reporter.value + n)
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        n_jobs = max(1, min(n_jobs, n))
+
+        if self.ipy_view is not None:  # pragma: no cover
+            out = self.ipy_view.map_sync(f, items)
+            if progress_reporter is not None:
+                progress_reporter.value += n
+            return out
+
+        if n_jobs == 1:
+            results = (f(item) for item in items)
+            return self._collect(results, progress_reporter)
+
+        if chunk_size is None:
+            chunk_size = max(1, n // (4 * n_jobs))
+        logger.debug("Run `%s` on %d items with %d processes.",
+                     _fullname(f), n, n_jobs)
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = self._pool_imap(pool, f, items, chunk_size,
+                                      shared_min_size)
+            return self._collect(results, progress_reporter)
+        finally:
+            pool.terminate()
+
+    def imap(self, f, iterable, n_jobs=None, batch_size=None,
+             initializer=None, initargs=(), shared_min_size=1 << 20):
+        """Apply a function to all items of an iterable, in parallel, and
+        yield the results in order.
+
+        Unlike `map()`, the items are read lazily, by batches of
+        `batch_size` items, and a single pool of processes is used for all
+        batches. The pool is terminated when the iterator is exhausted or
+        closed.
+
+        Parameters
+        ----------
+
+        f : function
+            A picklable function accepting a single argument.
+        iterable : iterable
+            The items to process.
+        n_jobs : int
+            Number of local processes. By default, the number of cores. With
+            `n_jobs=1`, the items are processed in the current process.
+            When the context has an `ipy_view`, it is used instead.
+        batch_size : int
+            Number of items sent at once to the processes. By default, four
+            items per process.
+        initializer : function
+            If specified, `initializer(*initargs)` is called once in every
+            process, or in the current process with `n_jobs=1`.
+        shared_min_size : int
+            See `map()`.
+
+        """
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        batch_size = batch_size or 4 * n_jobs
+        iterable = iter(iterable)
+
+        def _batches():
+            while True:
+                batch = list(islice(iterable, batch_size))
+                if not batch:
+                    return
+                yield batch
+
+        if self.ipy_view is not None:  # pragma: no cover
+            for batch in _batches():
+                for out in self.ipy_view.map_sync(f, batch):
+                    yield out
+            return
+
+        if n_jobs == 1:
+            if initializer is not None:
+                initializer(*initargs)
+            for item in iterable:
+                yield f(item)
+            return
+
+        logger.debug("Run `%s` with %d processes.", _fullname(f), n_jobs)
+        pool = multiprocessing.Pool(n_jobs, initializer, initargs)
+        try:
+            for batch in _batches():
+                for out in self._pool_imap(pool, f, batch, 1,
+                                           shared_min_size):
+                    yield out
+        finally:
+            pool.terminate()
+
+    def _pool_imap(self, pool, f, items, chunk_size, shared_min_size):
+        """Process a list of items in a pool, passing the large arrays
+        through temporary files."""
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.map-')
+        try:
+            items = [_to_shared(item, tmp_dir=tmp_dir,
+                                min_size=shared_min_size)
+                     for item in items]
+            for out in pool.imap(partial(_call_shared, f), items,
+                                 chunksize=chunk_size):
+                yield out
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _collect(self, results, progress_reporter=None):
+        out = []
+        for result in results:
+            out.append(result)
+            if progress_reporter is not None:
+                progress_reporter.increment()
+        return out
+
     def _get_path(self, name, location, file_ext='.json'):
         if location == 'local':
             return op.join(self.cache_dir, name + file_ext)
@@ -127,35 +479,57 @@ class Context(object):
             return op.join(phy_config_dir(), name + file_ext)
 
     def save(self, name, data, location='local', kind='json'):
-        """Save a dictionary in a JSON file within the cache directory."""
-        file_ext = '.json' if kind == 'json' else '.pkl'
+        """Save data within the cache directory.
+
+        Parameters
+        ----------
+
+        name : str
+            Name of the file, without extension.
+        data : object
+            The data to save.
+        location : str
+            `local` (cache directory) or `global` (phy config directory).
+        kind : str
+            `json`, `pickle`, or `arrays`. The latter stores a
+            SpikesPerCluster instance or a dict `{int: array}` as a single
+            concatenated array with a table of keys and offsets, which is
+            memory-mapped when loaded. Other data is pickled.
+
+        """
+        if kind == 'arrays' and not _is_concatenable(data):
+            logger.debug("Unable to save `%s` as concatenated arrays, "
+                         "pickle it instead.", name)
+            kind = 'pickle'
+        file_ext = {'json': '.json', 'arrays': '.arrays'}.get(kind, '.pkl')
         path = self._get_path(name, location, file_ext=file_ext)
         _ensure_dir_exists(op.dirname(path))
         logger.debug("Save data to `%s`.", path)
         if kind == 'json':
             _save_json(path, data)
+        elif kind == 'arrays':
+            save_concatenated(path, data)
         else:
             _save_pickle(path, data)
+        # Remove a previous version saved in the other binary format.
+        if kind != 'json':
+            other = '.pkl' if kind == 'arrays' else '.arrays'
+            other = self._get_path(name, location, file_ext=other)
+            if op.isdir(other):
+                shutil.rmtree(other)
+            elif op.exists(other):
+                os.remove(other)
 
     def load(self, name, location='local'):
         """Load saved data from the cache directory."""
         path = self._get_path(name, location, file_ext='.json')
         if op.exists(path):
             return _load_json(path)
+        path = self._get_path(name, location, file_ext='.arrays')
+        if op.isdir(path):
+            return load_concatenated(path)
         path = self._get_path(name, location, file_ext='.pkl')
         if op.exists(path):
             return _load_pickle(path)
         logger.debug("The file `%s` doesn't exist.", path)
         return {}
-
-    def __getstate__(self):
-        """Make sure that this class is picklable."""
-        state = self.__dict__.copy()
-        state['_memory'] = None
-        return state
-
-    def __setstate__(self, state):
-        """Make sure that this class is picklable."""
-        self.__dict__ = state
-        # Recreate the joblib Memory instance.
-        self._set_memory(state['cache_dir'])
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+
+"""Bounded in-memory cache with byte accounting."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import OrderedDict
+import hashlib
+from itertools import count
+import logging
+import os
+import os.path as op
+import struct
+import sys
+from threading import Lock, Thread
+
+import numpy as np
+from six.moves.cPickle import dumps, loads, dump, load, HIGHEST_PROTOCOL
+
+logger = logging.getLogger(__name__)
+
+# Global access counter, so that the entries of several caches can be
+# compared when evicting the least recently used ones.
+_clock = count()
+
+
+#------------------------------------------------------------------------------
+# Utility functions
+#------------------------------------------------------------------------------
+
+def _nbytes(obj):
+    """Estimate the memory used by an object, in bytes.
+
+    NumPy arrays (possibly within dictionaries, Bunches, lists, or tuples)
+    are counted with their buffer size. Memory-mapped arrays are not counted
+    since their pages can be reclaimed by the system.
+
+    """
+    if isinstance(obj, np.memmap):
+        return sys.getsizeof(obj)
+    elif isinstance(obj, np.ndarray):
+        # NOTE: the size of the buffer is included by sys.getsizeof()
+        # only if the array owns its data.
+        if obj.flags.owndata:
+            return sys.getsizeof(obj)
+        return obj.nbytes + sys.getsizeof(obj)
+    elif isinstance(obj, dict):
+        return (sys.getsizeof(obj) +
+                sum(_nbytes(k) + _nbytes(v) for k, v in obj.items()))
+    elif isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class _ArrayKey(tuple):
+    """Hashable key representing the contents of a NumPy array."""
+    def __new__(cls, arr):
+        arr = np.ascontiguousarray(arr)
+        digest = hashlib.sha1(arr.view(np.uint8)).hexdigest()
+        return super(_ArrayKey, cls).__new__(cls, (arr.dtype.str,
+                                                   arr.shape,
+                                                   digest))
+
+
+def _hash_args(args):
+    """Replace the array arguments by a hash of their contents."""
+    return tuple(_ArrayKey(arg) if isinstance(arg, np.ndarray) else arg
+                 for arg in args)
+
+
+#------------------------------------------------------------------------------
+# Log-structured store
+#------------------------------------------------------------------------------
+
+# Every record of the log file is:
+#
+#     [ key size (uint32) | value size (uint64) | key pickle | value pickle ]
+#
+# Records are only appended. The index maps every key to the offset of its
+# last record, and it is saved in a separate file with the size of the log
+# at that time. Records appended after the last index save (for example
+# before a crash) are recovered by scanning the end of the log.
+
+_RECORD_HEADER = '<IQ'
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:  # pragma: no cover
+        if op.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class LogStore(object):
+    """Append-only key-value store on disk.
+
+    Values are loaded lazily, one at a time. Overwritten entries leave
+    garbage in the log, which is removed by `compact()`, possibly in a
+    background thread.
+
+    Parameters
+    ----------
+
+    path : str
+        Path of the log file, without extension.
+
+    """
+    def __init__(self, path):
+        self.log_path = path + '.log'
+        self.index_path = path + '.idx'
+        self._lock = Lock()
+        self._index = {}  # key: (offset, key_size, value_size)
+        self._size = 0
+        self._thread = None
+        self._open()
+
+    def _open(self):
+        if not op.exists(self.log_path):
+            open(self.log_path, 'wb').close()
+        file_size = op.getsize(self.log_path)
+        start = 0
+        if op.exists(self.index_path):
+            try:
+                with open(self.index_path, 'rb') as f:
+                    saved = load(f)
+                if saved['size'] <= file_size:
+                    self._index, start = saved['index'], saved['size']
+            except Exception as e:  # pragma: no cover
+                logger.debug("Unable to load the index `%s`: %s.",
+                             self.index_path, str(e))
+        self._size = self._scan(start, file_size)
+
+    def _scan(self, start, file_size):
+        """Index the records in the log from a given offset, and return
+        the offset of the end of the last complete record."""
+        offset = start
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            while offset + _RECORD_HEADER_SIZE <= file_size:
+                ks, vs = struct.unpack(_RECORD_HEADER,
+                                       f.read(_RECORD_HEADER_SIZE))
+                end = offset + _RECORD_HEADER_SIZE + ks + vs
+                if end > file_size:
+                    break
+                key = loads(f.read(ks))
+                self._index[key] = (offset, ks, vs)
+                f.seek(vs, 1)
+                offset = end
+        if offset < file_size:
+            logger.debug("Discard an incomplete record in `%s`.",
+                         self.log_path)
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(offset)
+        return offset
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return list(self._index.keys())
+
+    @property
+    def size(self):
+        """Size of the log, in bytes."""
+        return self._size
+
+    @property
+    def live_size(self):
+        """Size of the records that have not been overwritten, in bytes."""
+        return sum(_RECORD_HEADER_SIZE + ks + vs
+                   for _, ks, vs in self._index.values())
+
+    def append(self, key, value):
+        """Append an entry to the log."""
+        kb = dumps(key, HIGHEST_PROTOCOL)
+        vb = dumps(value, HIGHEST_PROTOCOL)
+        with self._lock:
+            with open(self.log_path, 'ab') as f:
+                f.write(struct.pack(_RECORD_HEADER, len(kb), len(vb)))
+                f.write(kb)
+                f.write(vb)
+            self._index[key] = (self._size, len(kb), len(vb))
+            self._size += _RECORD_HEADER_SIZE + len(kb) + len(vb)
+
+    def load(self, key):
+        """Load an entry from the log."""
+        with self._lock:
+            offset, ks, vs = self._index[key]
+            with open(self.log_path, 'rb') as f:
+                f.seek(offset + _RECORD_HEADER_SIZE + ks)
+                buf = f.read(vs)
+        return loads(buf)
+
+    def save_index(self):
+        with self._lock:
+            with open(self.index_path, 'wb') as f:
+                dump(dict(size=self._size, index=self._index), f,
+                     HIGHEST_PROTOCOL)
+
+    def compact(self):
+        """Rewrite the log with the live records only."""
+        with self._lock:
+            index = dict(self._index)
+            end = self._size
+        tmp = self.log_path + '.compact'
+        new_index = {}
+        records = sorted(index.items(), key=lambda item: item[1][0])
+        with open(self.log_path, 'rb') as src, open(tmp, 'wb') as dst:
+            for key, (offset, ks, vs) in records:
+                src.seek(offset)
+                new_index[key] = (dst.tell(), ks, vs)
+                dst.write(src.read(_RECORD_HEADER_SIZE + ks + vs))
+            with self._lock:
+                # Copy the records appended during the compaction.
+                base = dst.tell()
+                src.seek(end)
+                dst.write(src.read(self._size - end))
+                for key, (offset, ks, vs) in self._index.items():
+                    if offset >= end:
+                        new_index[key] = (offset - end + base, ks, vs)
+                dst.close()
+                _replace(tmp, self.log_path)
+                self._size = op.getsize(self.log_path)
+                self._index = new_index
+        self.save_index()
+        logger.debug("Compacted `%s` from %d to %d bytes.",
+                     self.log_path, end, self._size)
+
+    def maybe_compact(self, min_garbage=.5, min_size=1 << 20,
+                      background=True):
+        """Compact the log in a background thread if the overwritten records
+        represent a large fraction of it."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._size < min_size:
+            return
+        if self._size - self.live_size < min_garbage * self._size:
+            return
+        if not background:
+            return self.compact()
+        self._thread = Thread(target=self.compact)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self):
+        """Wait for the background compaction to finish."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+#------------------------------------------------------------------------------
+# Memory cache
+#------------------------------------------------------------------------------
+
+class MemoryCache(object):
+    """In-memory cache of the results of a function, in LRU order.
+
+    The cache keeps track of the estimated size of its entries, and of the
+    number of hits, misses, loads from disk, and evictions. The byte budget
+    is enforced by the owner of the cache (see `Context`), which can compare
+    the last access of the least recently used entries of several caches.
+
+    When a `LogStore` is specified, the entries that are not in memory are
+    loaded lazily from it, and the new entries are appended to it by
+    `flush()` or when they are evicted.
+
+    """
+    def __init__(self, name=None, data=None, store=None):
+        self.name = name
+        self.store = store
+        self._data = OrderedDict()
+        self._dirty = set()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        for key, value in (data or {}).items():
+            self[key] = value
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def items(self):
+        return [(key, value) for key, (_, _, value) in self._data.items()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def _touch(self, key):
+        """Mark an entry as the most recently used."""
+        entry = self._data.pop(key)
+        self._data[key] = (next(_clock),) + entry[1:]
+        return entry[2]
+
+    def get(self, key, default=None, record=True):
+        """Return an entry, or `default` if it is not in the cache.
+
+        Hits and misses are recorded unless `record` is False.
+
+        """
+        if key not in self._data:
+            if self.store is not None and key in self.store:
+                value = self.store.load(key)
+                self._insert(key, value)
+                if record:
+                    self.loads += 1
+                return value
+            if record:
+                self.misses += 1
+            return default
+        if record:
+            self.hits += 1
+        return self._touch(key)
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        return self._touch(key)
+
+    def _insert(self, key, value):
+        self.pop(key, None)
+        size = _nbytes(value)
+        self._data[key] = (next(_clock), size, value)
+        self.nbytes += size
+
+    def __setitem__(self, key, value):
+        self._insert(key, value)
+        self._dirty.add(key)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        self._dirty.discard(key)
+        if entry is None:
+            return default
+        self.nbytes -= entry[1]
+        return entry[2]
+
+    def clear(self):
+        self._data.clear()
+        self._dirty.clear()
+        self.nbytes = 0
+
+    def _persist(self, key, value):
+        try:
+            self.store.append(key, value)
+        except Exception as e:  # pragma: no cover
+            logger.debug("Unable to save `%s%s`: %s.", self.name, key, str(e))
+
+    def persist(self, key):
+        """Append a new entry to the store now, rather than at the next
+        `flush()`."""
+        if self.store is None or key not in self._dirty:
+            return
+        self._persist(key, self._data[key][2])
+        self._dirty.discard(key)
+
+    def flush(self):
+        """Append the new entries to the store."""
+        if self.store is None:
+            return
+        for key in list(self._dirty):
+            self._persist(key, self._data[key][2])
+        self._dirty.clear()
+        self.store.save_index()
+        self.store.maybe_compact()
+
+    @property
+    def oldest(self):
+        """Last access time of the least recently used entry, or None."""
+        for clock, _, _ in self._data.values():
+            return clock
+
+    def popitem(self, persist=True):
+        """Evict the least recently used entry and return `(key, value)`.
+
+        If `persist` is True, a new entry is first appended to the store so
+        that it can be loaded again later.
+
+        """
+        key, (_, size, value) = self._data.popitem(last=False)
+        if key in self._dirty:
+            self._dirty.discard(key)
+            if persist and self.store is not None:
+                self._persist(key, value)
+        self.nbytes -= size
+        self.evictions += 1
+        return key, value
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    loads=self.loads,
+                    evictions=self.evictions,
+                    n_items=len(self),
+                    nbytes=self.nbytes,
+                    )
+
+    def __repr__(self):
+        return '<MemoryCache {} ({} items, {} bytes)>'.format(
+            self.name, len(self), self.nbytes)
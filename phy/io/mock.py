@@ -9,6 +9,9 @@
 import numpy as np
 import numpy.random as nr
 
+from phy.utils import Bunch, EventEmitter
+from .array import _spikes_per_cluster, _unique
+
 
 #------------------------------------------------------------------------------
 # Artificial data
@@ -44,3 +47,90 @@ def artificial_spike_samples(n_spikes, max_isi=50):
 
 def artificial_correlograms(n_clusters, n_samples):
     return nr.uniform(size=(n_clusters, n_clusters, n_samples))
+
+
+#------------------------------------------------------------------------------
+# Mock clustering
+#------------------------------------------------------------------------------
+
+class MockClustering(EventEmitter):
+    """Minimal `Clustering` emitting `cluster` events, to test the objects
+    that are attached to a clustering without importing `phy.cluster`.
+
+    With `spike_clusters`, the clusters are changed with `assign()`,
+    `merge()`, and `undo()`. With `cluster_ids` only, they are changed with
+    `change()`.
+
+    """
+    def __init__(self, spike_clusters=None, cluster_ids=None):
+        super(MockClustering, self).__init__()
+        self._history = []
+        self._new_id = 0
+        self.spike_clusters = None
+        self.spikes_per_cluster = None
+        if spike_clusters is not None:
+            self._set(np.asarray(spike_clusters, dtype=np.int64))
+        else:
+            self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+
+    def _set(self, spike_clusters):
+        # NOTE: like `Clustering`, new objects are created after every
+        # change.
+        self.spike_clusters = spike_clusters
+        self.spikes_per_cluster = _spikes_per_cluster(spike_clusters)
+        self.cluster_ids = _unique(spike_clusters)
+        if len(spike_clusters):
+            self._new_id = max(self._new_id, spike_clusters.max() + 1)
+
+    def change(self, added=(), deleted=(), descendants=None):
+        """Add and delete some clusters."""
+        cluster_ids = np.setdiff1d(self.cluster_ids, deleted)
+        self.cluster_ids = np.union1d(cluster_ids, added).astype(np.int64)
+        up = Bunch(added=list(added), deleted=list(deleted),
+                   descendants=descendants or [])
+        self.emit('cluster', up)
+        return up
+
+    def _assign(self, spike_clusters):
+        old, new = self.spike_clusters, spike_clusters
+        old_ids = self.cluster_ids
+        # The descendants of all clusters with changed spikes.
+        changed = np.in1d(old, old[old != new])
+        descendants = sorted(set(zip(old[changed].tolist(),
+                                     new[changed].tolist())))
+        self._set(new)
+        up = Bunch(added=np.setdiff1d(self.cluster_ids, old_ids).tolist(),
+                   deleted=np.setdiff1d(old_ids, self.cluster_ids).tolist(),
+                   descendants=descendants)
+        self.emit('cluster', up)
+        return up
+
+    def assign(self, spike_ids, cluster_ids):
+        """Move some spikes to new clusters.
+
+        Like `Clustering.assign()`, the other spikes of the modified
+        clusters are moved to new clusters, so that ids are never reused.
+
+        """
+        old = self.spike_clusters
+        self._history.append(old)
+        spike_clusters = old.copy()
+        spike_clusters[spike_ids] = cluster_ids
+        assigned = np.zeros(len(old), dtype=np.bool_)
+        assigned[spike_ids] = True
+        self._new_id = max(self._new_id, spike_clusters.max() + 1)
+        for cluster in _unique(old[assigned]):
+            rest = (old == cluster) & ~assigned
+            if rest.any():
+                spike_clusters[rest] = self._new_id
+                self._new_id += 1
+        return self._assign(spike_clusters)
+
+    def merge(self, cluster_ids, to=None):
+        """Merge some clusters into a new cluster."""
+        to = self._new_id if to is None else to
+        return self.assign(np.in1d(self.spike_clusters, cluster_ids), to)
+
+    def undo(self):
+        """Undo the last assignment."""
+        return self._assign(self._history.pop())
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""Index of spike times per cluster."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+
+from phy.utils._types import Bunch
+from .array import _spikes_per_cluster, _ClusteringListener
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Spike time index
+#------------------------------------------------------------------------------
+
+class SpikeTimeIndex(_ClusteringListener):
+    """Answer time queries on the spikes of any set of clusters.
+
+    The spike times of every cluster are sorted since the spike ids within a
+    cluster are sorted. They are extracted lazily and cached, so that
+    finding the spikes of some clusters in a time interval is a binary search
+    per cluster, in `O(log n + k)`.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        The increasing spike times, in seconds.
+    spike_clusters : array-like
+        The spike-cluster assignment. Only used if `spikes_per_cluster` is
+        not specified.
+    spikes_per_cluster : dict-like
+        The spikes of every cluster. The index keeps a reference to that
+        object and follows its changes via `on_cluster()`, or `attach()`.
+    recording_offsets : array-like
+        The offsets of the recordings in the concatenated data, in samples,
+        for example `ConcatenatedArrays.offsets`.
+    sample_rate : float
+        The sample rate, used to convert the recording offsets in seconds.
+
+    """
+    def __init__(self, spike_times, spike_clusters=None,
+                 spikes_per_cluster=None, recording_offsets=None,
+                 sample_rate=None):
+        self.spike_times = np.asarray(spike_times, dtype=np.float64)
+        assert self.spike_times.ndim == 1
+        if spikes_per_cluster is None:
+            spikes_per_cluster = _spikes_per_cluster(spike_clusters)
+        self.spikes_per_cluster = spikes_per_cluster
+        self._cluster_times = {}
+        if recording_offsets is None:
+            recording_offsets = [0, np.inf]
+            sample_rate = 1.
+        offsets = np.asarray(recording_offsets, dtype=np.float64)
+        self.recording_bounds = offsets / float(sample_rate or 1.)
+
+    # Recordings
+    # -------------------------------------------------------------------------
+
+    @property
+    def n_recordings(self):
+        return len(self.recording_bounds) - 1
+
+    def recording_interval(self, recording):
+        """Return the `(start, end)` interval of a recording, in seconds."""
+        b = self.recording_bounds
+        return b[recording], b[recording + 1]
+
+    def spike_recordings(self, spike_ids=None):
+        """Return the recording of every spike."""
+        times = (self.spike_times if spike_ids is None
+                 else self.spike_times[spike_ids])
+        out = np.searchsorted(self.recording_bounds, times, side='right') - 1
+        return np.clip(out, 0, self.n_recordings - 1)
+
+    def _clip_interval(self, interval, recording=None):
+        t0, t1 = interval
+        if recording is not None:
+            r0, r1 = self.recording_interval(recording)
+            t0, t1 = max(t0, r0), min(t1, r1)
+        return t0, max(t0, t1)
+
+    # Per-cluster times
+    # -------------------------------------------------------------------------
+
+    def cluster_times(self, cluster):
+        """Return the sorted spike times of a cluster."""
+        times = self._cluster_times.get(cluster, None)
+        if times is None:
+            spikes = self.spikes_per_cluster[cluster]
+            times = self.spike_times[spikes]
+            self._cluster_times[cluster] = times
+        return times
+
+    def on_cluster(self, up):
+        """Forget the times of the deleted clusters after a clustering
+        change. The times of the new clusters are computed on demand."""
+        for cluster in up.deleted:
+            self._cluster_times.pop(cluster, None)
+
+    # Queries
+    # -------------------------------------------------------------------------
+
+    def _spikes_in_interval(self, interval, cluster_ids=None,
+                            recording=None):
+        """Return the sorted spikes in an interval, and their clusters."""
+        t0, t1 = self._clip_interval(interval, recording=recording)
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        if not len(cluster_ids):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        # One binary search per cluster, and only the matching spikes are
+        # copied.
+        out = []
+        counts = np.zeros(len(cluster_ids), dtype=np.int64)
+        for i, c in enumerate(cluster_ids):
+            a, b = np.searchsorted(self.cluster_times(c), [t0, t1])
+            out.append(self.spikes_per_cluster[c][a:b])
+            counts[i] = b - a
+        out = np.concatenate(out).astype(np.int64)
+        clusters = np.repeat(cluster_ids, counts)
+        order = np.argsort(out, kind='mergesort')
+        return out[order], clusters[order]
+
+    def spikes_in_interval(self, interval, cluster_ids=None, recording=None):
+        """Return the sorted ids of the spikes in `[t0, t1)`.
+
+        Parameters
+        ----------
+
+        interval : tuple
+            The `(t0, t1)` interval, in seconds.
+        cluster_ids : array-like
+            If specified, only return the spikes of these clusters.
+        recording : int
+            If specified, restrict the interval to that recording.
+
+        """
+        if cluster_ids is None:
+            t0, t1 = self._clip_interval(interval, recording=recording)
+            a, b = np.searchsorted(self.spike_times, [t0, t1])
+            return np.arange(a, b)
+        return self._spikes_in_interval(interval, cluster_ids=cluster_ids,
+                                        recording=recording)[0]
+
+    def next_spike(self, cluster, time, recording=None):
+        """Return the id of the first spike of a cluster strictly after a
+        given time, or None."""
+        times = self.cluster_times(cluster)
+        i = np.searchsorted(times, time, side='right')
+        if i >= len(times):
+            return None
+        if (recording is not None and
+                times[i] >= self.recording_interval(recording)[1]):
+            return None
+        return int(self.spikes_per_cluster[cluster][i])
+
+    def previous_spike(self, cluster, time, recording=None):
+        """Return the id of the last spike of a cluster strictly before a
+        given time, or None."""
+        times = self.cluster_times(cluster)
+        i = np.searchsorted(times, time, side='left') - 1
+        if i < 0:
+            return None
+        if (recording is not None and
+                times[i] < self.recording_interval(recording)[0]):
+            return None
+        return int(self.spikes_per_cluster[cluster][i])
+
+    def spike_train(self, cluster_ids, interval=None, recording=None):
+        """Return the spikes of some clusters, sorted by time, possibly in a
+        time interval.
+
+        The returned Bunch contains `spike_ids`, `spike_times`,
+        `spike_clusters`, and `spike_recordings`. It can be passed directly
+        to `correlograms()` to compute windowed cross-correlograms without
+        scanning all spikes. Pairs of spikes in different recordings can be
+        excluded by computing the correlograms recording by recording.
+
+        """
+        if interval is None:
+            interval = (-np.inf, np.inf)
+        spike_ids, clusters = self._spikes_in_interval(interval,
+                                                       cluster_ids=cluster_ids,
+                                                       recording=recording)
+        return Bunch(spike_ids=spike_ids,
+                     spike_times=self.spike_times[spike_ids],
+                     spike_clusters=clusters,
+                     spike_recordings=self.spike_recordings(spike_ids),
+                     )
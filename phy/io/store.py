@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""Array-native storage of cached results."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import tempfile
+
+import numpy as np
+from six import string_types
+
+from phy.utils import Bunch, _load_pickle, _save_pickle
+from .array import SpikesPerCluster
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Array files
+#------------------------------------------------------------------------------
+
+# A stored object is a directory with one subdirectory per version (see
+# `_write_atomic()`). A version contains either:
+#
+# * `array.npy`: a single array,
+# * `dict.json` and `0.npy`, `1.npy`, ...: a dict or a Bunch of arrays, the
+#   JSON file contains the type and the keys,
+# * `object.pkl`: any other object, saved with joblib.
+#
+# The arrays are loaded memory-mapped, so that loading them is almost free
+# and several processes can share the same pages. They are mapped in
+# copy-on-write mode by default: like freshly computed arrays, they can be
+# modified in place, and the changes are never written to the files.
+
+def _is_storable_array(arr):
+    return isinstance(arr, np.ndarray) and not arr.dtype.hasobject
+
+
+def _is_array_dict(obj):
+    """Whether an object is a dict or Bunch of arrays with integer or string
+    keys."""
+    if not isinstance(obj, dict):
+        return False
+    return all(isinstance(k, (int, np.integer) + string_types) and
+               not isinstance(k, bool) and _is_storable_array(v)
+               for k, v in obj.items())
+
+
+def _save_npy(path, arr):
+    np.save(path, np.ascontiguousarray(arr))
+
+
+def _load_npy(path, mmap_mode='c'):
+    try:
+        return np.load(path, mmap_mode=mmap_mode)
+    except ValueError:  # pragma: no cover
+        # Empty arrays cannot be memory-mapped.
+        return np.load(path)
+
+
+def _json_key(k):
+    return int(k) if isinstance(k, (int, np.integer)) else k
+
+
+def _write_object(dirpath, obj):
+    if _is_storable_array(obj):
+        _save_npy(op.join(dirpath, 'array.npy'), obj)
+    elif _is_array_dict(obj):
+        keys = list(obj.keys())
+        meta = dict(type='Bunch' if isinstance(obj, Bunch) else 'dict',
+                    keys=[_json_key(k) for k in keys])
+        for i, k in enumerate(keys):
+            _save_npy(op.join(dirpath, '%d.npy' % i), obj[k])
+        with open(op.join(dirpath, 'dict.json'), 'w') as f:
+            json.dump(meta, f)
+    else:
+        _save_pickle(op.join(dirpath, 'object.pkl'), obj)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        # NOTE: the directory may be created concurrently by another process.
+        if not op.isdir(path):
+            raise
+
+
+def _versions(dirpath):
+    """Return the sorted version numbers of an entry."""
+    try:
+        names = os.listdir(dirpath)
+    except OSError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def _current_version(dirpath):
+    """Return the path to the last version of an entry, or None."""
+    versions = _versions(dirpath)
+    if not versions:
+        return None
+    return op.join(dirpath, str(versions[-1]))
+
+
+def _write_atomic(dirpath, write, obj):
+    """Write a new version of an entry.
+
+    Every version is a subdirectory of the entry, named after its version
+    number. A new version is written in a temporary directory which is then
+    renamed, so that a reader never sees an incomplete version, and no file
+    is ever replaced. The older versions are then removed. When they
+    cannot be removed (for example, memory-mapped files on Windows), they
+    are removed by a later write.
+
+    """
+    _makedirs(dirpath)
+    tmp = tempfile.mkdtemp(dir=dirpath, prefix='.tmp-')
+    try:
+        write(tmp, obj)
+        while True:
+            versions = _versions(dirpath)
+            version = versions[-1] + 1 if versions else 0
+            path = op.join(dirpath, str(version))
+            try:
+                os.rename(tmp, path)
+                break
+            except OSError:
+                # Another process wrote the same version concurrently.
+                if not op.exists(path):
+                    raise
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    for old in _versions(dirpath):
+        if old < version:
+            shutil.rmtree(op.join(dirpath, str(old)), ignore_errors=True)
+
+
+def _entry_path(dirpath):
+    path = _current_version(dirpath)
+    if path is None:
+        raise IOError("The entry `{}` does not exist.".format(dirpath))
+    return path
+
+
+def save_object(dirpath, obj):
+    """Save an object in a directory, with raw `.npy` files for arrays and
+    dicts of arrays.
+
+    The directory is written atomically (see `_write_atomic()`).
+
+    """
+    _write_atomic(dirpath, _write_object, obj)
+
+
+def has_object(dirpath):
+    return _current_version(dirpath) is not None
+
+
+def load_object(dirpath, mmap_mode='c'):
+    """Load an object saved with `save_object()`.
+
+    Arrays are memory-mapped, in copy-on-write mode by default, unless
+    `mmap_mode` is None.
+
+    """
+    dirpath = _entry_path(dirpath)
+    path = op.join(dirpath, 'array.npy')
+    if op.exists(path):
+        return _load_npy(path, mmap_mode=mmap_mode)
+    path = op.join(dirpath, 'dict.json')
+    if op.exists(path):
+        with open(path, 'r') as f:
+            meta = json.load(f)
+        out = Bunch() if meta['type'] == 'Bunch' else {}
+        for i, k in enumerate(meta['keys']):
+            out[k] = _load_npy(op.join(dirpath, '%d.npy' % i),
+                               mmap_mode=mmap_mode)
+        return out
+    return _load_pickle(op.join(dirpath, 'object.pkl'))
+
+
+#------------------------------------------------------------------------------
+# Concatenated dicts of arrays
+#------------------------------------------------------------------------------
+
+# A dict `{int: array}` with many keys, like `spikes_per_cluster`, is stored
+# in a directory (one subdirectory per version) with three files:
+#
+# * `keys.npy`: the sorted integer keys,
+# * `offsets.npy`: the `n_keys + 1` offsets of the values in `values.npy`,
+# * `values.npy`: the concatenation of all values along the first axis,
+#
+# and a `meta.json` file with the type of the object. Loading is then three
+# memory-mapped files instead of unpickling thousands of arrays.
+
+def _is_concatenable(obj):
+    """Whether an object is a SpikesPerCluster instance, or a dict of arrays
+    with integer keys and the same dtype and trailing shape."""
+    if isinstance(obj, SpikesPerCluster):
+        return True
+    if not _is_array_dict(obj) or isinstance(obj, Bunch):
+        return False
+    if not all(isinstance(k, (int, np.integer)) for k in obj):
+        return False
+    values = list(obj.values())
+    if not values:
+        return True
+    dtype, shape = values[0].dtype, values[0].shape[1:]
+    return all(v.ndim >= 1 and v.dtype == dtype and v.shape[1:] == shape
+               for v in values)
+
+
+def _write_concatenated(dirpath, obj):
+    if isinstance(obj, SpikesPerCluster):
+        state = obj.__getstate__()
+        keys, offsets, values = (state['clusters'], state['offsets'],
+                                 state['spikes'])
+        kind = 'SpikesPerCluster'
+    else:
+        keys = np.array(sorted(obj), dtype=np.int64)
+        arrays = [obj[k] for k in keys]
+        counts = [len(v) for v in arrays]
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        values = (np.concatenate(arrays) if arrays
+                  else np.zeros(0, dtype=np.int64))
+        kind = 'dict'
+    _save_npy(op.join(dirpath, 'keys.npy'), keys)
+    _save_npy(op.join(dirpath, 'offsets.npy'), offsets)
+    _save_npy(op.join(dirpath, 'values.npy'), values)
+    with open(op.join(dirpath, 'meta.json'), 'w') as f:
+        json.dump(dict(type=kind), f)
+
+
+def save_concatenated(dirpath, obj):
+    """Save a SpikesPerCluster instance, or a dict `{int: array}`, as a
+    concatenated array with a table of keys and offsets.
+
+    The directory is written atomically. A ValueError is raised if the
+    object cannot be stored in this format (see `_is_concatenable()`).
+
+    """
+    if not _is_concatenable(obj):
+        raise ValueError("The object cannot be stored as concatenated "
+                         "arrays.")
+    _write_atomic(dirpath, _write_concatenated, obj)
+
+
+def load_concatenated(dirpath, mmap_mode='c'):
+    """Load an object saved with `save_concatenated()`.
+
+    The values are views of a single memory-mapped array unless `mmap_mode`
+    is None.
+
+    """
+    dirpath = _entry_path(dirpath)
+    with open(op.join(dirpath, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    keys = _load_npy(op.join(dirpath, 'keys.npy'), mmap_mode=mmap_mode)
+    offsets = _load_npy(op.join(dirpath, 'offsets.npy'), mmap_mode=mmap_mode)
+    values = _load_npy(op.join(dirpath, 'values.npy'), mmap_mode=mmap_mode)
+    if meta['type'] == 'SpikesPerCluster':
+        # NOTE: SpikesPerCluster never writes in its arrays after loading,
+        # they are reallocated on the first update.
+        spc = SpikesPerCluster()
+        spc.__setstate__({'clusters': keys, 'offsets': offsets,
+                          'spikes': values})
+        return spc
+    offsets = np.asarray(offsets)
+    return {int(k): values[offsets[i]:offsets[i + 1]]
+            for i, k in enumerate(keys)}
+
+
+#------------------------------------------------------------------------------
+# Array store
+#------------------------------------------------------------------------------
+
+class ArrayStore(object):
+    """Store the results of functions in a directory, one subdirectory
+    per function and per call.
+
+    Arrays, and dicts or Bunches of arrays, are stored as raw `.npy` files
+    and come back memory-mapped. Other objects are pickled with joblib.
+
+    """
+    def __init__(self, root, mmap_mode='c'):
+        self.root = root
+        self.mmap_mode = mmap_mode
+
+    def _path(self, name, key):
+        return op.join(self.root, name, key)
+
+    def __contains__(self, item):
+        name, key = item
+        return has_object(self._path(name, key))
+
+    def load(self, name, key):
+        return load_object(self._path(name, key), mmap_mode=self.mmap_mode)
+
+    def save(self, name, key, obj):
+        try:
+            save_object(self._path(name, key), obj)
+        except Exception as e:  # pragma: no cover
+            logger.warn("Unable to cache the result of `%s`: %s.",
+                        name, str(e))
+
+    def clear(self, name=None):
+        path = self.root if name is None else op.join(self.root, name)
+        if op.exists(path):
+            shutil.rmtree(path)
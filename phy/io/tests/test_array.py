@@ -18,12 +18,15 @@ from ..array import (_unique,
                      _spikes_in_clusters,
                      _spikes_per_cluster,
                      _flatten_per_cluster,
+                     SpikesPerCluster,
                      get_closest_clusters,
                      _get_data_lim,
                      _flatten,
                      _start_stop,
                      select_spikes,
                      Selector,
+                     SubsamplingIndex,
+                     _pyramid_levels,
                      chunk_bounds,
                      regular_subset,
                      excerpts,
@@ -38,8 +41,9 @@ from ..array import (_unique,
                      write_array,
                      Accumulator,
                      _accumulate,
+                     _merged_parents,
                      )
-from phy.utils._types import _as_array
+from phy.utils._types import _as_array, Bunch
 from phy.utils.testing import _assert_equal as ae
 from ..mock import artificial_spike_clusters
 
@@ -276,6 +280,44 @@ def test_concatenate_virtual_arrays_3():
     ae(c[3], 2 * np.ones((1, 2)))
 
 
+def test_concatenate_virtual_arrays_4():
+    arrs = [np.arange(5), np.arange(10, 12), np.array([0]), np.arange(3)]
+    c = _concatenate_virtual_arrays(arrs)
+    full = np.concatenate(arrs)
+    ae(c[2:10], full[2:10])
+    ae(c[:100], full)
+
+    ae(c._get_recordings([0, 4, 5, 7, 8, 10]), [0, 0, 1, 2, 3, 3])
+
+    # Fancy indexing across several recordings.
+    ae(c[[1, 5, 7, 9]], full[[1, 5, 7, 9]])
+    ae(c[np.array([9, 0, 6, 6])], full[[9, 0, 6, 6]])
+    ae(c[[-1]], full[[-1]])
+    ae(c[full > 3], full[full > 3])
+    assert c[[]].shape == (0,)
+    with raises(IndexError):
+        c[[0, 20]]
+
+
+def test_concatenate_virtual_arrays_5():
+    arrs = [np.random.rand(4, 3), np.random.rand(2, 3), np.random.rand(5, 3)]
+    full = np.vstack(arrs)
+    c = _concatenate_virtual_arrays(arrs, cols=[2, 0], scaling=2)
+    assert c.shape == (11, 2)
+    indices = [0, 3, 4, 6, 10]
+    ae(c[indices], 2 * full[indices][:, [2, 0]])
+    ae(c[1:9], 2 * full[1:9][:, [2, 0]])
+
+    # The column selection is relative to `cols`.
+    ae(c[1:9, [1, 0]], 2 * full[1:9][:, [0, 2]])
+    ae(c[3:8, 0], 2 * full[3:8, 2])
+    ae(c[indices, 1:], 2 * full[indices][:, [0]])
+    ae(c[1:9][:, [1, 0]], c[1:9, [1, 0]])
+
+    c = _concatenate_virtual_arrays(arrs)
+    ae(c[indices, 1:], full[indices, 1:])
+
+
 #------------------------------------------------------------------------------
 # Test chunking
 #------------------------------------------------------------------------------
@@ -395,6 +437,79 @@ def test_spikes_per_cluster():
         assert np.all(spike_clusters[spikes_per_cluster[i]] == i)
 
 
+def test_spikes_per_cluster_struct():
+    spike_clusters = np.array([3, 5, 3, 7, 5, 3, -1])
+    spc = SpikesPerCluster(spike_clusters)
+    assert len(spc) == 4
+    assert spc.keys() == [-1, 3, 5, 7]
+    assert list(spc) == [-1, 3, 5, 7]
+    assert 3 in spc
+    assert 4 not in spc
+    ae(spc[3], [0, 2, 5])
+    ae(spc[-1], [6])
+    assert spc.get(4) is None
+    with raises(KeyError):
+        spc[4]
+    ae(spc.counts, [1, 3, 2, 1])
+    assert spc.n_spikes == 7
+    ae(spc.spike_clusters(), spike_clusters)
+
+    # Prefixes of the clusters.
+    ae(spc.head([5, 3]), [1, 4, 0, 2, 5])
+    ae(spc.head([5, 3], 1), [1, 0])
+    ae(spc.head([]), [])
+    with raises(KeyError):
+        spc.head([4])
+    with raises(KeyError):
+        SpikesPerCluster().head([4])
+
+    # Merge.
+    spc.remove([3, 5])
+    spc.update({8: [0, 1, 2, 4, 5]})
+    assert spc.keys() == [-1, 7, 8]
+    ae(spc[8], [0, 1, 2, 4, 5])
+    ae(spc.spike_clusters(), [8, 8, 8, 7, 8, 8, -1])
+
+    # Split.
+    spc.remove([8])
+    spc.add([5, 0, 1, 4, 2], [10, 9, 10, 10, 9])
+    assert spc.keys() == [-1, 7, 9, 10]
+    ae(spc[9], [0, 2])
+    ae(spc[10], [1, 4, 5])
+
+    # Adding spikes to an existing cluster.
+    spc.add([3], [9])
+    ae(spc[9], [0, 2, 3])
+    spc.remove([7])
+
+    # Compaction and copy.
+    spc2 = spc.copy()
+    assert spc2.keys() == spc.keys()
+    for c in spc:
+        ae(spc2[c], spc[c])
+    assert spc2._size == spc2.n_spikes
+
+    # Conversion to and from dictionaries.
+    d = spc.to_dict()
+    assert sorted(d) == [-1, 9, 10]
+    spc3 = SpikesPerCluster.from_dict(d)
+    assert spc3.items()[1][0] == 9
+    ae(spc3.items()[1][1], [0, 2, 3])
+
+
+def test_spikes_per_cluster_pickle(tempdir):
+    from six.moves import cPickle
+    spike_clusters = artificial_spike_clusters(1000, 10)
+    spc = _spikes_per_cluster(spike_clusters)
+    # Create holes in the spike array.
+    spc.remove([0, 1])
+    spc.update({20: np.sort(np.nonzero(spike_clusters <= 1)[0])})
+    spc2 = cPickle.loads(cPickle.dumps(spc))
+    assert spc2.keys() == spc.keys()
+    ae(spc2.spike_clusters(), np.where(spike_clusters <= 1, 20,
+                                       spike_clusters))
+
+
 def test_flatten_per_cluster():
     spc = {2: [2, 7, 11], 3: [3, 5], 5: []}
     arr = _flatten_per_cluster(spc)
@@ -449,6 +564,89 @@ def test_select_spikes_random():
     assert np.all(np.in1d(s, [2, 3, 4]))
 
 
+def test_pyramid_levels():
+    # Cluster with 8 spikes: 0 | 4 | 2 6 | 1 3 5 7
+    ae(_pyramid_levels(np.arange(8), 8 * [8]), [0, 3, 2, 3, 1, 3, 2, 3])
+    ae(_pyramid_levels([0], [1]), [0])
+
+
+def test_subsampling_index_1():
+    spc = {2: np.arange(0, 100, 2), 3: np.arange(1, 21, 2), 5: []}
+    index = SubsamplingIndex(spc, seed=1)
+    assert 2 in index
+    # Empty clusters are not stored.
+    assert 5 not in index
+    ae(index.cluster_ids, [2, 3])
+
+    # No subsampling.
+    ae(index.select([2, 3]), np.arange(0, 21, 1).tolist() +
+       np.arange(22, 100, 2).tolist())
+    ae(index.select([]), [])
+    with raises(KeyError):
+        index.select([7])
+
+    # Prefixes are nested.
+    s1 = index.select([2], 4)
+    s2 = index.select([2], 8)
+    assert len(s1) == 4
+    assert len(s2) == 8
+    assert np.all(np.in1d(s1, s2))
+    assert np.all(np.in1d(s2, spc[2]))
+    # The first spike is always selected first.
+    ae(index.select([2], 1), [0])
+
+    # Reproducible.
+    ae(SubsamplingIndex(spc, seed=1).select([2, 3], 10),
+       index.select([2, 3], 10))
+
+    # The selections are spread across the cluster.
+    s = index.select([2], 5)
+    assert s.max() >= 50
+
+
+def test_subsampling_index_random():
+    spc = {0: np.arange(1000)}
+    s1 = SubsamplingIndex(spc, seed=0, stratified=False).select([0], 100)
+    s2 = SubsamplingIndex(spc, seed=1, stratified=False).select([0], 100)
+    assert len(s1) == len(s2) == 100
+    assert not np.array_equal(s1, s2)
+
+
+def test_subsampling_index_update():
+    spc = {0: np.arange(10), 1: np.arange(10, 30)}
+    index = SubsamplingIndex(spc)
+    s = index.select([0, 1], 5)
+
+    # Merge.
+    spc[2] = np.arange(30)
+    index.on_cluster(Bunch(added=[2], deleted=[0, 1]), spc)
+    ae(index.cluster_ids, [2])
+    assert len(index.select([2], 5)) == 5
+
+    # Undo: the sample order is the same as before.
+    index.on_cluster(Bunch(added=[0, 1], deleted=[2]), spc)
+    ae(index.select([0, 1], 5), s)
+
+    # Selector using the index.
+    sel = Selector(lambda c: spc[c], subsampling_index=index)
+    ae(sel.select_spikes([0, 1], 5), s)
+    assert len(sel.select_spikes([0], 5, batch_size=2)) == 4
+
+
+#------------------------------------------------------------------------------
+# Test clustering listener
+#------------------------------------------------------------------------------
+
+def test_merged_parents():
+    # Merge.
+    up = Bunch(descendants=[(1, 10), (2, 10)])
+    assert _merged_parents(up) == {10: [1, 2]}
+    # Split.
+    up = Bunch(descendants=[(1, 10), (1, 11), (2, 12)])
+    assert _merged_parents(up) == {12: [2]}
+    assert _merged_parents(Bunch(descendants=None)) == {}
+
+
 #------------------------------------------------------------------------------
 # Test accumulator
 #------------------------------------------------------------------------------
@@ -471,3 +669,28 @@ def test_accumulator_2():
     # NOTE: in case of scalars, we take the first one and discard the others.
     # We don't concatenate them.
     assert acc['c'] == 0
+
+
+def test_accumulator_dtype():
+    data = [{'a': np.zeros((3, 2)), 'b': np.arange(3), 'c': [0, 1]},
+            {'a': np.ones((2, 2), dtype=np.float32), 'b': np.arange(2),
+             'c': [2]},
+            ]
+    acc = _accumulate(data, dtype=np.float32)
+    assert acc['a'].dtype == np.float32
+    ae(acc['a'], np.r_[np.zeros((3, 2)), np.ones((2, 2))])
+    # Integer arrays keep their dtype.
+    assert acc['b'].dtype == np.arange(3).dtype
+    ae(acc['b'], [0, 1, 2, 0, 1])
+    # Lists are concatenated too.
+    ae(acc['c'], [0, 1, 2])
+
+    acc = _accumulate(data, dtype=np.float32, keep_dtype=('a',))
+    assert acc['a'].dtype == np.float64
+
+    # Incompatible shapes.
+    acc = Accumulator()
+    acc.add('a', np.zeros((2, 2)))
+    acc.add('a', np.zeros((2, 3)))
+    with raises(ValueError):
+        acc['a']
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of chunked compressed arrays."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises, mark
+
+from ..array import read_array, write_array, _concatenate_virtual_arrays
+from ..compressed import CompressedArray, write_compressed_array
+from ..mock import artificial_traces
+from phy.traces.waveform import WaveformLoader
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _traces(n_samples=1000, n_channels=8):
+    arr = np.cumsum(np.random.randint(size=(n_samples, n_channels),
+                                      low=-20, high=20), axis=0)
+    return arr.astype(np.int16)
+
+
+@mark.parametrize('method', ['zlib', 'lzma'])
+def test_compressed_array_1(tempdir, method):
+    arr = _traces()
+    path = op.join(tempdir, 'traces.cbin')
+    write_compressed_array(path, arr, chunk_size=64, method=method)
+    assert op.getsize(path) < arr.nbytes
+
+    c = CompressedArray(path)
+    assert c.shape == arr.shape
+    assert c.dtype == arr.dtype
+    assert c.ndim == 2
+    assert len(c) == 1000
+    assert c.n_chunks == 16
+
+    ae(c[:], arr)
+    ae(c[10], arr[10])
+    ae(c[-1], arr[-1])
+    ae(c[60:70], arr[60:70])
+    ae(c[60:70, 3], arr[60:70, 3])
+    ae(c[60:700:7, 1:3], arr[60:700:7, 1:3])
+    ae(c[990:2000], arr[990:])
+    ae(c[20:10], arr[20:10])
+    ae(c[[900, 3, 64, 65, 3]], arr[[900, 3, 64, 65, 3]])
+    ae(c[[900, 3], [1, 2]], arr[[900, 3]][:, [1, 2]])
+    ae(c[[]], arr[[]])
+
+    with raises(IndexError):
+        c[1000]
+    with raises(IndexError):
+        c[[0, 1000]]
+
+    # Only the touched chunks are decompressed.
+    c = CompressedArray(path)
+    c[70:130]
+    assert sorted(c._chunks) == [1, 2]
+
+
+def test_compressed_array_indices(tempdir, monkeypatch):
+    from .. import compressed
+    arr = _traces()
+    path = op.join(tempdir, 'traces.cbin')
+    write_compressed_array(path, arr, chunk_size=64)
+
+    decoded = []
+    _decode_chunk = compressed._decode_chunk
+
+    def _decode(*args, **kwargs):
+        decoded.append(args)
+        return _decode_chunk(*args, **kwargs)
+    monkeypatch.setattr(compressed, '_decode_chunk', _decode)
+
+    # Every chunk is decoded once for unsorted indices.
+    c = CompressedArray(path, n_cached_chunks=1)
+    rows = np.random.permutation(1000)
+    ae(c[rows], arr[rows])
+    assert len(decoded) == 16
+
+
+def test_compressed_array_float(tempdir):
+    arr = artificial_traces(100, 3)
+    path = op.join(tempdir, 'traces.cbin')
+    write_array(path, arr, chunk_size=30)
+    c = read_array(path)
+    assert isinstance(c, CompressedArray)
+    ae(c[:], arr)
+    ae(c[25:35], arr[25:35])
+
+
+def test_compressed_array_errors(tempdir):
+    path = op.join(tempdir, 'traces.cbin')
+    with raises(ValueError):
+        write_compressed_array(path, np.zeros((10, 2)), method='unknown')
+    with open(path, 'wb') as f:
+        f.write(b'notacompressedarray')
+    with raises(IOError):
+        CompressedArray(path)
+
+
+def test_compressed_array_concatenate(tempdir):
+    arrs = [_traces(100, 4), _traces(50, 4)]
+    paths = [op.join(tempdir, 'traces%d.cbin' % i) for i in range(2)]
+    for path, arr in zip(paths, arrs):
+        write_compressed_array(path, arr, chunk_size=16)
+    c = _concatenate_virtual_arrays([read_array(path) for path in paths])
+    full = np.vstack(arrs)
+    ae(c[90:110], full[90:110])
+    ae(c[[5, 120, 99]], full[[5, 120, 99]])
+
+
+def test_compressed_array_waveform_loader(tempdir):
+    arr = _traces(200, 4)
+    path = op.join(tempdir, 'traces.cbin')
+    write_compressed_array(path, arr, chunk_size=16)
+    loader = WaveformLoader(traces=CompressedArray(path),
+                            spike_samples=[20, 100, 150],
+                            n_samples_waveforms=(3, 4),
+                            )
+    w = loader.get([1, 2], channels=[0, 2])
+    assert w.shape == (2, 7, 2)
+    ae(w[0], arr[97:104, [0, 2]])
@@ -6,6 +6,8 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import multiprocessing
+import os
 import os.path as op
 
 import numpy as np
@@ -13,8 +15,9 @@ from numpy.testing import assert_array_equal as ae
 from pytest import fixture, yield_fixture
 from six.moves import cPickle
 
-from ..array import write_array, read_array
-from ..context import Context, _fullname
+from phy.utils import Bunch, ProgressReporter
+from ..array import write_array, read_array, _spikes_per_cluster
+from ..context import Context, _fullname, _to_shared, _from_shared
 
 
 #------------------------------------------------------------------------------
@@ -70,6 +73,25 @@ def test_context_load_save_pickle(tempdir, context, temp_phy_config_dir):
     ae(context.load('arr'), arr)
 
 
+def test_context_load_save_arrays(tempdir, context, temp_phy_config_dir):
+    spc = _spikes_per_cluster(np.array([2, 0, 2, 1]))
+    context.save('spc', spc, kind='arrays')
+    assert op.isdir(op.join(context.cache_dir, 'spc.arrays'))
+    out = context.load('spc')
+    assert out.keys() == [0, 1, 2]
+    ae(out[2], [0, 2])
+
+    # Fallback to pickle, the previous version is removed.
+    context.save('spc', {0: [1, 2]}, kind='arrays')
+    assert not op.exists(op.join(context.cache_dir, 'spc.arrays'))
+    assert context.load('spc') == {0: [1, 2]}
+
+    # And conversely.
+    context.save('spc', {0: np.arange(3)}, kind='arrays')
+    assert not op.exists(op.join(context.cache_dir, 'spc.pkl'))
+    ae(context.load('spc')[0], np.arange(3))
+
+
 def test_context_cache(context):
 
     _res = []
@@ -95,6 +117,57 @@ def test_context_cache(context):
     assert len(_res) == 2
 
 
+def test_context_cache_load_error(context):
+    _res = []
+
+    @context.cache
+    def f(x):
+        _res.append(x)
+        return np.arange(x)
+
+    f(3)
+    # An incomplete entry, for example removed by a concurrent write, is a
+    # cache miss.
+    entry = op.join(context.cache_dir, 'arrays', _fullname(f))
+    entry = op.join(entry, os.listdir(entry)[0])
+    os.makedirs(op.join(entry, '100'))
+    ae(f(3), np.arange(3))
+    assert _res == [3, 3]
+
+
+def test_context_cache_mmap(context):
+    _res = []
+
+    @context.cache
+    def f(n):
+        _res.append(n)
+        return Bunch(x=np.arange(n), y=np.ones((n, 2)), z=n)
+
+    @context.cache
+    def g(n):
+        _res.append(n)
+        return {c: np.arange(c) for c in range(n)}
+
+    ae(f(3).x, np.arange(3))
+    assert len(_res) == 1
+
+    # Bunches of arrays are not stored as arrays if they contain scalars.
+    out = f(3)
+    assert len(_res) == 1
+    assert out.z == 3
+
+    # Dicts of arrays are memory-mapped.
+    g(4)
+    out = g(4)
+    assert len(_res) == 2
+    assert isinstance(out[3], np.memmap)
+    ae(out[3], np.arange(3))
+
+    # Cached arrays can be modified in place without changing the cache.
+    out[3][:] = 0
+    ae(g(4)[3], np.arange(3))
+
+
 def test_context_cache_method(tempdir, context):
     class A(object):
         def __init__(self, ctx):
@@ -153,6 +226,89 @@ def test_context_memcache(tempdir, context):
     assert len(_res) == 1
 
 
+def test_context_memcache_size(tempdir):
+    context = Context('{}/cache/'.format(tempdir), memcache_size=6000)
+    _res = []
+
+    @context.memcache
+    def f(x):
+        _res.append(x)
+        return np.zeros(200) + x
+
+    @context.memcache
+    def g(x):
+        return np.zeros(200) - x
+
+    # Each entry is about 1.6 KB: only 3 entries fit in the budget.
+    for i in range(3):
+        f(i)
+    g(0)
+    stats = context.memcache_stats()[_fullname(f)]
+    assert stats['evictions'] == 1
+    assert stats['n_items'] == 2
+    assert stats['nbytes'] <= 6000
+
+    # The evicted entry was saved to disk: it is not recomputed.
+    assert len(_res) == 3
+    ae(f(0), np.zeros(200))
+    assert len(_res) == 3
+    stats = context.memcache_stats()[_fullname(f)]
+    assert stats['misses'] == 3
+    assert stats['loads'] == 1
+    assert stats['hits'] == 0
+
+    # Without spilling, the evicted entries are discarded.
+    context.memcache_spill = False
+    f(3)
+    f(2)
+    assert len(_res) == 5
+
+
+def test_context_memcache_lazy(tempdir, context):
+    _res = []
+
+    def f(x):
+        _res.append(x)
+        return np.arange(x)
+
+    mf = context.memcache(f)
+    mf(3)
+    mf(4)
+    context.save_memcache()
+    mf(5)
+    context.save_memcache()
+
+    # Reopen the cache: the entries are loaded on demand.
+    context = Context('{}/cache/'.format(tempdir))
+    mf = context.memcache(f)
+    cache = context._memcache[_fullname(f)]
+    assert len(cache) == 0
+    ae(mf(4), np.arange(4))
+    assert len(cache) == 1
+    mf(5)
+    assert _res == [3, 4, 5]
+
+    # Persisted entries are saved without save_memcache().
+    mf.set_cached(np.arange(6), 6, persist=True)
+    context = Context('{}/cache/'.format(tempdir))
+    mf = context.memcache(f)
+    ae(mf(6), np.arange(6))
+    assert _res == [3, 4, 5]
+
+
+def test_context_memcache_hash_arrays(context):
+    _res = []
+
+    @context.memcache(hash_arrays=True)
+    def f(x):
+        _res.append(x)
+        return x.sum()
+
+    assert f(np.arange(10)) == 45
+    assert f(np.arange(10)) == 45
+    assert len(_res) == 1
+
+
 def test_pickle_cache(tempdir, context):
     """Make sure the Context is picklable."""
     with open(op.join(tempdir, 'test.pkl'), 'wb') as f:
@@ -161,3 +317,107 @@ def test_pickle_cache(tempdir, context):
         ctx = cPickle.load(f)
     assert isinstance(ctx, Context)
     assert ctx.cache_dir == context.cache_dir
+
+
+#------------------------------------------------------------------------------
+# Test parallel map
+#------------------------------------------------------------------------------
+
+def _square(x):
+    return x * x
+
+
+def _sum_arrays(item):
+    i, arr = item
+    assert isinstance(arr, np.memmap)
+    return i, float(arr.sum())
+
+
+def test_shared_arrays(tempdir):
+    arr = np.random.rand(100)
+    item = (1, arr, {'a': arr[:2]})
+    shared = _to_shared(item, tmp_dir=tempdir, min_size=100)
+    assert shared[0] == 1
+    # Small arrays are kept as they are.
+    assert isinstance(shared[2]['a'], np.ndarray)
+    out = _from_shared(shared)
+    assert isinstance(out[1], np.memmap)
+    ae(out[1], arr)
+    ae(out[2]['a'], arr[:2])
+
+
+def test_context_map_serial(context):
+    pr = ProgressReporter()
+    assert context.map(_square, range(5), n_jobs=1,
+                       progress_reporter=pr) == [0, 1, 4, 9, 16]
+    assert pr.value == pr.value_max == 5
+    assert context.map(_square, []) == []
+
+
+def test_context_map_parallel(context):
+    pr = ProgressReporter()
+    assert context.map(_square, range(20), n_jobs=2, chunk_size=3,
+                       progress_reporter=pr) == [i * i for i in range(20)]
+    assert pr.value == 20
+
+    # Large arrays are passed through memory-mapped files.
+    arrs = [np.random.rand(1000) for _ in range(4)]
+    out = context.map(_sum_arrays, enumerate(arrs), n_jobs=2,
+                      shared_min_size=1000)
+    assert [i for i, _ in out] == list(range(4))
+    assert np.allclose([s for _, s in out], [a.sum() for a in arrs])
+
+
+def test_context_map_sliced_memmap(tempdir, context):
+    path = op.join(tempdir, 'arr.dat')
+    np.arange(1000, dtype=np.float64).tofile(path)
+    mm = np.memmap(path, dtype=np.float64, mode='r')
+    # Views of a memmap keep the offset of the original memmap.
+    items = [(0, mm[100:200]), (1, mm[500:]), (2, mm[::2])]
+    out = context.map(_sum_arrays, items, n_jobs=2)
+    assert [s for _, s in out] == [14950., 374750., 249500.]
+
+
+def _init_offset(offset):
+    _OFFSET[:] = [offset]
+
+
+_OFFSET = [0]
+
+
+def _add_offset(x):
+    return x + _OFFSET[0]
+
+
+def test_context_imap(context, monkeypatch):
+    n_pools = []
+    pool = multiprocessing.Pool
+
+    def _pool(*args, **kwargs):
+        n_pools.append(args)
+        return pool(*args, **kwargs)
+    monkeypatch.setattr(multiprocessing, 'Pool', _pool)
+
+    # The items are read lazily.
+    read = []
+
+    def _items(n):
+        for i in range(n):
+            read.append(i)
+            yield i
+
+    it = context.imap(_square, _items(20), n_jobs=2, batch_size=3)
+    assert next(it) == 0
+    assert len(read) == 3
+    assert list(it) == [i * i for i in range(1, 20)]
+    # A single pool is used for all batches.
+    assert len(n_pools) == 1
+
+    it = context.imap(_add_offset, range(10), n_jobs=2, batch_size=4,
+                      initializer=_init_offset, initargs=(10,))
+    assert next(it) == 10
+    it.close()
+    assert list(context.imap(_add_offset, range(3), n_jobs=1,
+                             initializer=_init_offset,
+                             initargs=(1,))) == [1, 2, 3]
+    _init_offset(0)
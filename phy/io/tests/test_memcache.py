@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the memory cache."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from phy.utils import Bunch
+from ..memcache import LogStore, MemoryCache, _nbytes, _hash_args
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_nbytes():
+    arr = np.zeros(1000)
+    assert 8000 <= _nbytes(arr) < 9000
+    assert 16000 <= _nbytes(Bunch(a=arr, b=arr)) < 18000
+    assert 16000 <= _nbytes([arr, (arr,)]) < 18000
+    assert _nbytes(None) > 0
+
+
+def test_hash_args():
+    a = np.arange(10)
+    h = _hash_args((1, a))
+    assert h[0] == 1
+    assert h == _hash_args((1, a.copy()))
+    assert h != _hash_args((1, a[::-1]))
+    assert hash(h)
+
+
+def test_memory_cache():
+    cache = MemoryCache('f', {(0,): np.zeros(10)})
+    assert len(cache) == 1
+    assert cache.nbytes >= 80
+
+    cache[(1,)] = np.zeros(100)
+    assert cache.nbytes >= 880
+    assert (1,) in cache
+    assert cache.get((2,)) is None
+    assert cache.get((0,)) is not None
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+    # (1,) is now the least recently used entry.
+    assert cache.oldest is not None
+    key, value = cache.popitem()
+    assert key == (1,)
+    assert cache.evictions == 1
+    assert cache.nbytes < 880
+
+    assert list(cache.to_dict()) == [(0,)]
+    assert cache.pop((0,)) is not None
+    assert cache.nbytes == 0
+    assert cache.oldest is None
+    with raises(KeyError):
+        cache[(0,)]
+
+
+def test_log_store(tempdir):
+    path = op.join(tempdir, 'store')
+    store = LogStore(path)
+    assert len(store) == 0
+    store.append((1,), np.arange(3))
+    store.append((2,), 'hello')
+    store.append((1,), np.arange(5))
+    assert len(store) == 2
+    assert (1,) in store
+    ae(store.load((1,)), np.arange(5))
+    assert store.live_size < store.size
+
+    # Reopen without the index: the log is scanned.
+    store = LogStore(path)
+    ae(store.load((1,)), np.arange(5))
+    assert store.load((2,)) == 'hello'
+
+    # Reopen with an outdated index and an incomplete record.
+    store.save_index()
+    store.append((3,), 3)
+    with open(path + '.log', 'ab') as f:
+        f.write(b'\x01\x02')
+    store = LogStore(path)
+    assert sorted(store.keys()) == [(1,), (2,), (3,)]
+    assert store.load((3,)) == 3
+    size = store.size
+
+    # Compaction.
+    store.maybe_compact(min_size=0, min_garbage=0, background=False)
+    assert store.size < size
+    assert store.size == store.live_size
+    ae(store.load((1,)), np.arange(5))
+    assert store.load((2,)) == 'hello'
+    store = LogStore(path)
+    assert store.load((3,)) == 3
+
+    # Background compaction.
+    store.append((3,), 4)
+    store.maybe_compact(min_size=0, min_garbage=0)
+    store.wait()
+    assert store.load((3,)) == 4
+
+
+def test_memory_cache_store(tempdir):
+    store = LogStore(op.join(tempdir, 'store'))
+    cache = MemoryCache('f', store=store)
+    cache[(0,)] = 0
+    cache[(1,)] = 1
+    cache.flush()
+    assert len(store) == 2
+
+    # Evicted entries are saved.
+    cache[(2,)] = 2
+    cache.popitem()
+    cache.popitem()
+    cache.popitem()
+    assert len(store) == 3
+
+    # Lazy loading.
+    assert cache.get((2,)) == 2
+    assert cache.loads == 1
+    assert cache.get((3,)) is None
+    assert cache.misses == 1
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the spike time index."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from ..mock import MockClustering, artificial_spike_clusters
+from ..spike_times import SpikeTimeIndex
+
+
+#------------------------------------------------------------------------------
+# Test spike time index
+#------------------------------------------------------------------------------
+
+def test_spike_time_index_1():
+    n_spikes, n_clusters = 1000, 10
+    spike_times = np.cumsum(np.random.uniform(0, .01, n_spikes))
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    index = SpikeTimeIndex(spike_times, spike_clusters)
+    interval = (spike_times[100], spike_times[200])
+
+    # All spikes.
+    ae(index.spikes_in_interval(interval), np.arange(100, 200))
+
+    # Some clusters.
+    clusters = [1, 3, 7]
+    expected = np.nonzero((spike_times >= interval[0]) &
+                          (spike_times < interval[1]) &
+                          np.in1d(spike_clusters, clusters))[0]
+    ae(index.spikes_in_interval(interval, clusters), expected)
+    ae(index.spikes_in_interval(interval, []), [])
+
+    # Spike train.
+    st = index.spike_train(clusters, interval)
+    ae(st.spike_ids, expected)
+    ae(st.spike_times, spike_times[expected])
+    ae(st.spike_clusters, spike_clusters[expected])
+    ae(st.spike_recordings, 0)
+
+    # Navigation.
+    c = 3
+    spikes = np.nonzero(spike_clusters == c)[0]
+    t = spike_times[spikes[4]]
+    assert index.next_spike(c, t) == spikes[5]
+    assert index.previous_spike(c, t) == spikes[3]
+    assert index.previous_spike(c, spike_times[spikes[0]]) is None
+    assert index.next_spike(c, spike_times[spikes[-1]]) is None
+
+
+def test_spike_time_index_recordings():
+    spike_times = np.arange(10) + .5
+    spike_clusters = np.array([0, 1, 0, 1, 0, 1, 0, 1, 0, 1])
+    # Two recordings of 4 and 6 seconds at 100 Hz.
+    index = SpikeTimeIndex(spike_times, spike_clusters,
+                           recording_offsets=[0, 400, 1000],
+                           sample_rate=100.)
+    assert index.n_recordings == 2
+    assert index.recording_interval(1) == (4., 10.)
+    ae(index.spike_recordings(), [0] * 4 + [1] * 6)
+
+    ae(index.spikes_in_interval((2., 6.), [0]), [2, 4])
+    ae(index.spikes_in_interval((2., 6.), [0], recording=0), [2])
+    ae(index.spikes_in_interval((2., 6.), recording=1), [4, 5])
+
+    assert index.next_spike(0, 2.5) == 4
+    assert index.next_spike(0, 2.5, recording=0) is None
+    assert index.previous_spike(1, 5.5, recording=1) is None
+    assert index.previous_spike(1, 5.5) == 3
+
+
+def test_spike_time_index_update():
+    spike_times = np.arange(10) * .1
+    spike_clusters = np.array([0, 1, 0, 1, 0, 1, 0, 1, 0, 1])
+    clustering = MockClustering(spike_clusters)
+    index = SpikeTimeIndex(spike_times, spike_clusters).attach(clustering)
+    ae(index.cluster_times(1), spike_times[1::2])
+
+    # Merge.
+    clustering.merge([0, 1], 2)
+    ae(index.spikes_in_interval((.15, .45), [2]), [2, 3, 4])
+    assert 0 not in index._cluster_times
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the array store."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from phy.utils import Bunch
+from ..array import _spikes_per_cluster, SpikesPerCluster
+from ..store import (ArrayStore, save_object, load_object, has_object,
+                     save_concatenated, load_concatenated,
+                     _is_array_dict, _is_concatenable,
+                     )
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_is_array_dict():
+    assert _is_array_dict({})
+    assert _is_array_dict({1: np.arange(3), 'a': np.zeros(2)})
+    assert not _is_array_dict({1: [0, 1]})
+    assert not _is_array_dict({(1, 2): np.arange(3)})
+    assert not _is_array_dict({1: np.array([None])})
+    assert not _is_array_dict(np.arange(3))
+
+
+def test_save_load_object(tempdir):
+    path = op.join(tempdir, 'obj')
+    assert not has_object(path)
+
+    # Array.
+    arr = np.random.rand(10, 3)
+    save_object(path, arr)
+    assert has_object(path)
+    out = load_object(path)
+    assert isinstance(out, np.memmap)
+    ae(out, arr)
+
+    # Overwrite with a dict of arrays.
+    save_object(path, {3: arr, 5: arr[:2]})
+    out = load_object(path)
+    assert sorted(out) == [3, 5]
+    assert isinstance(out[5], np.memmap)
+    ae(out[5], arr[:2])
+
+    # Bunch of arrays.
+    save_object(path, Bunch(a=arr, b=np.zeros(0)))
+    out = load_object(path, mmap_mode=None)
+    assert isinstance(out, Bunch)
+    ae(out.a, arr)
+    assert not isinstance(out.a, np.memmap)
+    assert out.b.shape == (0,)
+
+    # Other objects.
+    save_object(path, {'a': [1, 2]})
+    assert load_object(path) == {'a': [1, 2]}
+
+
+def test_is_concatenable():
+    assert _is_concatenable({})
+    assert _is_concatenable(SpikesPerCluster())
+    assert _is_concatenable({1: np.arange(3), 5: np.arange(2)})
+    assert _is_concatenable({1: np.zeros((3, 2)), 5: np.zeros((0, 2))})
+    assert not _is_concatenable({'a': np.arange(3)})
+    assert not _is_concatenable({1: np.arange(3), 2: np.zeros(2)})
+    assert not _is_concatenable({1: np.zeros((3, 2)), 2: np.zeros((3, 3))})
+    assert not _is_concatenable({1: np.array(0)})
+    assert not _is_concatenable({1: [0, 1]})
+
+
+def test_save_load_concatenated(tempdir):
+    path = op.join(tempdir, 'spc.arrays')
+
+    # SpikesPerCluster.
+    spc = _spikes_per_cluster(np.array([3, 1, 1, 7, 3, 3]))
+    spc.remove([7])
+    save_concatenated(path, spc)
+    out = load_concatenated(path)
+    assert isinstance(out, SpikesPerCluster)
+    assert out.keys() == [1, 3]
+    ae(out[3], [0, 4, 5])
+    assert isinstance(out[1], np.memmap)
+
+    # The loaded structure can be updated.
+    out.add([6, 7], [2, 3])
+    out.remove([1])
+    assert out.keys() == [2, 3]
+    ae(out[3], [0, 4, 5, 7])
+    # The files are not modified.
+    ae(load_concatenated(path)[1], [1, 2])
+
+    # Dict of arrays.
+    d = {5: np.random.rand(3, 2), 2: np.random.rand(0, 2),
+         4: np.random.rand(1, 2)}
+    save_concatenated(path, d)
+    out = load_concatenated(path)
+    assert sorted(out) == [2, 4, 5]
+    for k in d:
+        ae(out[k], d[k])
+
+    out = load_concatenated(path, mmap_mode=None)
+    assert not isinstance(out[5], np.memmap)
+
+    # Empty dict.
+    save_concatenated(path, {})
+    assert load_concatenated(path) == {}
+
+    with raises(ValueError):
+        save_concatenated(path, {'a': np.arange(2)})
+
+
+def test_array_store(tempdir):
+    store = ArrayStore(op.join(tempdir, 'store'))
+    assert ('f', 'abc') not in store
+    store.save('f', 'abc', np.arange(5))
+    assert ('f', 'abc') in store
+    ae(store.load('f', 'abc'), np.arange(5))
+    store.clear('f')
+    assert ('f', 'abc') not in store
+
+
+def test_save_versions(tempdir):
+    path = op.join(tempdir, 'obj')
+    save_object(path, np.arange(3))
+    out = load_object(path)
+    # A new version is written next to the current one, whose files may be
+    # in use, and the older versions are removed.
+    save_object(path, np.arange(5))
+    assert os.listdir(path) == ['1']
+    ae(out, np.arange(3))
+    ae(load_object(path), np.arange(5))
+
+    # Stale versions left by previous writes are removed.
+    os.makedirs(op.join(path, '0'))
+    save_object(path, np.arange(7))
+    ae(load_object(path), np.arange(7))
+    assert sorted(os.listdir(path)) == ['2']
+
+    with raises(IOError):
+        load_object(op.join(tempdir, 'missing'))
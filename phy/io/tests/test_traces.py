@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of raw traces."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+from pytest import yield_fixture, raises
+
+from ..array import _concatenate_virtual_arrays
+from ..traces import (RawTraces, read_raw_traces, _as_contiguous_slice,
+                      _select_traces)
+from phy.traces.waveform import WaveformLoader
+
+
+#------------------------------------------------------------------------------
+# Fixtures
+#------------------------------------------------------------------------------
+
+@yield_fixture
+def raw(tempdir):
+    n_samples, n_channels = 100, 10
+    arr = np.random.randint(size=(n_samples, n_channels),
+                            low=-1000, high=1000).astype(np.int16)
+    path = op.join(tempdir, 'traces.dat')
+    # Add a header.
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * 16)
+        arr.tofile(f)
+    yield path, arr
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_contiguous_slice():
+    assert _as_contiguous_slice(np.array([2, 3, 4])) == slice(2, 5, None)
+    ae(_as_contiguous_slice(np.array([2, 4])), [2, 4])
+    assert _as_contiguous_slice(slice(1, 2)) == slice(1, 2)
+
+
+def test_raw_traces_1(raw):
+    path, arr = raw
+    traces = read_raw_traces(path, n_channels=10, dtype=np.int16, offset=16)
+    assert traces.shape == arr.shape
+    assert len(traces) == 100
+    assert traces.dtype == np.float32
+
+    ae(traces[:], arr)
+    ae(traces[10:20], arr[10:20])
+    ae(traces[5], arr[5])
+    ae(traces[-1], arr[-1])
+    ae(traces[-100, 2], arr[-100, 2])
+    with raises(IndexError):
+        traces[100]
+    with raises(IndexError):
+        traces[-101]
+    ae(traces[10:20, 3], arr[10:20, 3])
+    ae(traces[10:20, [1, 2, 3]], arr[10:20, 1:4])
+    ae(traces[10:20, [7, 2]], arr[10:20, [7, 2]])
+    ae(traces[[3, 50, 4]], arr[[3, 50, 4]])
+    ae(traces[[3, 50, 4], [7, 2]], arr[[3, 50, 4]][:, [7, 2]])
+
+    # Preallocated buffer.
+    out = np.zeros((10, 2), dtype=np.float32)
+    traces.get(slice(0, 10), [0, 9], out=out)
+    ae(out, arr[:10, [0, 9]])
+
+
+def test_raw_traces_2(raw):
+    path, arr = raw
+    traces = RawTraces(path, n_channels=10, dtype=np.int16, offset=16,
+                       channels=[8, 1, 5], scaling=.5)
+    assert traces.shape == (100, 3)
+    out = traces[20:30]
+    assert out.dtype == np.float32
+    ac(out, .5 * arr[20:30][:, [8, 1, 5]])
+    ac(traces[20:30, 1:], .5 * arr[20:30][:, [1, 5]])
+
+    # Virtual concatenation.
+    c = _concatenate_virtual_arrays([traces, traces])
+    assert c.shape == (200, 3)
+    ac(c[95:105], .5 * np.vstack((arr[95:], arr[:5]))[:, [8, 1, 5]])
+
+
+def test_concatenated_raw_traces(raw):
+    path, arr = raw
+    traces = RawTraces(path, n_channels=10, dtype=np.int16, offset=16,
+                       scaling=.5)
+    c = _concatenate_virtual_arrays([traces, traces], cols=[9, 4, 6, 2],
+                                    scaling=2.)
+    assert c.dtype == np.float32
+    full = np.vstack((arr, arr))[:, [9, 4, 6, 2]]
+
+    # Only the requested columns are read in the underlying arrays.
+    cols = []
+    get = RawTraces.get
+
+    def _get(self, rows, cols_=None, out=None):
+        cols.append(cols_)
+        return get(self, rows, cols_, out=out)
+    RawTraces.get = _get
+    try:
+        out = _select_traces(c, slice(95, 105), [2, 0])
+        assert out.dtype == np.float32
+        ae(out, full[95:105, [2, 0]])
+        ae(cols[0], [6, 9])
+        assert len(cols) == 2
+
+        out = c[[150, 3, 101, 99], [1, 3]]
+        assert out.dtype == np.float32
+        ae(out, full[[150, 3, 101, 99]][:, [1, 3]])
+        ae(cols[-1], [4, 2])
+    finally:
+        RawTraces.get = get
+
+    ae(c[98:102, 1], full[98:102, 1])
+    ae(c[:], full)
+    assert c[:0].shape == (0, 4)
+    assert c[[]].shape == (0, 4)
+
+    # Integer arrays are scaled into float32 arrays.
+    c = _concatenate_virtual_arrays([arr, arr], cols=[9, 4], scaling=.5)
+    assert c.dtype == np.float32
+    out = c[95:105, [1]]
+    assert out.dtype == np.float32
+    ac(out, .5 * full[95:105, [1]])
+    ac(c[[101, 3]], .5 * full[[101, 3]][:, :2])
+
+
+def test_raw_traces_waveform_loader(raw):
+    path, arr = raw
+    traces = RawTraces(path, n_channels=10, dtype=np.int16, offset=16)
+    loader = WaveformLoader(traces=traces,
+                            spike_samples=[10, 50, 90],
+                            n_samples_waveforms=(2, 3),
+                            )
+    w = loader.get([1], channels=[4, 6])
+    assert w.shape == (1, 5, 2)
+    ae(w[0], arr[48:53, [4, 6]])
+
+
+def test_concatenated_cols_waveform_loader(raw):
+    path, arr = raw
+    traces = RawTraces(path, n_channels=10, dtype=np.int16, offset=16)
+    c = _concatenate_virtual_arrays([traces, traces], cols=[9, 4, 6])
+    loader = WaveformLoader(traces=c,
+                            spike_samples=[10, 150, 190],
+                            n_samples_waveforms=(2, 3),
+                            )
+    # The channels are relative to the columns of the virtual array.
+    w = loader.get([1], channels=[1, 2])
+    assert w.shape == (1, 5, 2)
+    ae(w[0], arr[48:53, [4, 6]])
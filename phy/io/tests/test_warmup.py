@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the cache warm-up."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import multiprocessing
+import os.path as op
+
+from click.testing import CliRunner
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from phy.utils import ProgressReporter
+from phy.utils._misc import _write_text
+from ..context import Context
+from ..warmup import warm_caches, _load_spec, WarmCachePlugin
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _make_functions(context):
+
+    @context.memcache
+    def f(cluster_id):
+        return np.arange(cluster_id)
+
+    @context.cache
+    def g(cluster_id):
+        return np.ones(cluster_id)
+
+    return f, g
+
+
+def test_warm_caches_serial(tempdir):
+    context = Context(op.join(tempdir, 'cache'))
+    f, g = _make_functions(context)
+
+    with raises(ValueError):
+        warm_caches(context, [lambda c: c], [1])
+
+    pr = ProgressReporter()
+    info = warm_caches(context, [f, g], range(5), n_jobs=1,
+                       progress_reporter=pr)
+    assert info.n_tasks == 10
+    assert info.n_done == 10
+    assert info.complete
+    assert pr.value == 10
+    assert f.is_cached(3)
+    assert g.is_cached(3)
+    ae(f(3), np.arange(3))
+
+    # The second time, everything is already cached.
+    info = warm_caches(context, [f, g], range(5), n_jobs=1)
+    assert info.n_skipped == 10
+    assert info.n_done == 0
+
+
+def test_warm_caches_parallel(tempdir, monkeypatch):
+    n_pools = []
+    pool = multiprocessing.Pool
+
+    def _pool(*args, **kwargs):
+        n_pools.append(args)
+        return pool(*args, **kwargs)
+    monkeypatch.setattr(multiprocessing, 'Pool', _pool)
+
+    context = Context(op.join(tempdir, 'cache'))
+    f, g = _make_functions(context)
+    info = warm_caches(context, [f, g], range(10), n_jobs=2, batch_size=3)
+    # A single pool is used for all batches.
+    assert len(n_pools) == 1
+    assert info.n_done == 20
+    assert info.nbytes > 0
+    for cluster_id in range(10):
+        assert f.is_cached(cluster_id)
+        assert g.is_cached(cluster_id)
+
+    # The memcache has been saved.
+    context = Context(op.join(tempdir, 'cache'))
+    f, g = _make_functions(context)
+    assert f.is_cached(9)
+    ae(f(9), np.arange(9))
+
+
+def test_warm_caches_budget(tempdir):
+    context = Context(op.join(tempdir, 'cache'))
+    f, g = _make_functions(context)
+    info = warm_caches(context, [f, g], range(10), n_jobs=1, time_budget=0)
+    assert info.n_done == 0
+    assert not info.complete
+
+    info = warm_caches(context, [f, g], range(10), n_jobs=1,
+                       batch_size=4, size_budget=1)
+    assert info.n_done == 4
+
+    # Resume.
+    info = warm_caches(context, [f, g], range(10), n_jobs=1)
+    assert info.n_skipped == 4
+    assert info.n_done == 16
+
+
+def test_warm_cache_cli(tempdir):
+    script = """
+        import numpy as np
+        from phy.io import Context
+
+        def warmup():
+            context = Context('{cache}')
+
+            @context.memcache
+            def f(cluster_id):
+                return np.arange(cluster_id)
+
+            return dict(context=context, functions=[f], cluster_ids=[1, 2])
+    """.replace('\n        ', '\n').format(cache=op.join(tempdir, 'cache'))
+    path = op.join(tempdir, 'warmup_script.py')
+    _write_text(path, script)
+    assert _load_spec(path + ':warmup')
+    with raises(ValueError):
+        _load_spec(path)
+
+    import click
+
+    @click.group()
+    def cli():
+        pass
+
+    WarmCachePlugin().attach_to_cli(cli)
+    runner = CliRunner()
+    result = runner.invoke(cli, ['warm-cache', path + ':warmup',
+                                 '--n-jobs', '1'])
+    assert result.exit_code == 0
+    assert '2 tasks done' in result.output
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""Raw traces in flat binary files."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+import os.path as op
+
+import numpy as np
+
+from phy.utils._types import _is_integer
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utility functions
+#------------------------------------------------------------------------------
+
+def _as_contiguous_slice(cols):
+    """Return an equivalent slice if an array of indices is contiguous,
+    so that the columns can be selected without making a copy."""
+    if isinstance(cols, slice) or len(cols) == 0:
+        return cols
+    if np.all(np.diff(cols) == 1):
+        return slice(int(cols[0]), int(cols[-1]) + 1, None)
+    return cols
+
+
+def _n_samples_in_file(path, n_channels=None, dtype=None, offset=0):
+    """Number of complete samples in a flat binary file."""
+    item_size = np.dtype(dtype).itemsize
+    n_bytes = op.getsize(path) - offset
+    n_samples = n_bytes // (item_size * n_channels)
+    if n_samples * item_size * n_channels != n_bytes:
+        logger.warn("The file `%s` does not contain a whole number of "
+                    "samples: the last incomplete sample is discarded.",
+                    path)
+    return n_samples
+
+
+#------------------------------------------------------------------------------
+# Raw traces
+#------------------------------------------------------------------------------
+
+class RawTraces(object):
+    """Memory-mapped raw traces stored in a flat binary file.
+
+    Only the requested rows and columns are read from disk. The column
+    selection, the conversion to `float32`, and the scaling are done in a
+    single pass into a preallocated buffer.
+
+    Parameters
+    ----------
+
+    path : str
+        Path to the binary file.
+    n_channels : int
+        Total number of channels in the file.
+    dtype : dtype
+        Data type of the raw data in the file.
+    offset : int
+        Size of the header, in bytes.
+    channels : array-like
+        Subset of channels to expose. By default, all channels are exposed.
+    scaling : float
+        Scaling factor applied to the raw values.
+
+    """
+    def __init__(self, path, n_channels=None, dtype=None, offset=0,
+                 channels=None, scaling=None):
+        assert n_channels > 0
+        self.path = path
+        self.n_channels_file = n_channels
+        self.raw_dtype = np.dtype(dtype or np.int16)
+        self.offset = offset
+        self.scaling = scaling
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+        self.n_samples = _n_samples_in_file(path,
+                                            n_channels=n_channels,
+                                            dtype=self.raw_dtype,
+                                            offset=offset)
+        if self.n_samples > 0:
+            self._raw = np.memmap(path, dtype=self.raw_dtype, mode='r',
+                                  offset=offset,
+                                  shape=(self.n_samples, n_channels))
+        else:
+            self._raw = np.zeros((0, n_channels), dtype=self.raw_dtype)
+        if channels is not None:
+            channels = np.asarray(channels, dtype=np.int64)
+            assert np.all((0 <= channels) & (channels < n_channels))
+        self.channels = channels
+
+    @property
+    def n_channels(self):
+        """Number of exposed channels."""
+        if self.channels is None:
+            return self.n_channels_file
+        return len(self.channels)
+
+    @property
+    def shape(self):
+        return (self.n_samples, self.n_channels)
+
+    def __len__(self):
+        return self.n_samples
+
+    def _file_columns(self, cols=None):
+        """Return the columns to read in the file."""
+        if self.channels is None:
+            out = cols if cols is not None else slice(None, None, None)
+        else:
+            out = self.channels[cols] if cols is not None else self.channels
+        if _is_integer(out):
+            out = [out]
+        if not isinstance(out, slice):
+            out = _as_contiguous_slice(np.asarray(out, dtype=np.int64))
+        return out
+
+    def get(self, rows, cols=None, out=None):
+        """Load some rows and columns of the traces.
+
+        Parameters
+        ----------
+
+        rows : slice, integer, or array-like
+            Samples to load.
+        cols : slice, integer, or array-like
+            Channels to load, relative to the exposed channels.
+        out : ndarray
+            An optional preallocated `float32` buffer with the right shape.
+
+        """
+        squeeze_row = _is_integer(rows)
+        squeeze_col = _is_integer(cols)
+        if squeeze_row:
+            row = int(rows)
+            if not -self.n_samples <= row < self.n_samples:
+                raise IndexError("Sample {} is out of bounds ".format(row) +
+                                 "for {} samples.".format(self.n_samples))
+            row %= self.n_samples
+            rows = slice(row, row + 1, None)
+        file_cols = self._file_columns(cols)
+        if isinstance(rows, slice):
+            # The row slice is a view: only the column selection makes a copy
+            # of the raw data (in the raw data type).
+            sub = self._raw[rows][:, file_cols]
+        else:
+            rows = np.asarray(rows)
+            if rows.dtype == np.bool_:
+                rows = np.nonzero(rows)[0]
+            if isinstance(file_cols, slice):
+                sub = self._raw[rows, file_cols]
+            else:
+                sub = self._raw[np.ix_(rows, file_cols)]
+        if out is None:
+            out = np.empty(sub.shape, dtype=self.dtype)
+        assert out.shape == sub.shape
+        # Single pass: conversion to float32 and scaling.
+        if self.scaling is not None and self.scaling != 1:
+            np.multiply(sub, np.float32(self.scaling), out=out,
+                        casting='unsafe')
+        else:
+            out[...] = sub
+        if squeeze_row:
+            out = out[0]
+        if squeeze_col:
+            out = out[..., 0]
+        return out
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            assert 1 <= len(item) <= 2
+            rows = item[0]
+            cols = item[1] if len(item) == 2 else None
+        else:
+            rows, cols = item, None
+        if isinstance(cols, slice) and cols == slice(None, None, None):
+            cols = None
+        return self.get(rows, cols)
+
+
+def _select_traces(traces, rows, cols=None):
+    """Select some rows and columns of a traces array.
+
+    The selection is done at once with `RawTraces` and virtual arrays, so
+    that only the requested channels are read and converted. Other arrays
+    (NumPy arrays, HDF5 datasets...) are indexed in two steps.
+
+    """
+    from .array import ConcatenatedArrays
+    if cols is None:
+        return traces[rows]
+    if isinstance(traces, (RawTraces, ConcatenatedArrays)):
+        return traces[rows, cols]
+    return traces[rows][:, cols]
+
+
+def read_raw_traces(path, n_channels=None, dtype=None, offset=0,
+                    channels=None, scaling=None):
+    """Open a flat binary file with raw traces."""
+    return RawTraces(path,
+                     n_channels=n_channels,
+                     dtype=dtype,
+                     offset=offset,
+                     channels=channels,
+                     scaling=scaling,
+                     )
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""Precompute the cached per-cluster data of a dataset."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from importlib import import_module
+import logging
+import multiprocessing
+import os.path as op
+import sys
+import time
+
+from phy.utils import Bunch, ProgressReporter
+from phy.utils._misc import _fullname
+from phy.utils.plugin import IPlugin, _load_source
+from .memcache import _nbytes
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Cache warm-up
+#------------------------------------------------------------------------------
+
+# NOTE: the cached functions are closures that cannot be pickled. They are
+# passed to the worker processes when they are forked, by the pool
+# initializer, so that the tasks only contain the index of the function and
+# the cluster id.
+_FUNCTIONS = []
+
+
+def _can_fork():
+    get_start_method = getattr(multiprocessing, 'get_start_method', None)
+    if get_start_method is not None:
+        return get_start_method() == 'fork'
+    return sys.platform != 'win32'  # pragma: no cover
+
+
+def _set_functions(functions):
+    """Pool initializer."""
+    _FUNCTIONS[:] = functions
+
+
+def _run_task(task):
+    """Compute a cached function on a cluster.
+
+    The results of memcached functions are returned so that they can be
+    put in the memory cache of the main process. The results of disk-cached
+    functions are saved to disk by the worker.
+
+    """
+    i, cluster_id = task
+    f = _FUNCTIONS[i]
+    if hasattr(f, 'set_cached'):
+        out = f.function(cluster_id)
+        return out, _nbytes(out)
+    out = f(cluster_id)
+    return None, _nbytes(out)
+
+
+def warm_caches(context, functions, cluster_ids, n_jobs=None,
+                batch_size=None, time_budget=None, size_budget=None,
+                progress_reporter=None):
+    """Populate the caches of per-cluster functions ahead of time.
+
+    Calls that are already cached are skipped, so that an interrupted
+    warm-up resumes where it stopped. A single pool of processes is used,
+    and the memcached results are appended to the memcache files as soon as
+    they are received.
+
+    Parameters
+    ----------
+
+    context : Context
+        The context used to cache the functions.
+    functions : list
+        Functions `cluster_id => value` decorated with `context.cache()` or
+        `context.memcache()`.
+    cluster_ids : array-like
+        The clusters to process.
+    n_jobs : int
+        Number of processes. By default, all cores are used.
+    batch_size : int
+        Number of tasks between two checks of the budgets.
+    time_budget : float
+        Stop after this duration, in seconds.
+    size_budget : int
+        Stop when the size of the computed data exceeds this value, in
+        bytes.
+    progress_reporter : ProgressReporter
+        Incremented after every task.
+
+    Returns
+    -------
+
+    info : Bunch
+        The number of tasks `n_tasks`, the number of tasks that were already
+        cached `n_skipped`, the number of computed tasks `n_done`, the size of
+        the computed data `nbytes`, and whether all tasks are done
+        `complete`.
+
+    """
+    for f in functions:
+        if not hasattr(f, 'is_cached'):
+            raise ValueError("The function `{}` is not ".format(_fullname(f)) +
+                             "cached by the context.")
+    tasks = [(i, int(cluster_id)) for cluster_id in cluster_ids
+             for i in range(len(functions))]
+    todo = [(i, c) for (i, c) in tasks if not functions[i].is_cached(c)]
+    logger.debug("Warm-up: %d tasks, %d already cached.",
+                 len(tasks), len(tasks) - len(todo))
+
+    if not _can_fork():  # pragma: no cover
+        n_jobs = 1
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(todo)))
+    batch_size = batch_size or 16 * n_jobs
+    if progress_reporter is not None:
+        progress_reporter.value_max = progress_reporter.value + len(todo)
+
+    t0 = time.time()
+    n_done = 0
+    nbytes = 0
+    results = context.imap(_run_task, todo, n_jobs=n_jobs,
+                           batch_size=batch_size,
+                           initializer=_set_functions,
+                           initargs=(functions,))
+    try:
+        for j, cluster_id in todo:
+            # NOTE: the next batch is only sent to the processes when its
+            # first result is requested.
+            if n_done % batch_size == 0:
+                if (time_budget is not None and
+                        time.time() - t0 >= time_budget):
+                    logger.info("Warm-up time budget exceeded.")
+                    break
+                if size_budget is not None and nbytes >= size_budget:
+                    logger.info("Warm-up size budget exceeded.")
+                    break
+            out, size = next(results)
+            if out is not None:
+                functions[j].set_cached(out, cluster_id, persist=True)
+            nbytes += size
+            n_done += 1
+            if progress_reporter is not None:
+                progress_reporter.increment()
+    finally:
+        results.close()
+        _FUNCTIONS[:] = []
+        context.save_memcache()
+    return Bunch(n_tasks=len(tasks),
+                 n_skipped=len(tasks) - len(todo),
+                 n_done=n_done,
+                 nbytes=nbytes,
+                 complete=n_done == len(todo),
+                 )
+
+
+#------------------------------------------------------------------------------
+# CLI
+#------------------------------------------------------------------------------
+
+def _load_spec(spec):
+    """Return the object designated by `path/to/file.py:name` or
+    `module:name`."""
+    if ':' not in spec:
+        raise ValueError("The specification should be `file.py:name` or "
+                         "`module:name`.")
+    path, name = spec.rsplit(':', 1)
+    if path.endswith('.py'):
+        path = op.realpath(op.expanduser(path))
+        modname = op.splitext(op.basename(path))[0]
+        mod = _load_source(modname, path)
+    else:
+        mod = import_module(path)
+    return getattr(mod, name)
+
+
+class WarmCachePlugin(IPlugin):
+    """Add a `phy warm-cache` command to precompute per-cluster data."""
+    def attach_to_cli(self, cli):
+        import click
+
+        @cli.command('warm-cache')
+        @click.argument('spec')
+        @click.option('--n-jobs', type=int, default=None,
+                      help='Number of processes (all cores by default).')
+        @click.option('--time-budget', type=float, default=None,
+                      help='Maximum duration, in seconds.')
+        @click.option('--size-budget', type=float, default=None,
+                      help='Maximum size of the computed data, in MB.')
+        def warm_cache(spec, n_jobs=None, time_budget=None,
+                       size_budget=None):
+            """Precompute the cached per-cluster data of a dataset.
+
+            SPEC is `path/to/file.py:name` or `module:name`, a function
+            returning a dictionary with a `context`, a list of cached
+            `functions`, and the `cluster_ids`.
+
+            """
+            d = _load_spec(spec)()
+            pr = ProgressReporter()
+            pr.set_progress_message("Warming up the caches: {progress:.1f}%.")
+            pr.set_complete_message("The caches are warm.")
+            size_budget = (size_budget * 1024 ** 2
+                           if size_budget is not None else None)
+            info = warm_caches(d['context'], d['functions'], d['cluster_ids'],
+                               n_jobs=n_jobs,
+                               time_budget=time_budget,
+                               size_budget=size_budget,
+                               progress_reporter=pr,
+                               )
+            click.echo("{n_done} tasks done, {n_skipped} already cached, "
+                       "{nbytes} bytes computed.".format(**info))
+            if not info.complete:
+                click.echo("The warm-up is incomplete: run the command "
+                           "again to resume it.")
@@ -44,6 +44,11 @@ class BaseVisual(object):
     """Data variables that can be lists of arrays."""
     allow_list = ()
 
+    """Data variables that are transformed on the CPU: they keep their
+    precision when the items are concatenated, the other floating-point
+    variables are concatenated in single precision."""
+    cpu_list = ('x', 'y', 'pos', 'data_bounds', 'hist', 'ylim')
+
     def __init__(self):
         self.gl_primitive_type = None
         self.transforms = TransformChain()
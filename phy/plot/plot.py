@@ -182,8 +182,12 @@ class View(BaseCanvas):
         """
         for cls, data_list in self._items.items():
             # Some variables are not concatenated. They are specified
-            # in `allow_list`.
-            data = _accumulate(data_list, cls.allow_list)
+            # in `allow_list`. The vertex attributes are written directly
+            # in single precision buffers.
+            data = _accumulate(data_list, cls.allow_list,
+                               dtype=np.float32,
+                               keep_dtype=cls.cpu_list,
+                               )
             box_index = data.pop('box_index')
             visual = cls()
             self.add_visual(visual)
@@ -192,7 +196,8 @@ class View(BaseCanvas):
             # so we can replace this with `if 'a_box_index' in visual.program`
             # after the next VisPy release.
             if 'a_box_index' in visual.program._code_variables:
-                visual.program['a_box_index'] = box_index.astype(np.float32)
+                box_index = box_index.astype(np.float32, copy=False)
+                visual.program['a_box_index'] = box_index
         # TODO: refactor this when there is the possibility to update existing
         # visuals without recreating the whole scene.
         if self.lasso:
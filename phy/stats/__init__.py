@@ -3,4 +3,10 @@
 
 """Statistics functions."""
 
-from .ccg import correlograms
+from .ccg import (correlograms, subset_correlograms, CorrelogramCache,
+                  MultiResolutionCorrelograms, multi_resolution_correlograms,
+                  chunked_correlograms, SparseCorrelograms)
+from .grouped import grouped_reductions
+from .quality import spike_train_metrics, ClusterMetrics
+from .clusters import (SimilarityMatrix, SpatialClusterIndex,
+                       ClusterStatistics, BestChannels)
@@ -6,10 +6,20 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from collections import defaultdict, OrderedDict
+import logging
+import multiprocessing
+import shutil
+import tempfile
+
 import numpy as np
 
 from phy.utils._types import _as_array
-from phy.io.array import _index_of, _unique
+from phy.io.array import (_index_of, _unique, _spikes_per_cluster,
+                          _ClusteringListener, _merged_parents)
+from phy.io.context import Context
+
+logger = logging.getLogger(__name__)
 
 
 #------------------------------------------------------------------------------
@@ -175,3 +185,926 @@ def correlograms(spike_times,
         return _symmetrize_correlograms(correlograms)
     else:
         return correlograms
+
+
+#------------------------------------------------------------------------------
+# Cross-correlograms of a subset of clusters
+#------------------------------------------------------------------------------
+
+def _subset_spikes(spike_clusters, cluster_ids, spikes_per_cluster=None):
+    """Return the sorted spikes of some clusters, and the relative index of
+    their clusters in `cluster_ids`."""
+    cluster_ids = _as_array(cluster_ids)
+    if spikes_per_cluster is None:
+        spike_clusters = _as_array(spike_clusters)
+        spikes = np.nonzero(np.in1d(spike_clusters, cluster_ids))[0]
+        return spikes, _index_of(spike_clusters[spikes], cluster_ids)
+    spikes = [spikes_per_cluster[c] for c in cluster_ids]
+    clusters_i = np.repeat(np.arange(len(cluster_ids)),
+                           [len(s) for s in spikes])
+    spikes = np.concatenate(spikes or [[]]).astype(np.int64)
+    order = np.argsort(spikes, kind='mergesort')
+    return spikes[order], clusters_i[order]
+
+
+def _range_pairs(firsts, lo, hi, max_pairs=None):
+    """Yield the pairs `(firsts[k], j)` with `lo[k] <= j < hi[k]`, by chunks
+    of at most `max_pairs` pairs (except if a single item has more
+    pairs)."""
+    n = len(firsts)
+    counts = hi - lo
+    cum = np.cumsum(counts)
+    max_pairs = max_pairs or max(1, int(cum[-1]) if n else 1)
+    start = 0
+    while start < n:
+        before = cum[start - 1] if start > 0 else 0
+        stop = np.searchsorted(cum, before + max_pairs, side='right')
+        stop = min(n, max(stop, start + 1))
+        c = counts[start:stop]
+        m = int(c.sum())
+        if m:
+            # Rank of every pair among the pairs of its first item.
+            k = np.arange(m) - np.repeat(np.cumsum(c) - c, c)
+            yield (np.repeat(firsts[start:stop], c),
+                   np.repeat(lo[start:stop], c) + k)
+        start = stop
+
+
+def _window_pairs(spike_samples, max_delay, max_pairs=None, n_first=None):
+    """Yield the pairs of spikes `i < j` with
+    `spike_samples[j] - spike_samples[i] < max_delay`, by chunks of at most
+    `max_pairs` pairs (except if a single spike has more neighbours).
+
+    If `n_first` is specified, only the pairs with `i < n_first` are
+    yielded.
+
+    """
+    n = len(spike_samples) if n_first is None else n_first
+    firsts = np.arange(n)
+    # Index of the first spike after the window of every spike.
+    ends = np.searchsorted(spike_samples, spike_samples[:n] + max_delay,
+                           side='left')
+    return _range_pairs(firsts, firsts + 1, ends, max_pairs=max_pairs)
+
+
+def _selected_pairs(spike_samples, selected, max_delay, max_pairs=None):
+    """Yield the pairs of spikes `i < j` within the window where spike `i`
+    or spike `j` is selected, without going through the other pairs."""
+    firsts = np.nonzero(selected)[0]
+    samples = spike_samples[firsts]
+    # Pairs where the first spike is selected.
+    ends = np.searchsorted(spike_samples, samples + max_delay, side='left')
+    for i, j in _range_pairs(firsts, firsts + 1, ends, max_pairs=max_pairs):
+        yield i, j
+    # Pairs where only the second spike is selected.
+    starts = np.searchsorted(spike_samples, samples - max_delay,
+                             side='right')
+    for j, i in _range_pairs(firsts, starts, firsts, max_pairs=max_pairs):
+        keep = ~selected[i]
+        yield i[keep], j[keep]
+
+
+def subset_correlograms(spike_times,
+                        spike_clusters,
+                        cluster_ids,
+                        spikes_per_cluster=None,
+                        sample_rate=1.,
+                        bin_size=None,
+                        window_size=None,
+                        symmetrize=True,
+                        max_pairs=1 << 22,
+                        method='auto',
+                        ):
+    """Compute the pairwise cross-correlograms of a few clusters, without
+    processing the spikes of the other clusters.
+
+    The output is identical to the output of `correlograms()` called on the
+    spikes of the requested clusters. With the exact method, the window
+    neighbours of every spike are found with a binary search in the sorted
+    times of the subset, and all pairs are binned with a single `bincount()`
+    per chunk of pairs. With large windows and high firing rates, the spike
+    trains are cross-correlated with FFTs instead (`method='fft'`), and the
+    lags are summed into bins.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        Increasing spike times of all spikes, in seconds.
+    spike_clusters : array-like
+        Spike-cluster mapping of all spikes. Only used if
+        `spikes_per_cluster` is not specified.
+    cluster_ids : array-like
+        The requested clusters. That order will be used in the output array.
+    spikes_per_cluster : dict-like
+        The sorted spikes of every cluster, used to pull in the spikes of
+        the requested clusters without scanning `spike_clusters`.
+    sample_rate : float
+        The sample rate.
+    bin_size : float
+        Size of the bin, in seconds.
+    window_size : float
+        Size of the window, in seconds.
+    max_pairs : int
+        Maximum number of spike pairs binned at once, to bound the memory.
+    method : str
+        `auto` (default) to choose the fastest method from the number of
+        pairs of spikes within the window, `exact`, or `fft`. Both methods
+        give the same counts.
+
+    Returns
+    -------
+
+    correlograms : array
+        A `(n_clusters, n_clusters, winsize_samples)` array with all pairwise
+        CCGs.
+
+    """
+    counts = _subset_counts(spike_times, spike_clusters, cluster_ids,
+                            spikes_per_cluster=spikes_per_cluster,
+                            sample_rate=sample_rate,
+                            bin_size=bin_size,
+                            window_size=window_size,
+                            max_pairs=max_pairs,
+                            method=method,
+                            )
+    return _finalize_correlograms(counts, symmetrize=symmetrize)
+
+
+def _ccg_bins(sample_rate, bin_size, window_size):
+    """Return the bin size in samples, and the number of bins of the
+    one-sided correlograms."""
+    assert sample_rate > 0.
+    binsize = int(sample_rate * np.clip(bin_size, 1e-5, 1e5))
+    assert binsize >= 1
+    window_size = np.clip(window_size, 1e-5, 1e5)
+    winsize_bins = 2 * int(.5 * window_size / bin_size) + 1
+    return binsize, winsize_bins // 2 + 1
+
+
+def _exact_counts(spike_samples, clusters_i, n_clusters, binsize, n_bins,
+                  max_pairs=None, block=None):
+    """Bin the delays of all pairs of spikes within the window, or only of
+    the pairs with a cluster in `block`."""
+    counts = np.zeros(n_clusters * n_clusters * n_bins, dtype=np.int64)
+    # A delay is in the window iff `delay // binsize < n_bins`.
+    if block is None:
+        pairs = _window_pairs(spike_samples, n_bins * binsize,
+                              max_pairs=max_pairs)
+    else:
+        selected = np.in1d(clusters_i, block)
+        pairs = _selected_pairs(spike_samples, selected, n_bins * binsize,
+                                max_pairs=max_pairs)
+    for i, j in pairs:
+        d = (spike_samples[j] - spike_samples[i]) // binsize
+        indices = ((clusters_i[i] * n_clusters + clusters_i[j]) * n_bins +
+                   d)
+        counts += np.bincount(indices, minlength=len(counts))
+    return counts.reshape((n_clusters, n_clusters, n_bins))
+
+
+def _fft_size(binsize, n_bins):
+    """Return the size of the FFTs of the spike trains, and the number of
+    samples of the chunks of time correlated at once."""
+    window = n_bins * binsize
+    # The spike trains of a chunk are zero-padded with a window, so that the
+    # lags within the window do not wrap around.
+    size = 1 << int(np.ceil(np.log2(max(4 * window, 1 << 12))))
+    return size, size - window
+
+
+def _spike_trains(spike_samples, clusters_i, n_clusters, size):
+    """Return the `(n_clusters, size)` spike trains at sample resolution."""
+    indices = clusters_i * size + spike_samples
+    trains = np.bincount(indices, minlength=n_clusters * size)
+    return trains.reshape((n_clusters, size)).astype(np.float64)
+
+
+def _fft_counts(spike_samples, clusters_i, n_clusters, binsize, n_bins,
+                block=None):
+    """Cross-correlate the spike trains with FFTs, or only the pairs with a
+    cluster in `block`.
+
+    The spike trains are cross-correlated at sample resolution, by chunks of
+    time, and the lags are summed into bins, so that the counts are the
+    same as with the exact method. The pairs of spikes with identical times
+    are counted with the exact method.
+
+    """
+    counts = np.zeros((n_clusters, n_clusters, n_bins), dtype=np.int64)
+    # Pairs of spikes with identical times, counted in the order of the
+    # spikes.
+    counts[..., 0] = _exact_counts(spike_samples, clusters_i, n_clusters,
+                                   1, 1, block=block)[..., 0]
+    if not len(spike_samples):
+        return counts
+    window = n_bins * binsize
+    size, chunk = _fft_size(binsize, n_bins)
+    samples = spike_samples - spike_samples[0]
+    # First lag of every bin.
+    edges = np.arange(0, window, binsize)
+    for start in np.unique(samples // chunk) * chunk:
+        # The first spike of a pair is in the chunk, the second spike is
+        # in the chunk or less than a window after it.
+        i0, i1, i2 = np.searchsorted(samples, [start, start + chunk,
+                                               start + chunk + window])
+        firsts = np.fft.rfft(_spike_trains(samples[i0:i1] - start,
+                                           clusters_i[i0:i1],
+                                           n_clusters, size), axis=1)
+        seconds = np.fft.rfft(_spike_trains(samples[i0:i2] - start,
+                                            clusters_i[i0:i2],
+                                            n_clusters, size), axis=1)
+        for i in range(n_clusters):
+            cols = np.arange(n_clusters)
+            if block is not None and i not in block:
+                cols = np.asarray(block)
+            # The lag `l` of `corr[j]` counts the pairs (spike of cluster
+            # `i`, spike of cluster `j` `l` samples later).
+            corr = np.fft.irfft(np.conj(firsts[i]) * seconds[cols], size,
+                                axis=1)
+            corr = np.rint(corr[:, :window]).astype(np.int64)
+            corr[:, 0] = 0
+            counts[i, cols] += np.add.reduceat(corr, edges, axis=1)
+    return counts
+
+
+# Relative cost of a pair of spikes in the exact method, and of one
+# element of a FFT (per log2 of its size).
+_EXACT_COST_RATIO = 30.
+
+
+def _choose_method(spike_samples, n_clusters, binsize, n_bins):
+    """Choose the fastest method from the number of pairs of spikes within
+    the window and the number of chunks of the spike trains."""
+    if not len(spike_samples):
+        return 'exact'
+    ends = np.searchsorted(spike_samples, spike_samples + n_bins * binsize,
+                           side='left')
+    n_pairs = int((ends - np.arange(len(spike_samples)) - 1).sum())
+    size, chunk = _fft_size(binsize, n_bins)
+    n_chunks = len(np.unique((spike_samples - spike_samples[0]) // chunk))
+    fft_cost = (n_chunks * (n_clusters + n_clusters ** 2) *
+                size * np.log2(size))
+    return 'fft' if _EXACT_COST_RATIO * n_pairs > fft_cost else 'exact'
+
+
+def _subset_counts(spike_times, spike_clusters, cluster_ids,
+                   spikes_per_cluster=None, sample_rate=1., bin_size=None,
+                   window_size=None, max_pairs=1 << 22, method='auto',
+                   block=None):
+    """Return the one-sided `(n_clusters, n_clusters, n_bins)` counts of
+    some clusters, with the ACG peaks.
+
+    `counts[i, j, d]` is the number of pairs of spikes where the first spike
+    is in cluster `i` and the second spike in cluster `j`. These counts are
+    additive: the counts of a merged cluster are the sums of the counts of
+    its constituents.
+
+    If `block` is specified, only the counts of the pairs where `i` or `j`
+    is in `block` (relative indices) are computed, and the other counts
+    are zero.
+
+    """
+    binsize, n_bins = _ccg_bins(sample_rate, bin_size, window_size)
+    cluster_ids = _as_array(cluster_ids)
+    n_clusters = len(cluster_ids)
+
+    spikes, clusters_i = _subset_spikes(spike_clusters, cluster_ids,
+                                        spikes_per_cluster=spikes_per_cluster)
+    spike_times = np.asarray(spike_times, dtype=np.float64)[spikes]
+    spike_samples = (spike_times * sample_rate).astype(np.int64)
+    assert np.all(np.diff(spike_samples) >= 0), ("The spike times must be "
+                                                 "increasing.")
+
+    if method == 'auto':
+        method = _choose_method(spike_samples, n_clusters, binsize, n_bins)
+        logger.debug("Compute the correlograms with the %s method.", method)
+    if method == 'fft':
+        return _fft_counts(spike_samples, clusters_i, n_clusters,
+                           binsize, n_bins, block=block)
+    assert method == 'exact'
+    return _exact_counts(spike_samples, clusters_i, n_clusters,
+                         binsize, n_bins, max_pairs=max_pairs, block=block)
+
+
+def _finalize_correlograms(counts, symmetrize=True):
+    """Remove the ACG peaks of one-sided counts, and symmetrize them."""
+    correlograms = counts.astype(np.int32)
+    n_clusters = correlograms.shape[0]
+    correlograms[np.arange(n_clusters),
+                 np.arange(n_clusters),
+                 0] = 0
+    if symmetrize:
+        return _symmetrize_correlograms(correlograms)
+    else:
+        return correlograms
+
+
+#------------------------------------------------------------------------------
+# Multi-resolution correlograms
+#------------------------------------------------------------------------------
+
+def _rebinning_factor(sample_rate, base, bin_size, window_size):
+    """Return the rebinning factor and the number of bins, or None if the
+    parameters are incompatible with the base `(bin_size, window_size)`."""
+    base_binsize, base_n_bins = _ccg_bins(sample_rate, *base)
+    binsize, n_bins = _ccg_bins(sample_rate, bin_size, window_size)
+    if binsize % base_binsize != 0:
+        return
+    k = binsize // base_binsize
+    if n_bins * k > base_n_bins:
+        return
+    return k, n_bins
+
+
+class MultiResolutionCorrelograms(object):
+    """Correlograms computed once at a fine bin size and a large window,
+    from which the correlograms at coarser bins and smaller windows are
+    derived by integer rebinning and cropping.
+
+    The derived correlograms are identical to the ones computed directly
+    with `correlograms()`.
+
+    Parameters
+    ----------
+
+    counts : array
+        The one-sided `(n_clusters, n_clusters, n_bins)` counts at the base
+        resolution, with the ACG peaks (see `_subset_counts()`).
+    cluster_ids : array-like
+        The clusters, in the order of the counts.
+    sample_rate : float
+        The sample rate.
+    bin_size : float
+        The base bin size, in seconds.
+    window_size : float
+        The base window size, in seconds.
+
+    """
+    def __init__(self, counts, cluster_ids, sample_rate=1., bin_size=None,
+                 window_size=None):
+        self.counts = counts
+        self.cluster_ids = _as_array(cluster_ids)
+        self.sample_rate = sample_rate
+        self.bin_size = bin_size
+        self.window_size = window_size
+        self._binsize, self._n_bins = _ccg_bins(sample_rate, bin_size,
+                                                window_size)
+        assert counts.shape == (len(self.cluster_ids),
+                                len(self.cluster_ids),
+                                self._n_bins)
+
+    def _factor(self, bin_size, window_size):
+        return _rebinning_factor(self.sample_rate,
+                                 (self.bin_size, self.window_size),
+                                 bin_size, window_size)
+
+    def is_compatible(self, bin_size, window_size):
+        """Whether some correlograms can be derived from the base
+        resolution: the bin size must be a multiple of the base bin size,
+        and the window must not be larger than the base window."""
+        return self._factor(bin_size, window_size) is not None
+
+    def get(self, bin_size, window_size, symmetrize=True):
+        """Return the `(n_clusters, n_clusters, n_bins)` correlograms at a
+        given resolution, like `correlograms()`."""
+        factor = self._factor(bin_size, window_size)
+        if factor is None:
+            raise ValueError("The bin size {} and window size {} ".format(
+                             bin_size, window_size) +
+                             "are incompatible with the base resolution.")
+        k, n_bins = factor
+        n = len(self.cluster_ids)
+        counts = self.counts[..., :n_bins * k].reshape((n, n, n_bins, k))
+        return _finalize_correlograms(counts.sum(axis=-1),
+                                      symmetrize=symmetrize)
+
+
+def _base_resolution(sample_rate, bin_size=None, window_size=None,
+                     max_bin_size=None):
+    """Return the bin and window sizes of the base resolution."""
+    # NOTE: one sample, rounded up so that it is never truncated to zero.
+    bin_size = bin_size or np.nextafter(1. / sample_rate, np.inf)
+    # The last bin of the one-sided correlograms extends beyond the half
+    # window by up to one bin.
+    max_bin_size = max_bin_size or .1 * window_size
+    return bin_size, window_size + 2 * max_bin_size
+
+
+def multi_resolution_correlograms(spike_times,
+                                  spike_clusters,
+                                  cluster_ids,
+                                  spikes_per_cluster=None,
+                                  sample_rate=1.,
+                                  bin_size=None,
+                                  window_size=None,
+                                  max_bin_size=None,
+                                  ):
+    """Compute the correlograms of some clusters at a base resolution, and
+    return a `MultiResolutionCorrelograms` instance.
+
+    Parameters
+    ----------
+
+    bin_size : float
+        The base bin size, one sample by default so that any bin size can be
+        derived.
+    window_size : float
+        The largest window of interest.
+    max_bin_size : float
+        The largest bin size of interest with that window, a tenth of the
+        window by default.
+
+    The other parameters are the same as in `subset_correlograms()`.
+
+    """
+    bin_size, window_size = _base_resolution(sample_rate,
+                                             bin_size=bin_size,
+                                             window_size=window_size,
+                                             max_bin_size=max_bin_size)
+    counts = _subset_counts(spike_times, spike_clusters, cluster_ids,
+                            spikes_per_cluster=spikes_per_cluster,
+                            sample_rate=sample_rate,
+                            bin_size=bin_size,
+                            window_size=window_size,
+                            )
+    return MultiResolutionCorrelograms(counts, cluster_ids,
+                                       sample_rate=sample_rate,
+                                       bin_size=bin_size,
+                                       window_size=window_size,
+                                       )
+
+
+#------------------------------------------------------------------------------
+# Correlogram cache
+#------------------------------------------------------------------------------
+
+class CorrelogramCache(_ClusteringListener):
+    """Cache the one-sided pairwise correlograms of clusters, keyed by
+    `(cluster_a, cluster_b, bin_size, window_size)`.
+
+    Correlograms are additive: after a merge, the entries of the new cluster
+    are the sums of the entries of its constituents, and its ACG is the sum
+    of their ACGs and of their cross terms. Only the entries of the clusters
+    created by a split are computed, when they are requested.
+
+    Cluster ids are never reused, so that the entries of the deleted
+    clusters are kept for undo and redo. The least recently used entries
+    are evicted when the cache exceeds `max_size`.
+
+    An instance can be passed as the `correlograms` function of the
+    `CorrelogramView`.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        Increasing spike times, in seconds.
+    spike_clusters : array-like
+        The spike-cluster assignment. Only used if `spikes_per_cluster` is
+        not specified.
+    spikes_per_cluster : dict-like
+        The spikes of every cluster.
+    sample_rate : float
+        The sample rate.
+    max_window_size : float
+        If specified, the entries are only computed at a base resolution,
+        and the correlograms at all compatible bin and window sizes are
+        derived from them (see `multi_resolution_correlograms()`).
+    base_bin_size : float
+        The bin size of the base resolution, one sample by default.
+    max_bin_size : float
+        The largest bin size of interest with the largest window.
+    method : str
+        `auto` (default), `exact`, or `fft` (see `subset_correlograms()`).
+    max_size : int
+        Maximum total size of the cached counts, in bytes.
+
+    """
+    def __init__(self, spike_times, spike_clusters=None,
+                 spikes_per_cluster=None, sample_rate=1.,
+                 max_window_size=None, base_bin_size=None,
+                 max_bin_size=None, method='auto', max_size=1 << 28):
+        self.spike_times = np.asarray(spike_times, dtype=np.float64)
+        if spikes_per_cluster is None:
+            spikes_per_cluster = _spikes_per_cluster(spike_clusters)
+        self.spikes_per_cluster = spikes_per_cluster
+        self.sample_rate = sample_rate
+        self.method = method
+        self._base = None
+        if max_window_size:
+            self._base = _base_resolution(sample_rate,
+                                          bin_size=base_bin_size,
+                                          window_size=max_window_size,
+                                          max_bin_size=max_bin_size)
+        self.max_size = max_size
+        # (cluster_a, cluster_b, bin_size, window_size): counts, from the
+        # least to the most recently used.
+        self._ccgs = OrderedDict()
+        self._size = 0
+        # (cluster, bin_size, window_size): set of clusters b with cached
+        # (cluster, b) and (b, cluster) entries.
+        self._partners = defaultdict(set)
+        # Deleted clusters, whose entries are kept for undo.
+        self._deleted = set()
+        self.hits = 0
+        self.misses = 0
+        self.derived = 0
+
+    def __len__(self):
+        return len(self._ccgs)
+
+    def __contains__(self, key):
+        return key in self._ccgs
+
+    def _set(self, a, b, bin_size, window_size, counts):
+        old = self._ccgs.pop((a, b, bin_size, window_size), None)
+        if old is not None:
+            self._size -= old.nbytes
+        self._ccgs[a, b, bin_size, window_size] = counts
+        self._size += counts.nbytes
+        self._partners[a, bin_size, window_size].add(b)
+        self._partners[b, bin_size, window_size].add(a)
+
+    def _get(self, a, b, bin_size, window_size):
+        # Mark the entry as the most recently used one.
+        counts = self._ccgs.pop((a, b, bin_size, window_size))
+        self._ccgs[a, b, bin_size, window_size] = counts
+        return counts
+
+    def _pop(self, a, b, bin_size, window_size):
+        """Remove the entries of a pair of clusters, in both directions."""
+        for key in ((a, b, bin_size, window_size),
+                    (b, a, bin_size, window_size)):
+            counts = self._ccgs.pop(key, None)
+            if counts is not None:
+                self._size -= counts.nbytes
+        for x, y in ((a, b), (b, a)):
+            partners = self._partners.get((x, bin_size, window_size))
+            if partners is not None:
+                partners.discard(y)
+                if not partners:
+                    del self._partners[x, bin_size, window_size]
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in
+        `max_size`."""
+        n = len(self._ccgs)
+        while self._ccgs and self._size > self.max_size:
+            a, b, bin_size, window_size = next(iter(self._ccgs))
+            self._pop(a, b, bin_size, window_size)
+        if len(self._ccgs) < n:
+            logger.debug("Evict %d correlograms from the cache.",
+                         n - len(self._ccgs))
+
+    def _compute(self, cluster_ids, new, bin_size, window_size):
+        """Compute the entries of the new clusters with all clusters."""
+        block = [i for i, c in enumerate(cluster_ids) if c in new]
+        counts = _subset_counts(self.spike_times, None, cluster_ids,
+                                spikes_per_cluster=self.spikes_per_cluster,
+                                sample_rate=self.sample_rate,
+                                bin_size=bin_size,
+                                window_size=window_size,
+                                method=self.method,
+                                block=block,
+                                )
+        for i, a in enumerate(cluster_ids):
+            for j, b in enumerate(cluster_ids):
+                if a in new or b in new:
+                    self._set(a, b, bin_size, window_size, counts[i, j])
+
+    def _counts(self, cluster_ids, bin_size, window_size):
+        """Return the one-sided counts of some clusters, and compute the
+        missing entries."""
+        cluster_ids = [int(c) for c in cluster_ids]
+        n = len(cluster_ids)
+        missing = [(a, b) for a in cluster_ids for b in cluster_ids
+                   if (a, b, bin_size, window_size) not in self._ccgs]
+        self.hits += n * n - len(missing)
+        self.misses += len(missing)
+        # The entries of the clusters without an ACG are computed with all
+        # requested clusters, and the other missing pairs are covered by
+        # one of their clusters. The cached pairs of the other clusters
+        # are not recomputed.
+        new = set(a for a, b in missing if a == b)
+        for a, b in missing:
+            if a not in new and b not in new:
+                new.add(a)
+        if new:
+            self._compute(cluster_ids, new, bin_size, window_size)
+        _, n_bins = _ccg_bins(self.sample_rate, bin_size, window_size)
+        counts = np.zeros((n, n, n_bins), dtype=np.int64)
+        for i, a in enumerate(cluster_ids):
+            for j, b in enumerate(cluster_ids):
+                counts[i, j] = self._get(a, b, bin_size, window_size)
+        self._evict()
+        return counts
+
+    def multi_resolution(self, cluster_ids):
+        """Return a `MultiResolutionCorrelograms` instance with the
+        correlograms of some clusters at the base resolution."""
+        assert self._base
+        bin_size, window_size = self._base
+        counts = self._counts(cluster_ids, bin_size, window_size)
+        return MultiResolutionCorrelograms(counts, cluster_ids,
+                                           sample_rate=self.sample_rate,
+                                           bin_size=bin_size,
+                                           window_size=window_size,
+                                           )
+
+    def __call__(self, cluster_ids, bin_size, window_size, symmetrize=True):
+        """Return the `(n_clusters, n_clusters, n_bins)` correlograms of some
+        clusters, like `correlograms()`."""
+        if self._base:
+            if _rebinning_factor(self.sample_rate, self._base,
+                                 bin_size, window_size) is not None:
+                ccg = self.multi_resolution(cluster_ids)
+                return ccg.get(bin_size, window_size, symmetrize=symmetrize)
+            logger.debug("Bin size %.5f and window size %.5f incompatible "
+                         "with the base resolution.", bin_size, window_size)
+        counts = self._counts(cluster_ids, bin_size, window_size)
+        return _finalize_correlograms(counts, symmetrize=symmetrize)
+
+    def _derive_merge(self, new, parents):
+        """Derive the entries of a merged cluster from its constituents."""
+        params = set(key[2:] for key in self._ccgs)
+        for bin_size, window_size in params:
+            ccgs = self._ccgs
+            partners = [self._partners.get((p, bin_size, window_size), set())
+                        for p in parents]
+            # Existing clusters cached with all constituents.
+            others = (set.intersection(*partners) - set(parents) -
+                      self._deleted)
+            for x in others:
+                self._set(new, x, bin_size, window_size,
+                          sum(ccgs[p, x, bin_size, window_size]
+                              for p in parents))
+                self._set(x, new, bin_size, window_size,
+                          sum(ccgs[x, p, bin_size, window_size]
+                              for p in parents))
+                self.derived += 2
+            if all(set(parents) <= s for s in partners):
+                # The ACG of the merged cluster includes the cross terms.
+                self._set(new, new, bin_size, window_size,
+                          sum(ccgs[p, q, bin_size, window_size]
+                              for p in parents for q in parents))
+                self.derived += 1
+
+    def on_cluster(self, up):
+        """Derive the entries of the merged clusters after a clustering
+        change. The entries of the other new clusters are computed when
+        they are requested."""
+        self._deleted.update(up.deleted)
+        self._deleted.difference_update(up.added)
+        for new, parents in _merged_parents(up).items():
+            self._derive_merge(new, parents)
+        self._evict()
+
+    def clear(self):
+        self._ccgs.clear()
+        self._partners.clear()
+        self._size = 0
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    derived=self.derived,
+                    n_items=len(self._ccgs),
+                    size=self._size,
+                    )
+
+
+#------------------------------------------------------------------------------
+# Chunked correlograms
+#------------------------------------------------------------------------------
+
+# Estimated number of bytes of the temporary arrays per pair of spikes.
+_BYTES_PER_PAIR = 64
+
+
+def _sparse_sum(parts):
+    """Sum sparse vectors given by a list of `(indices, values)` pairs, and
+    return the sorted indices and values of the sum."""
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    idx = np.concatenate([i for i, _ in parts])
+    cnt = np.concatenate([c for _, c in parts])
+    order = np.argsort(idx, kind='mergesort')
+    idx, cnt = idx[order], cnt[order]
+    if not len(idx):
+        return idx, cnt
+    first = np.r_[True, idx[1:] != idx[:-1]]
+    starts = np.nonzero(first)[0]
+    return idx[starts], np.add.reduceat(cnt, starts)
+
+
+def _chunk_counts(args):
+    """Return the sparse counts of the pairs whose first spike is among the
+    first `n_first` spikes of a chunk.
+
+    This function is executed in the worker processes.
+
+    """
+    (spike_samples, clusters_i, n_first,
+     n_clusters, binsize, n_bins, max_pairs) = args
+    size = n_clusters * n_clusters * n_bins
+    # The counts are accumulated in a dense array if it fits in the memory
+    # budget, otherwise in a sparse vector.
+    dense = np.zeros(size, dtype=np.int64) \
+        if 8 * size <= _BYTES_PER_PAIR * max_pairs else None
+    parts = []
+    for i, j in _window_pairs(spike_samples, n_bins * binsize,
+                              max_pairs=max_pairs, n_first=n_first):
+        d = (spike_samples[j] - spike_samples[i]) // binsize
+        indices = ((clusters_i[i] * n_clusters + clusters_i[j]) * n_bins +
+                   d)
+        if dense is not None:
+            dense += np.bincount(indices, minlength=size)
+        else:
+            parts.append(np.unique(indices, return_counts=True))
+    if dense is not None:
+        idx = np.nonzero(dense)[0]
+        return idx, dense[idx]
+    return _sparse_sum(parts)
+
+
+class SparseCorrelograms(object):
+    """One-sided correlograms of the pairs of clusters with at least one
+    count.
+
+    Parameters
+    ----------
+
+    cluster_ids : array
+        The clusters.
+    pairs : array
+        A `(n_pairs, 2)` array with the relative indices of the clusters of
+        every pair, sorted by increasing first and second index.
+    counts : array
+        A `(n_pairs, n_bins)` array with the one-sided correlograms of every
+        pair, without the ACG peaks.
+
+    """
+    def __init__(self, cluster_ids, pairs, counts):
+        self.cluster_ids = _as_array(cluster_ids)
+        self.pairs = pairs
+        self.counts = counts
+        self.n_bins = counts.shape[1]
+        # Sorted keys of the pairs.
+        n = len(self.cluster_ids)
+        self._keys = self.pairs[:, 0] * n + self.pairs[:, 1]
+        assert np.all(np.diff(self._keys) > 0)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def pair(self, cluster_a, cluster_b):
+        """Return the one-sided correlogram of a pair of clusters."""
+        i, j = _index_of(np.array([cluster_a, cluster_b]), self.cluster_ids)
+        key = i * len(self.cluster_ids) + j
+        k = np.searchsorted(self._keys, key)
+        if k == len(self._keys) or self._keys[k] != key:
+            return np.zeros(self.n_bins, dtype=self.counts.dtype)
+        return self.counts[k]
+
+    def to_dense(self, symmetrize=True):
+        """Return the `(n_clusters, n_clusters, n_bins)` array, like
+        `correlograms()`."""
+        n = len(self.cluster_ids)
+        counts = np.zeros((n, n, self.n_bins), dtype=np.int64)
+        counts[self.pairs[:, 0], self.pairs[:, 1]] = self.counts
+        return _finalize_correlograms(counts, symmetrize=symmetrize)
+
+
+def chunked_correlograms(spike_times,
+                         spike_clusters,
+                         cluster_ids=None,
+                         sample_rate=1.,
+                         bin_size=None,
+                         window_size=None,
+                         n_jobs=None,
+                         chunk_size=None,
+                         max_memory=1 << 30,
+                         context=None,
+                         ):
+    """Compute the correlograms of all pairs of clusters in parallel, with a
+    bounded memory usage.
+
+    The spike train is split into time chunks overlapping by one window.
+    Every chunk is processed in a worker process, which returns the sparse
+    counts of the pairs of spikes starting in it. The chunks are sent to
+    `Context.imap()` in batches of `n_jobs` chunks, and the partial counts
+    are added to the total after every batch.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        Increasing spike times, in seconds.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    cluster_ids : array-like
+        The clusters, by default all clusters in `spike_clusters`. The
+        spikes of other clusters are ignored.
+    sample_rate : float
+        The sample rate.
+    bin_size : float
+        Size of the bin, in seconds.
+    window_size : float
+        Size of the window, in seconds.
+    n_jobs : int
+        Number of processes. By default, the number of cores. With
+        `n_jobs=1`, the chunks are processed in the current process.
+    chunk_size : int
+        Number of spikes per chunk. By default, every process receives
+        about four chunks.
+    max_memory : int
+        Approximate ceiling of the memory used by the temporary arrays of
+        all processes and by the accumulated counts, in bytes.
+    context : Context
+        The context used to process the chunks in parallel. By default, a
+        temporary context is created.
+
+    Returns
+    -------
+
+    correlograms : SparseCorrelograms
+        The one-sided correlograms of the pairs with non-zero counts. Use
+        `to_dense()` to get the same array as `correlograms()`.
+
+    """
+    binsize, n_bins = _ccg_bins(sample_rate, bin_size, window_size)
+    spike_clusters = _as_array(spike_clusters)
+    if cluster_ids is None:
+        cluster_ids = _unique(spike_clusters)
+    cluster_ids = _as_array(cluster_ids)
+    n_clusters = len(cluster_ids)
+
+    spikes, clusters_i = _subset_spikes(spike_clusters, cluster_ids)
+    spike_times = np.asarray(spike_times, dtype=np.float64)[spikes]
+    spike_samples = (spike_times * sample_rate).astype(np.int64)
+    assert np.all(np.diff(spike_samples) >= 0), ("The spike times must be "
+                                                 "increasing.")
+    n = len(spike_samples)
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    chunk_size = chunk_size or max(1, -(-n // (4 * n_jobs)))
+    # The accumulated counts, and the partial counts of a batch of n_jobs
+    # chunks, have at most one entry of 16 bytes per bin of every pair:
+    # this size is reserved in the budget.
+    size = n_clusters * n_clusters * n_bins
+    reserved = min(16 * size * (n_jobs + 1), max_memory // 2)
+    max_pairs = max(1, (max_memory - reserved) // (_BYTES_PER_PAIR * n_jobs))
+
+    def _chunk(start):
+        stop = min(n, start + chunk_size)
+        # The chunk is extended by one window.
+        end = np.searchsorted(spike_samples,
+                              spike_samples[stop - 1] + n_bins * binsize,
+                              side='left')
+        return (spike_samples[start:end], clusters_i[start:end],
+                stop - start, n_clusters, binsize, n_bins, max_pairs)
+
+    # The chunks are created lazily.
+    chunks = (_chunk(start) for start in range(0, n, chunk_size))
+    tmp_dir = None
+    if n_jobs == 1:
+        results = (_chunk_counts(chunk) for chunk in chunks)
+    else:
+        logger.debug("Compute the correlograms of %d clusters with %d "
+                     "processes.", n_clusters, n_jobs)
+        if context is None:
+            tmp_dir = tempfile.mkdtemp(prefix='phy-ccg-')
+            context = Context(tmp_dir)
+        results = context.imap(_chunk_counts, chunks, n_jobs=n_jobs,
+                               batch_size=n_jobs)
+    # The partial counts are summed after every batch, so that the memory
+    # usage does not grow with the number of chunks.
+    acc = _sparse_sum([])
+    batch = []
+    try:
+        for part in results:
+            batch.append(part)
+            if len(batch) == n_jobs:
+                acc = _sparse_sum([acc] + batch)
+                batch = []
+        idx, cnt = _sparse_sum([acc] + batch)
+    finally:
+        results.close()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Remove ACG peaks.
+    pair, d = idx // n_bins, idx % n_bins
+    i, j = pair // n_clusters, pair % n_clusters
+    keep = (i != j) | (d != 0)
+    pair, d, cnt = pair[keep], d[keep], cnt[keep]
+
+    # Group the counts by pair.
+    pairs, inv = np.unique(pair, return_inverse=True)
+    counts = np.zeros((len(pairs), n_bins), dtype=np.int64)
+    counts[inv, d] = cnt
+    pairs = np.c_[pairs // n_clusters, pairs % n_clusters]
+    return SparseCorrelograms(cluster_ids, pairs.astype(np.int64), counts)
@@ -6,7 +6,16 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import logging
+
 import numpy as np
+from scipy.spatial import cKDTree
+
+from phy.io.array import (_spikes_in_clusters, _ClusteringListener,
+                          _merged_parents)
+from .grouped import _GroupedAccumulator, _relative_clusters
+
+logger = logging.getLogger(__name__)
 
 
 #------------------------------------------------------------------------------
@@ -34,6 +43,60 @@ def get_sorted_main_channels(mean_masks, unmasked_channels):
     return main_channels
 
 
+def get_unmasked_channels_bitmap(mean_masks, min_mask=.25):
+    """Return a `(n_clusters, n_channels)` boolean array with the unmasked
+    channels of all clusters."""
+    return np.asarray(mean_masks) > min_mask
+
+
+def get_sorted_main_channels_padded(mean_masks, unmasked=None,
+                                    min_mask=.25, max_channels=None):
+    """Return the unmasked channels of all clusters, sorted by decreasing
+    mean mask.
+
+    Parameters
+    ----------
+
+    mean_masks : array
+        A `(n_clusters, n_channels)` array.
+    unmasked : array
+        A `(n_clusters, n_channels)` boolean array with the unmasked
+        channels. By default, `get_unmasked_channels_bitmap()`.
+    min_mask : float
+        Threshold used when `unmasked` is not specified.
+    max_channels : int
+        Maximum number of channels per cluster.
+
+    Returns
+    -------
+
+    channels : array
+        A `(n_clusters, k)` array, where `k` is the largest number of
+        unmasked channels, with the sorted channels of every cluster
+        followed by -1.
+    counts : array
+        The `(n_clusters,)` number of channels of every cluster.
+
+    """
+    mean_masks = np.atleast_2d(mean_masks)
+    if unmasked is None:
+        unmasked = get_unmasked_channels_bitmap(mean_masks, min_mask)
+    n = mean_masks.shape[0]
+    rows = np.arange(n)[:, np.newaxis]
+    # Same order as `get_sorted_main_channels()`.
+    order = np.argsort(mean_masks, axis=1)[:, ::-1]
+    # Move the unmasked channels first, keeping their order.
+    keep = np.argsort(~unmasked[rows, order], axis=1, kind='mergesort')
+    channels = order[rows, keep]
+    counts = unmasked.sum(axis=1)
+    if max_channels is not None:
+        counts = np.minimum(counts, max_channels)
+    k = int(counts.max()) if n else 0
+    channels = channels[:, :k]
+    channels[np.arange(k)[np.newaxis, :] >= counts[:, np.newaxis]] = -1
+    return channels, counts
+
+
 #------------------------------------------------------------------------------
 # Wizard measures
 #------------------------------------------------------------------------------
@@ -78,3 +141,692 @@ def get_mean_masked_features_distance(mean_features_0,
     d_1 = mu_1 * omeg_1
 
     return np.linalg.norm(d_0 - d_1)
+
+
+#------------------------------------------------------------------------------
+# Batched similarity
+#------------------------------------------------------------------------------
+
+def _masked_features(mean_features, mean_masks, n_features_per_channel):
+    """Return the `(n_clusters, n_channels * n_features_per_channel)` mean
+    features multiplied by the mean masks."""
+    mean_features = np.asarray(mean_features, dtype=np.float64)
+    mean_masks = np.asarray(mean_masks, dtype=np.float64)
+    n = mean_features.shape[0]
+    masks = np.repeat(mean_masks.reshape((n, -1)), n_features_per_channel,
+                      axis=1)
+    return mean_features.reshape((n, -1)) * masks
+
+
+def _pairwise_distances(x, y=None):
+    """Euclidean distances between the rows of two arrays, with a single
+    matrix product."""
+    y = x if y is None else y
+    sx = np.einsum('ij,ij->i', x, x)
+    sy = np.einsum('ij,ij->i', y, y)
+    d2 = sx[:, np.newaxis] + sy[np.newaxis, :] - 2 * np.dot(x, y.T)
+    np.maximum(d2, 0, out=d2)
+    return np.sqrt(d2)
+
+
+def get_mean_masked_features_distances(mean_features,
+                                       mean_masks,
+                                       n_features_per_channel=None,
+                                       ):
+    """Compute the distances between the mean masked features of all pairs
+    of clusters.
+
+    Parameters
+    ----------
+
+    mean_features : array
+        A `(n_clusters, n_channels, n_features_per_channel)` array.
+    mean_masks : array
+        A `(n_clusters, n_channels)` array.
+
+    Returns
+    -------
+
+    distances : array
+        A `(n_clusters, n_clusters)` array, with
+        `distances[i, j] = get_mean_masked_features_distance(...)`.
+
+    """
+    assert n_features_per_channel > 0
+    x = _masked_features(mean_features, mean_masks, n_features_per_channel)
+    d = _pairwise_distances(x)
+    d[np.arange(len(d)), np.arange(len(d))] = 0
+    return d
+
+
+class _ClusterSetListener(_ClusteringListener):
+    """Follow the clusters of a clustering with `add()` and `remove()`.
+
+    The clusters are updated from the `cluster` events. Before a query,
+    `_sync()` compares the clusters with the clustering only if its
+    `cluster_ids` array was replaced since the last update.
+
+    """
+    _clustering_attrs = ()
+    _synced_cluster_ids = None
+
+    def _on_attach(self):
+        self.reset(self.clustering.cluster_ids)
+        self._synced_cluster_ids = self.clustering.cluster_ids
+
+    def on_cluster(self, up):
+        """Update the changed clusters."""
+        self.remove(up.deleted)
+        self.add(up.added)
+        self._synced_cluster_ids = self.clustering.cluster_ids
+
+    def _sync(self):
+        """Follow the clusters of the attached clustering."""
+        if self.clustering is None:
+            return
+        cluster_ids = self.clustering.cluster_ids
+        if cluster_ids is self._synced_cluster_ids:
+            return
+        current = self.cluster_ids
+        self.remove(np.setdiff1d(current, cluster_ids))
+        self.add(np.setdiff1d(cluster_ids, current))
+        self._synced_cluster_ids = cluster_ids
+
+
+class SimilarityMatrix(_ClusterSetListener):
+    """Distances between the mean masked features of all clusters.
+
+    The full matrix is computed at once with a matrix product. After a
+    clustering change, only the rows and columns of the new clusters are
+    computed. Top-k queries use a partial sort of a row of the matrix, and
+    only the selected clusters are ranked with their exact distances.
+
+    Parameters
+    ----------
+
+    mean_features : function
+        A function `cluster_id => (n_channels, n_features_per_channel)`.
+    mean_masks : function
+        A function `cluster_id => (n_channels,)`.
+    n_features_per_channel : int
+        Number of features per channel.
+    max_n : int
+        Default number of clusters returned by `similarity()`.
+
+    Use the `similarity()` method as the `similarity` function of the
+    `Supervisor`.
+
+    """
+    def __init__(self, mean_features, mean_masks, n_features_per_channel,
+                 max_n=20):
+        assert n_features_per_channel > 0
+        self.max_n = max_n
+        self.mean_features = mean_features
+        self.mean_masks = mean_masks
+        self.n_features_per_channel = n_features_per_channel
+        self.clustering = None
+        # The vectors of the deleted clusters are kept for undo.
+        self._vectors = {}
+        self.reset([])
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the clusters in the matrix."""
+        return np.array(sorted(self._slots), dtype=np.int64)
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._slots
+
+    def _vector(self, cluster_id):
+        if cluster_id not in self._vectors:
+            x = _masked_features(self.mean_features(cluster_id)[np.newaxis],
+                                 self.mean_masks(cluster_id)[np.newaxis],
+                                 self.n_features_per_channel)
+            self._vectors[cluster_id] = x[0]
+        return self._vectors[cluster_id]
+
+    def _reserve(self, n, n_dims):
+        """Make sure that there are at least n free slots."""
+        cap = len(self._cluster_of_slot)
+        if len(self._free) >= n:
+            return
+        new_cap = max(cap + n - len(self._free), 2 * cap, 16)
+        matrix = np.zeros((new_cap, new_cap), dtype=np.float64)
+        matrix[:cap, :cap] = self._matrix
+        self._matrix = matrix
+        vectors = np.zeros((new_cap, n_dims), dtype=np.float64)
+        if cap:
+            vectors[:cap] = self._slot_vectors
+        self._slot_vectors = vectors
+        self._slot_norms = np.r_[self._slot_norms, np.zeros(new_cap - cap)]
+        self._cluster_of_slot = np.concatenate(
+            (self._cluster_of_slot, -np.ones(new_cap - cap, dtype=np.int64)))
+        # Use the new slots in increasing order.
+        self._free = list(range(new_cap - 1, cap - 1, -1)) + self._free
+
+    def add(self, cluster_ids):
+        """Add the rows and columns of some clusters."""
+        cluster_ids = [int(c) for c in cluster_ids if c not in self._slots]
+        if not cluster_ids:
+            return
+        x = np.array([self._vector(c) for c in cluster_ids])
+        self._reserve(len(cluster_ids), x.shape[1])
+        slots = np.array([self._free.pop() for _ in cluster_ids],
+                         dtype=np.int64)
+        for c, s in zip(cluster_ids, slots):
+            self._slots[c] = s
+        self._cluster_of_slot[slots] = cluster_ids
+        self._slot_vectors[slots] = x
+        self._slot_norms[slots] = np.einsum('ij,ij->i', x, x)
+        occupied = np.nonzero(self._cluster_of_slot >= 0)[0]
+        d = _pairwise_distances(x, self._slot_vectors[occupied])
+        self._matrix[np.ix_(slots, occupied)] = d
+        self._matrix[np.ix_(occupied, slots)] = d.T
+        self._matrix[slots, slots] = 0
+
+    def remove(self, cluster_ids):
+        """Remove the rows and columns of some clusters."""
+        for c in cluster_ids:
+            s = self._slots.pop(int(c), None)
+            if s is not None:
+                self._cluster_of_slot[s] = -1
+                self._free.append(s)
+
+    def reset(self, cluster_ids):
+        """Compute the full matrix of some clusters."""
+        # Every cluster has a slot, i.e. a row and a column in the matrix,
+        # and a row in the array of vectors.
+        self._slots = {}
+        self._free = []
+        self._cluster_of_slot = np.zeros(0, dtype=np.int64)
+        self._matrix = np.zeros((0, 0), dtype=np.float64)
+        self._slot_vectors = np.zeros((0, 0), dtype=np.float64)
+        self._slot_norms = np.zeros(0, dtype=np.float64)
+        self.add(cluster_ids)
+
+    def distance(self, cluster_0, cluster_1):
+        """Return the distance between two clusters."""
+        return float(np.linalg.norm(self._vector(cluster_0) -
+                                    self._vector(cluster_1)))
+
+    def similarity(self, cluster_id, max_n=None):
+        """Return a list of pairs `(cluster, similarity)` sorted by
+        decreasing similarity to a given cluster, the similarity being the
+        opposite of the distance.
+
+        The given cluster may not be in the clustering, for example a
+        deleted cluster that is still selected: its distances are then
+        computed without adding it to the matrix.
+
+        """
+        self._sync()
+        x = self._vector(cluster_id)
+        occupied = np.nonzero(self._cluster_of_slot >= 0)[0]
+        if not len(occupied):
+            return []
+        slot = self._slots.get(cluster_id)
+        if slot is not None:
+            occupied = occupied[occupied != slot]
+            d = self._matrix[slot, occupied]
+        else:
+            d = _pairwise_distances(x[np.newaxis],
+                                    self._slot_vectors[occupied])[0]
+        max_n = min(max_n or self.max_n or len(d), len(d))
+        candidates = np.arange(len(d))
+        if max_n < len(d):
+            # NOTE: the matrix product loses precision for the closest
+            # clusters. The error on the distances is bounded by `tol`,
+            # so that the near-ties at the cut are kept as candidates.
+            cut = np.partition(d, max_n - 1)[max_n - 1]
+            err = (4 * len(x) * np.finfo(np.float64).eps *
+                   (x.dot(x) + self._slot_norms[occupied].max()))
+            candidates = np.nonzero(d <= cut + np.sqrt(err))[0]
+        # The candidates are ranked with their exact distances.
+        occupied = occupied[candidates]
+        d = np.linalg.norm(self._slot_vectors[occupied] - x, axis=1)
+        best = np.argsort(d, kind='mergesort')[:max_n]
+        clusters = self._cluster_of_slot[occupied[best]]
+        return [(int(c), -float(v)) for c, v in zip(clusters, d[best])]
+
+
+#------------------------------------------------------------------------------
+# Spatial index
+#------------------------------------------------------------------------------
+
+class SpatialClusterIndex(_ClusterSetListener):
+    """Nearest-cluster index on the mean probe positions of the clusters.
+
+    On large probes, most clusters are far apart and their similarity is
+    irrelevant. A KD-tree on the mean probe positions selects the spatial
+    neighbors of a cluster, and only these candidates are scored with the
+    exact similarity function. The tree is rebuilt lazily, from the cached
+    positions, before the first query following a clustering change.
+
+    Parameters
+    ----------
+
+    mean_masks : function
+        A function `cluster_id => (n_channels,)`.
+    site_positions : array
+        A `(n_channels, 2)` array with the positions of the channels.
+    similarity : function
+        A function `(cluster_0, cluster_1) => similarity`. By default, the
+        opposite of the distance between the mean probe positions.
+    radius : float
+        Maximum distance between the positions of a cluster and of its
+        candidates. If None, the `n_neighbors` nearest clusters are the
+        candidates.
+    n_neighbors : int
+        Number of candidates when `radius` is None.
+    max_n : int
+        Default number of clusters returned by `similarity()`.
+
+    Use the `similarity()` method as the `similarity` function of the
+    `Supervisor`.
+
+    """
+    def __init__(self, mean_masks, site_positions, similarity=None,
+                 radius=None, n_neighbors=32, max_n=None):
+        self.mean_masks = mean_masks
+        self.site_positions = np.asarray(site_positions, dtype=np.float64)
+        self.pair_similarity = similarity or self._position_similarity
+        self.radius = radius
+        self.n_neighbors = n_neighbors
+        self.max_n = max_n
+        self.clustering = None
+        # Positions of all clusters seen so far, including deleted ones.
+        self._positions = {}
+        self._cluster_ids = set()
+        self._tree = None
+        self._tree_clusters = np.zeros(0, dtype=np.int64)
+        self.n_builds = 0
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the clusters in the index."""
+        return np.array(sorted(self._cluster_ids), dtype=np.int64)
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._cluster_ids
+
+    def position(self, cluster_id):
+        """Return the mean probe position of a cluster."""
+        if cluster_id not in self._positions:
+            self._positions[cluster_id] = get_mean_probe_position(
+                np.asarray(self.mean_masks(cluster_id)), self.site_positions)
+        return self._positions[cluster_id]
+
+    def _position_similarity(self, cluster_0, cluster_1):
+        return -float(np.linalg.norm(self.position(cluster_0) -
+                                     self.position(cluster_1)))
+
+    def add(self, cluster_ids):
+        """Add some clusters to the index."""
+        cluster_ids = [int(c) for c in cluster_ids
+                       if c not in self._cluster_ids]
+        if cluster_ids:
+            self._cluster_ids.update(cluster_ids)
+            self._tree = None
+
+    def remove(self, cluster_ids):
+        """Remove some clusters from the index."""
+        cluster_ids = [int(c) for c in cluster_ids if c in self._cluster_ids]
+        if cluster_ids:
+            self._cluster_ids.difference_update(cluster_ids)
+            self._tree = None
+
+    def reset(self, cluster_ids):
+        """Index some clusters."""
+        self._cluster_ids = set()
+        self._tree = None
+        self.add(cluster_ids)
+
+    def _build(self):
+        if self._tree is not None:
+            return
+        self._tree_clusters = self.cluster_ids
+        pos = np.array([self.position(c) for c in self._tree_clusters])
+        ndim = self.site_positions.shape[1]
+        self._tree = cKDTree(pos.reshape((len(pos), ndim)))
+        self.n_builds += 1
+        logger.debug("Build the spatial index of %d clusters.", len(pos))
+
+    def candidates(self, cluster_id):
+        """Return the spatial neighbors of a cluster, by increasing
+        distance."""
+        self._sync()
+        self._build()
+        n = len(self._tree_clusters)
+        if not n:
+            return []
+        pos = self.position(cluster_id)
+        if self.radius is not None:
+            idx = self._tree.query_ball_point(pos, self.radius)
+            idx = np.asarray(idx, dtype=np.int64)
+            d = np.linalg.norm(self._tree.data[idx] - pos, axis=1)
+            idx = idx[np.argsort(d, kind='mergesort')]
+        else:
+            # One more neighbor, since the cluster may be its own neighbor.
+            k = min(self.n_neighbors + 1, n)
+            _, idx = self._tree.query(pos, k=k)
+            idx = np.atleast_1d(idx)
+        clusters = self._tree_clusters[idx]
+        clusters = clusters[clusters != cluster_id]
+        if self.radius is None:
+            clusters = clusters[:self.n_neighbors]
+        return [int(c) for c in clusters]
+
+    def similarity(self, cluster_id, max_n=None):
+        """Return a list of pairs `(cluster, similarity)` sorted by
+        decreasing similarity to a given cluster, among its spatial
+        neighbors."""
+        sims = [(c, self.pair_similarity(cluster_id, c))
+                for c in self.candidates(cluster_id)]
+        sims = sorted(sims, key=lambda x: -x[1])
+        max_n = max_n or self.max_n
+        return sims[:max_n] if max_n is not None else sims
+
+
+#------------------------------------------------------------------------------
+# Sufficient statistics
+#------------------------------------------------------------------------------
+
+class ClusterStatistics(_ClusteringListener):
+    """Columnar store of the per-cluster sums of per-spike arrays.
+
+    The mean masks, mean features, and mean waveforms of a cluster, and the
+    quantities derived from them (mean probe position, waveform amplitude),
+    only depend on the number of spikes and on the sums of the per-spike
+    arrays. These sums are stored in one array per statistic, indexed by
+    cluster id, and they are computed for all clusters in a single
+    streaming pass over the data.
+
+    After a merge, the rows of the new cluster are the sums of the rows of
+    the merged clusters. Only the spikes of the clusters created by a split
+    are read again, and an undo reuses the rows of the restored clusters.
+
+    Parameters
+    ----------
+
+    spike_clusters : array-like
+        The spike-cluster assignment.
+    masks : array-like
+        The `(n_spikes, n_channels)` masks.
+    features : array-like
+        The `(n_spikes, n_channels, n_features_per_channel)` features.
+    waveforms : array-like
+        The `(n_spikes, n_samples, n_channels)` waveforms.
+    site_positions : array-like
+        The `(n_channels, 2)` positions of the channels, required by
+        `mean_probe_position()`.
+    spikes_per_cluster : dict-like
+        The spikes of every cluster, used to find the spikes of the new
+        clusters. By default, they are found in `spike_clusters`.
+    chunk_size : int
+        Number of spikes read at once. By default, the chunks are about
+        64 MB in double precision.
+
+    The per-spike arrays can be memory-mapped.
+
+    """
+    _clustering_attrs = ('spike_clusters', 'spikes_per_cluster')
+
+    def __init__(self, spike_clusters, masks=None, features=None,
+                 waveforms=None, site_positions=None,
+                 spikes_per_cluster=None, chunk_size=None):
+        self.spike_clusters = np.asarray(spike_clusters, dtype=np.int64)
+        self.spikes_per_cluster = spikes_per_cluster
+        self.site_positions = site_positions
+        self.arrays = {name: arr for name, arr in (('masks', masks),
+                                                   ('features', features),
+                                                   ('waveforms', waveforms),
+                                                   )
+                       if arr is not None}
+        if chunk_size is None:
+            row_size = 8 * max([1] + [int(np.prod(arr.shape[1:]))
+                                      for arr in self.arrays.values()])
+            chunk_size = max(1, (64 << 20) // row_size)
+        self.chunk_size = chunk_size
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._valid = np.zeros(0, dtype=np.bool_)
+        self._sums = {name: np.zeros((0,) + tuple(arr.shape[1:]))
+                      for name, arr in self.arrays.items()}
+        self.n_scanned = 0
+        self.n_merged = 0
+        self.n_reused = 0
+
+    def __contains__(self, cluster_id):
+        return cluster_id < len(self._valid) and bool(self._valid[cluster_id])
+
+    def _reserve(self, max_cluster_id):
+        """Make sure that there is a row for every cluster up to a given
+        id."""
+        cap = len(self._counts)
+        if max_cluster_id < cap:
+            return
+        new_cap = max(max_cluster_id + 1, 2 * cap, 16)
+        n = new_cap - cap
+        self._counts = np.concatenate((self._counts,
+                                       np.zeros(n, dtype=np.int64)))
+        self._valid = np.concatenate((self._valid,
+                                      np.zeros(n, dtype=np.bool_)))
+        for name, sums in self._sums.items():
+            self._sums[name] = np.concatenate(
+                (sums, np.zeros((n,) + sums.shape[1:])))
+
+    def _spikes(self, cluster_ids):
+        if not len(cluster_ids):
+            return np.array([], dtype=np.int64)
+        if self.spikes_per_cluster is not None:
+            spikes = [self.spikes_per_cluster[c] for c in cluster_ids]
+            return np.sort(np.concatenate(spikes).astype(np.int64))
+        return _spikes_in_clusters(self.spike_clusters, cluster_ids)
+
+    def _scan(self, cluster_ids=None):
+        """Compute the rows of some clusters in a single pass over their
+        spikes, or over all spikes by default."""
+        if cluster_ids is None:
+            cluster_ids = np.unique(self.spike_clusters)
+            cluster_ids = cluster_ids[cluster_ids >= 0]
+            spike_ids = None
+            n_spikes = len(self.spike_clusters)
+        else:
+            cluster_ids = np.unique(np.asarray(cluster_ids, dtype=np.int64))
+            if not len(cluster_ids):
+                return
+            spike_ids = self._spikes(cluster_ids)
+            n_spikes = len(spike_ids)
+        logger.debug("Compute the statistics of %d clusters from %d spikes.",
+                     len(cluster_ids), n_spikes)
+        n = len(cluster_ids)
+        accs = {name: _GroupedAccumulator(n, arr.shape[1:], ('sum',))
+                for name, arr in self.arrays.items()}
+        counts = np.zeros(n, dtype=np.int64)
+        for i in range(0, n_spikes, self.chunk_size):
+            j = min(i + self.chunk_size, n_spikes)
+            ids = (np.arange(i, j) if spike_ids is None
+                   else spike_ids[i:j])
+            rel, valid = _relative_clusters(self.spike_clusters[ids],
+                                            cluster_ids)
+            ids, rel = ids[valid], rel[valid]
+            counts += np.bincount(rel, minlength=n)
+            for name, arr in self.arrays.items():
+                chunk = (arr[i:j] if spike_ids is None and np.all(valid)
+                         else arr[ids])
+                accs[name].add(chunk, rel)
+        if not n:
+            return
+        self._reserve(cluster_ids.max())
+        self._counts[cluster_ids] = counts
+        for name, acc in accs.items():
+            self._sums[name][cluster_ids] = acc.sum
+        self._valid[cluster_ids] = True
+        self.n_scanned += n
+
+    def update(self, cluster_ids=None):
+        """Compute the rows of some clusters, all clusters by default."""
+        if cluster_ids is not None:
+            cluster_ids = [c for c in cluster_ids if c not in self]
+        self._scan(cluster_ids)
+
+    def _merge(self, cluster_id, parents):
+        self._reserve(cluster_id)
+        self._counts[cluster_id] = self._counts[parents].sum()
+        for sums in self._sums.values():
+            sums[cluster_id] = sums[parents].sum(axis=0)
+        self._valid[cluster_id] = True
+        self.n_merged += 1
+
+    def on_cluster(self, up):
+        """Sum the rows of the merged clusters, and rescan the spikes of the
+        other new clusters."""
+        merged = _merged_parents(up)
+        to_scan = []
+        for cluster_id in up.added:
+            if cluster_id in self:
+                self.n_reused += 1
+                continue
+            parents = merged.get(cluster_id)
+            if parents and all(p in self for p in parents):
+                self._merge(cluster_id, parents)
+            else:
+                to_scan.append(cluster_id)
+        self._scan(to_scan)
+
+    # Statistics
+    # -------------------------------------------------------------------------
+
+    def count(self, cluster_ids):
+        """Number of spikes of one or several clusters."""
+        self.update(np.atleast_1d(cluster_ids))
+        return self._counts[cluster_ids]
+
+    def sum(self, name, cluster_ids):
+        """Sum of a per-spike array over the spikes of one or several
+        clusters."""
+        self.update(np.atleast_1d(cluster_ids))
+        return self._sums[name][cluster_ids]
+
+    def mean(self, name, cluster_ids):
+        """Mean of a per-spike array over the spikes of one or several
+        clusters."""
+        sums = self.sum(name, cluster_ids)
+        counts = np.maximum(self._counts[cluster_ids], 1)
+        return sums / np.reshape(counts, np.shape(counts) +
+                                 (1,) * (sums.ndim - np.ndim(counts)))
+
+    def mean_masks(self, cluster_ids):
+        return self.mean('masks', cluster_ids)
+
+    def mean_features(self, cluster_ids):
+        return self.mean('features', cluster_ids)
+
+    def mean_waveforms(self, cluster_ids):
+        return self.mean('waveforms', cluster_ids)
+
+    def mean_probe_position(self, cluster_ids):
+        """Mean probe position of one or several clusters."""
+        mean_masks = self.mean_masks(cluster_ids)
+        pos = np.dot(mean_masks, self.site_positions)
+        norm = np.maximum(1, mean_masks.sum(axis=-1))
+        return pos / np.reshape(norm, np.shape(norm) + (1,))
+
+    def waveform_amplitude(self, cluster_ids):
+        """Amplitude of the mean masked waveforms of one or several clusters
+        on all channels."""
+        mean_masks = self.mean_masks(cluster_ids)
+        w = self.mean_waveforms(cluster_ids) * mean_masks[..., np.newaxis, :]
+        return w.max(axis=-2) - w.min(axis=-2)
+
+    @property
+    def stats(self):
+        return dict(scanned=self.n_scanned,
+                    merged=self.n_merged,
+                    reused=self.n_reused,
+                    n_items=int(self._valid.sum()),
+                    )
+
+
+#------------------------------------------------------------------------------
+# Best channels
+#------------------------------------------------------------------------------
+
+class BestChannels(_ClusteringListener):
+    """Cache of the sorted main channels and of the unmasked channels of
+    all clusters.
+
+    The channels of many clusters are computed at once from their stacked
+    mean masks. After a clustering change, only the channels of the new
+    clusters are computed.
+
+    Parameters
+    ----------
+
+    mean_masks : function
+        A function `cluster_id => (n_channels,)`.
+    min_mask : float
+        Channels with a larger mean mask are unmasked.
+    max_channels : int
+        Maximum number of best channels per cluster.
+
+    """
+    _clustering_attrs = ()
+
+    def __init__(self, mean_masks, min_mask=.25, max_channels=None):
+        self.mean_masks = mean_masks
+        self.min_mask = min_mask
+        self.max_channels = max_channels
+        # cluster_id: (sorted channels, unmasked channels bitmap)
+        self._channels = {}
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._channels
+
+    def update(self, cluster_ids):
+        """Compute the channels of some clusters at once."""
+        cluster_ids = [int(c) for c in cluster_ids
+                       if c not in self._channels]
+        if not cluster_ids:
+            return
+        logger.debug("Compute the best channels of %d clusters.",
+                     len(cluster_ids))
+        mean_masks = np.array([self.mean_masks(c) for c in cluster_ids])
+        unmasked = get_unmasked_channels_bitmap(mean_masks, self.min_mask)
+        channels, counts = get_sorted_main_channels_padded(
+            mean_masks, unmasked, max_channels=self.max_channels)
+        for i, c in enumerate(cluster_ids):
+            self._channels[c] = (channels[i, :counts[i]], unmasked[i])
+
+    def best_channels(self, cluster_id):
+        """Sorted main channels of a cluster."""
+        self.update([cluster_id])
+        return self._channels[cluster_id][0]
+
+    def unmasked_channels(self, cluster_id):
+        """Unmasked channels of a cluster."""
+        self.update([cluster_id])
+        return np.nonzero(self._channels[cluster_id][1])[0]
+
+    def best_channels_padded(self, cluster_ids):
+        """Return a `(n_clusters, k)` array with the sorted main channels of
+        some clusters, padded with -1."""
+        self.update(cluster_ids)
+        rows = [self._channels[c][0] for c in cluster_ids]
+        k = max([len(r) for r in rows] + [0])
+        out = -np.ones((len(rows), k), dtype=np.int64)
+        for i, r in enumerate(rows):
+            out[i, :len(r)] = r
+        return out
+
+    def unmasked_bitmap(self, cluster_ids):
+        """Return a `(n_clusters, n_channels)` boolean array with the
+        unmasked channels of some clusters."""
+        self.update(cluster_ids)
+        return np.array([self._channels[c][1] for c in cluster_ids])
+
+    def on_cluster(self, up):
+        """Compute the channels of the new clusters at once."""
+        self.update(up.added)
+
+    def _on_attach(self):
+        self.update(self.clustering.cluster_ids)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Grouped reductions of per-spike arrays."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+
+from phy.utils._types import Bunch
+from phy.io.array import _unique
+
+
+#------------------------------------------------------------------------------
+# Grouped reductions
+#------------------------------------------------------------------------------
+
+_REDUCTIONS = ('count', 'sum', 'mean', 'var', 'min', 'max')
+
+
+def _relative_clusters(spike_clusters, cluster_ids):
+    """Return the index of every spike's cluster in the sorted `cluster_ids`
+    array, and a mask of the spikes belonging to one of these clusters."""
+    rel = np.searchsorted(cluster_ids, spike_clusters)
+    rel = np.clip(rel, 0, max(0, len(cluster_ids) - 1))
+    valid = (cluster_ids[rel] == spike_clusters if len(cluster_ids)
+             else np.zeros(len(spike_clusters), dtype=np.bool_))
+    return rel, valid
+
+
+class _GroupedAccumulator(object):
+    """Accumulate grouped statistics chunk by chunk.
+
+    The variance is computed with the pairwise update formula of Chan et al.
+    so that it remains accurate when combining many chunks.
+
+    """
+    def __init__(self, n_clusters, shape, reductions):
+        self.reductions = reductions
+        self.count = np.zeros(n_clusters, dtype=np.int64)
+        self.sum = np.zeros((n_clusters,) + shape, dtype=np.float64)
+        if 'var' in reductions:
+            self.m2 = np.zeros((n_clusters,) + shape, dtype=np.float64)
+        if 'min' in reductions:
+            self.min = np.full((n_clusters,) + shape, np.inf)
+        if 'max' in reductions:
+            self.max = np.full((n_clusters,) + shape, -np.inf)
+
+    def add(self, chunk, rel):
+        """Add a chunk of spikes, `rel` contains the relative cluster indices
+        of the spikes."""
+        if not len(rel):
+            return
+        # One sort per chunk, then every reduction is a single reduceat call.
+        order = np.argsort(rel, kind='mergesort')
+        rel = rel[order]
+        x = np.asarray(chunk[order], dtype=np.float64)
+        bounds = np.concatenate([[0], np.nonzero(np.diff(rel))[0] + 1])
+        present = rel[bounds]
+        n_b = np.diff(np.append(bounds, len(rel)))
+        sum_b = np.add.reduceat(x, bounds, axis=0)
+        extra = (1,) * (x.ndim - 1)
+
+        if 'var' in self.reductions:
+            mean_b = sum_b / n_b.reshape((-1,) + extra)
+            dev = x - np.repeat(mean_b, n_b, axis=0)
+            m2_b = np.add.reduceat(dev * dev, bounds, axis=0)
+            n_a = self.count[present].reshape((-1,) + extra)
+            nb = n_b.reshape((-1,) + extra)
+            mean_a = self.sum[present] / np.maximum(n_a, 1)
+            delta = mean_b - mean_a
+            self.m2[present] += m2_b + delta * delta * n_a * nb / (n_a + nb)
+        if 'min' in self.reductions:
+            self.min[present] = np.minimum(self.min[present],
+                                           np.minimum.reduceat(x, bounds,
+                                                               axis=0))
+        if 'max' in self.reductions:
+            self.max[present] = np.maximum(self.max[present],
+                                           np.maximum.reduceat(x, bounds,
+                                                               axis=0))
+        self.count[present] += n_b
+        self.sum[present] += sum_b
+
+    def result(self):
+        out = Bunch()
+        extra = (1,) * (self.sum.ndim - 1)
+        n = self.count.reshape((-1,) + extra)
+        empty = self.count == 0
+        for name in self.reductions:
+            if name == 'count':
+                val = self.count
+            elif name == 'sum':
+                val = self.sum
+            elif name == 'mean':
+                val = self.sum / np.maximum(n, 1)
+            elif name == 'var':
+                val = self.m2 / np.maximum(n, 1)
+            else:
+                val = getattr(self, name)
+                val[empty] = np.nan
+            out[name] = val
+        return out
+
+
+def grouped_reductions(arr, spike_clusters, cluster_ids=None,
+                       reductions=('count', 'mean'), spike_ids=None,
+                       chunk_size=None):
+    """Compute reductions of a per-spike array for every cluster.
+
+    Parameters
+    ----------
+
+    arr : array-like
+        A `(n_spikes, ...)` array, for example features, masks, or
+        waveforms. It can be memory-mapped: it is read chunk by chunk.
+    spike_clusters : array-like
+        The `(n_spikes,)` spike-cluster assignment. When `spike_ids` is
+        specified, this array should contain the clusters of these spikes
+        only.
+    cluster_ids : array-like
+        The clusters to consider, in the order of the output arrays. By
+        default, all non-negative clusters appearing in `spike_clusters`, in
+        increasing order. Spikes belonging to other clusters are ignored.
+    reductions : tuple
+        A subset of `count`, `sum`, `mean`, `var`, `min`, `max`.
+    spike_ids : array-like
+        Optional subset of spikes in `arr`.
+    chunk_size : int
+        Number of spikes processed at once. By default, the chunks are about
+        64 MB in double precision.
+
+    Returns
+    -------
+
+    out : Bunch
+        A Bunch with `cluster_ids` and one `(n_clusters, ...)` array for
+        every requested reduction. The minimum and maximum of empty clusters
+        are NaN, their mean and variance are zero.
+
+    """
+    for name in reductions:
+        if name not in _REDUCTIONS:
+            raise ValueError("Unknown reduction `{}`: ".format(name) +
+                             "it should be one of " +
+                             "{}.".format(', '.join(_REDUCTIONS)))
+    spike_clusters = np.asarray(spike_clusters, dtype=np.int64)
+    n_spikes = len(spike_clusters)
+    if spike_ids is not None:
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        assert len(spike_ids) == n_spikes
+    else:
+        assert arr.shape[0] == n_spikes
+    shape = tuple(arr.shape[1:])
+
+    if cluster_ids is None:
+        cluster_ids = _unique(spike_clusters)
+    cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+    # Internally, the clusters are sorted.
+    perm = np.argsort(cluster_ids, kind='mergesort')
+    sorted_ids = cluster_ids[perm]
+
+    if chunk_size is None:
+        row_size = 8 * max(1, int(np.prod(shape, dtype=np.int64)))
+        chunk_size = max(1, (64 << 20) // row_size)
+
+    acc = _GroupedAccumulator(len(cluster_ids), shape, reductions)
+    for i in range(0, n_spikes, chunk_size):
+        j = min(i + chunk_size, n_spikes)
+        rel, valid = _relative_clusters(spike_clusters[i:j], sorted_ids)
+        if spike_ids is not None:
+            chunk = arr[spike_ids[i:j][valid]]
+        elif np.all(valid):
+            chunk = arr[i:j]
+        else:
+            chunk = arr[i:j][valid]
+        acc.add(chunk, rel[valid])
+
+    out = acc.result()
+    # Reorder the output arrays in the order of the requested clusters.
+    inv = np.argsort(perm)
+    for name in reductions:
+        out[name] = out[name][inv]
+    out.cluster_ids = cluster_ids
+    return out
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""Spike-train quality metrics of all clusters."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+
+from phy.utils._types import Bunch, _as_array
+from phy.io.array import _spikes_per_cluster, _ClusteringListener
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Quality metrics
+#------------------------------------------------------------------------------
+
+def _grouped_times(spike_times, spikes_per_cluster, cluster_ids):
+    """Return the concatenated spike times of some clusters, grouped by
+    cluster, and the number of spikes of every cluster."""
+    spikes = [spikes_per_cluster[c] for c in cluster_ids]
+    counts = np.array([len(s) for s in spikes], dtype=np.int64)
+    spikes = np.concatenate(spikes or [[]]).astype(np.int64)
+    return spike_times[spikes], counts
+
+
+def spike_train_metrics(spike_times, spikes_per_cluster, cluster_ids,
+                        duration=None,
+                        refractory_period=.002,
+                        isi_bin_size=.001,
+                        isi_window_size=.05,
+                        n_presence_bins=100,
+                        ):
+    """Compute spike-train quality metrics of many clusters at once.
+
+    The spikes of all clusters are concatenated in the order of the
+    clusters. Since the spikes of every cluster are sorted, the
+    inter-spike intervals (ISIs) are the differences of consecutive times
+    within every group, and every metric is a single `bincount()`.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        Increasing spike times, in seconds.
+    spikes_per_cluster : dict-like
+        The sorted spikes of every cluster.
+    cluster_ids : array-like
+        The clusters, in the order of the output arrays.
+    duration : float
+        Duration of the recording, in seconds. By default, the time of the
+        last spike.
+    refractory_period : float
+        ISIs shorter than this are refractory-period violations.
+    isi_bin_size : float
+        Bin size of the ISI histograms, in seconds.
+    isi_window_size : float
+        Maximum ISI of the ISI histograms, in seconds.
+    n_presence_bins : int
+        Number of time bins used for the presence ratio.
+
+    Returns
+    -------
+
+    metrics : Bunch
+        A Bunch with the following `(n_clusters,)` arrays: `n_spikes`,
+        `firing_rate` (in Hz), `refractory_violations` (fraction of the ISIs
+        shorter than the refractory period), `presence_ratio` (fraction of
+        the time bins with at least one spike), and the
+        `(n_clusters, n_bins)` array `isi`.
+
+    """
+    spike_times = np.asarray(spike_times, dtype=np.float64)
+    cluster_ids = _as_array(cluster_ids)
+    n = len(cluster_ids)
+    if duration is None:
+        duration = spike_times[-1] if len(spike_times) else 1.
+    duration = max(float(duration), 1e-12)
+
+    times, counts = _grouped_times(spike_times, spikes_per_cluster,
+                                   cluster_ids)
+    rel = np.repeat(np.arange(n), counts)
+
+    # ISIs within every cluster.
+    same = rel[1:] == rel[:-1]
+    isi = np.diff(times)[same]
+    isi_rel = rel[1:][same]
+    n_isi = np.bincount(isi_rel, minlength=n)
+    n_violations = np.bincount(isi_rel[isi < refractory_period],
+                               minlength=n)
+
+    # ISI histograms.
+    n_bins = int(round(isi_window_size / isi_bin_size))
+    b = (isi / isi_bin_size).astype(np.int64)
+    m = b < n_bins
+    isi_hist = np.bincount(isi_rel[m] * n_bins + b[m], minlength=n * n_bins)
+
+    # Presence ratio.
+    pb = (times / duration * n_presence_bins).astype(np.int64)
+    pb = np.clip(pb, 0, n_presence_bins - 1)
+    occupied = np.zeros(n * n_presence_bins, dtype=np.bool_)
+    occupied[rel * n_presence_bins + pb] = True
+
+    return Bunch(cluster_ids=cluster_ids,
+                 n_spikes=counts,
+                 firing_rate=counts / duration,
+                 refractory_violations=n_violations / np.maximum(n_isi, 1.),
+                 presence_ratio=occupied.reshape((n, n_presence_bins)
+                                                 ).mean(axis=1),
+                 isi=isi_hist.reshape((n, n_bins)),
+                 )
+
+
+class ClusterMetrics(_ClusteringListener):
+    """Quality metrics of all clusters, updated after clustering changes.
+
+    The metrics of all clusters are computed at once with
+    `spike_train_metrics()`. After a merge or a split, only the metrics of
+    the new clusters are computed, and the metrics of the deleted clusters
+    are kept for undo.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        Increasing spike times, in seconds.
+    spike_clusters : array-like
+        The spike-cluster assignment. Only used if `spikes_per_cluster` is
+        not specified.
+    spikes_per_cluster : dict-like
+        The spikes of every cluster.
+
+    The other keyword arguments are passed to `spike_train_metrics()`.
+
+    """
+    columns = ('firing_rate', 'refractory_violations', 'presence_ratio')
+
+    def __init__(self, spike_times, spike_clusters=None,
+                 spikes_per_cluster=None, **kwargs):
+        self.spike_times = np.asarray(spike_times, dtype=np.float64)
+        if spikes_per_cluster is None:
+            spikes_per_cluster = _spikes_per_cluster(spike_clusters)
+        self.spikes_per_cluster = spikes_per_cluster
+        kwargs.setdefault('duration', self.spike_times[-1]
+                          if len(self.spike_times) else 1.)
+        self._kwargs = kwargs
+        # cluster_id: Bunch with the metrics of that cluster.
+        self._metrics = {}
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._metrics
+
+    def update(self, cluster_ids=None):
+        """Compute the metrics of some clusters, all clusters by default."""
+        if cluster_ids is None:
+            cluster_ids = list(self.spikes_per_cluster.keys())
+        cluster_ids = [int(c) for c in cluster_ids]
+        if not cluster_ids:
+            return
+        logger.debug("Compute the quality metrics of %d clusters.",
+                     len(cluster_ids))
+        m = spike_train_metrics(self.spike_times, self.spikes_per_cluster,
+                                cluster_ids, **self._kwargs)
+        for i, cluster_id in enumerate(cluster_ids):
+            self._metrics[cluster_id] = Bunch(
+                n_spikes=int(m.n_spikes[i]),
+                firing_rate=float(m.firing_rate[i]),
+                refractory_violations=float(m.refractory_violations[i]),
+                presence_ratio=float(m.presence_ratio[i]),
+                isi=m.isi[i],
+            )
+
+    def get(self, cluster_id):
+        """Return a Bunch with the metrics of a cluster."""
+        if cluster_id not in self._metrics:
+            self.update([cluster_id])
+        return self._metrics[cluster_id]
+
+    def firing_rate(self, cluster_id):
+        """Firing rate, in Hz."""
+        return self.get(cluster_id).firing_rate
+
+    def refractory_violations(self, cluster_id):
+        """Fraction of the ISIs shorter than the refractory period."""
+        return self.get(cluster_id).refractory_violations
+
+    def presence_ratio(self, cluster_id):
+        """Fraction of the recording during which the cluster fires."""
+        return self.get(cluster_id).presence_ratio
+
+    def isi(self, cluster_id):
+        """ISI histogram."""
+        return self.get(cluster_id).isi
+
+    def on_cluster(self, up):
+        """Compute the metrics of the new clusters in a single pass."""
+        self.update([c for c in up.added if c not in self._metrics])
+
+    def add_columns(self, supervisor):
+        """Add sortable columns with the metrics in the cluster views of a
+        `Supervisor` instance."""
+        self.attach(supervisor.clustering)
+
+        @supervisor.connect
+        def on_create_cluster_views():
+            # Compute the metrics of all clusters at once before the
+            # cluster view requests them one by one.
+            self.update([c for c in supervisor.clustering.cluster_ids
+                         if c not in self._metrics])
+            for name in self.columns:
+                supervisor.add_column(getattr(self, name), name=name)
+        return self
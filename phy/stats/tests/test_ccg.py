@@ -11,8 +11,22 @@ from numpy.testing import assert_array_equal as ae
 
 from ..ccg import (_increment,
                    _diff_shifted,
+                   _window_pairs,
                    correlograms,
+                   subset_correlograms,
+                   CorrelogramCache,
+                   MultiResolutionCorrelograms,
+                   multi_resolution_correlograms,
+                   chunked_correlograms,
+                   SparseCorrelograms,
+                   _sparse_sum,
+                   _choose_method,
+                   _fft_size,
                    )
+from phy.io.array import _spikes_per_cluster
+from phy.io.context import Context
+from phy.io.mock import MockClustering
+from pytest import raises
 
 
 #------------------------------------------------------------------------------
@@ -172,3 +186,361 @@ def test_symmetrize_correlograms():
     assert np.all(sym[np.arange(3), np.arange(3), 25] == 0)
 
     ae(sym[0, 1, :], sym[1, 0, ::-1])
+
+
+def test_window_pairs():
+    spike_samples = np.array([0, 1, 1, 5, 6, 20])
+    pairs = [(i, j) for ii, jj in _window_pairs(spike_samples, 2)
+             for i, j in zip(ii, jj)]
+    assert pairs == [(0, 1), (0, 2), (1, 2), (3, 4)]
+
+    # Chunks.
+    chunks = list(_window_pairs(spike_samples, 10, max_pairs=2))
+    assert [len(i) for i, j in chunks] == [4, 3, 2, 1]
+    pairs_2 = [(i, j) for ii, jj in chunks for i, j in zip(ii, jj)]
+    assert pairs_2 == [(i, j) for ii, jj in _window_pairs(spike_samples, 10)
+                       for i, j in zip(ii, jj)]
+    assert len(pairs_2) == 10
+
+    assert not list(_window_pairs(np.array([], dtype=np.int64), 2))
+
+
+def test_subset_correlograms():
+    spike_samples, spike_clusters = _random_data(20)
+    spike_clusters[:3] = 3  # identical clusters at the start
+    spike_samples[1] = spike_samples[0]  # identical times
+    binsize, winsize_bins = _ccg_params()
+    spc = _spikes_per_cluster(spike_clusters)
+
+    for cluster_ids in ([3], [7, 3], [12, 0, 5, 19]):
+        spikes = np.nonzero(np.in1d(spike_clusters, cluster_ids))[0]
+        for symmetrize in (False, True):
+            c0 = correlograms(spike_samples[spikes], spike_clusters[spikes],
+                              cluster_ids=cluster_ids,
+                              bin_size=binsize, window_size=winsize_bins,
+                              sample_rate=20000, symmetrize=symmetrize)
+            for kwargs in (dict(), dict(spikes_per_cluster=spc),
+                           dict(max_pairs=10)):
+                c1 = subset_correlograms(spike_samples, spike_clusters,
+                                         cluster_ids,
+                                         bin_size=binsize,
+                                         window_size=winsize_bins,
+                                         sample_rate=20000,
+                                         symmetrize=symmetrize,
+                                         **kwargs)
+                assert c1.dtype == c0.dtype
+                ae(c1, c0)
+
+    # Empty clusters.
+    c = subset_correlograms(spike_samples, spike_clusters, [100],
+                            bin_size=binsize, window_size=winsize_bins,
+                            sample_rate=20000)
+    assert c.shape == (1, 1, 51)
+    assert not c.any()
+
+
+def test_subset_counts_block():
+    from ..ccg import _subset_counts
+    spike_samples, spike_clusters = _random_data(4)
+    spike_samples[1] = spike_samples[0]
+    kwargs = dict(sample_rate=1., bin_size=20, window_size=1000)
+    cluster_ids = [3, 0, 2, 1]
+    for method in ('exact', 'fft'):
+        full = _subset_counts(spike_samples, spike_clusters, cluster_ids,
+                              method=method, **kwargs)
+        block = _subset_counts(spike_samples, spike_clusters, cluster_ids,
+                               method=method, block=[1, 2], max_pairs=100,
+                               **kwargs)
+        # Only the pairs with the clusters 0 and 2 are computed.
+        ae(block[[1, 2]], full[[1, 2]])
+        ae(block[:, [1, 2]], full[:, [1, 2]])
+        assert not block[np.ix_([0, 3], [0, 3])].any()
+
+
+def test_correlogram_cache(monkeypatch):
+    from .. import ccg
+    spike_samples, spike_clusters = _random_data(5)
+    spike_samples[1] = spike_samples[0]
+    binsize, winsize_bins = _ccg_params()
+    kwargs = dict(bin_size=binsize, window_size=winsize_bins)
+    clustering = MockClustering(spike_clusters)
+    cache = CorrelogramCache(spike_samples, spike_clusters,
+                             sample_rate=20000)
+    cache.attach(clustering)
+
+    def _ccg(cluster_ids, spike_clusters):
+        return subset_correlograms(spike_samples, spike_clusters, cluster_ids,
+                                   sample_rate=20000, **kwargs)
+
+    ae(cache([2, 0], **kwargs), _ccg([2, 0], spike_clusters))
+    assert cache.stats['misses'] == 4
+    ae(cache([0, 2], **kwargs), _ccg([0, 2], spike_clusters))
+    assert cache.stats['hits'] == 4
+    calls = []
+    _subset_counts = ccg._subset_counts
+
+    def _counts(*args, **kwargs):
+        if kwargs.get('block') is not None:
+            calls.append(kwargs['block'])
+        return _subset_counts(*args, **kwargs)
+    monkeypatch.setattr(ccg, '_subset_counts', _counts)
+
+    ae(cache([0, 3, 2], **kwargs), _ccg([0, 3, 2], spike_clusters))
+    # Only the pairs of 3 are computed.
+    assert cache.stats['misses'] == 4 + 5
+    assert calls == [[1]]
+
+    # Merge 0 and 2 into 5.
+    clustering.merge([0, 2], 5)
+    spike_clusters_1 = clustering.spike_clusters
+    # The entries of 5 with 5 and 3 are derived.
+    assert cache.stats['derived'] == 3
+    misses = cache.stats['misses']
+    ae(cache([5, 3], **kwargs), _ccg([5, 3], spike_clusters_1))
+    assert cache.stats['misses'] == misses
+    ae(cache([3, 5, 1], **kwargs), _ccg([3, 5, 1], spike_clusters_1))
+
+    # Split of 5 into 6 and 7: the new clusters are computed.
+    spikes = np.nonzero(spike_clusters_1 == 5)[0]
+    clustering.assign(spikes[::2], 6)
+    spike_clusters_2 = clustering.spike_clusters
+    assert (6, 6, binsize, winsize_bins) not in cache
+    ae(cache([6, 7, 3], **kwargs), _ccg([6, 7, 3], spike_clusters_2))
+
+    # The entries of the deleted clusters are kept.
+    assert (5, 3, binsize, winsize_bins) in cache
+    assert (0, 0, binsize, winsize_bins) in cache
+
+    # Undo: nothing is recomputed.
+    misses = cache.stats['misses']
+    clustering.undo()
+    ae(cache([3, 5, 1], **kwargs), _ccg([3, 5, 1], spike_clusters_1))
+    clustering.undo()
+    ae(cache([0, 2, 3], **kwargs), _ccg([0, 2, 3], spike_clusters))
+    assert cache.stats['misses'] == misses
+
+    # The entries of the deleted clusters are not derived after a merge.
+    n_derived = cache.stats['derived']
+    clustering.merge([0, 3], 8)
+    assert cache.stats['derived'] == n_derived + 3
+    assert (8, 5, binsize, winsize_bins) not in cache
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats['size'] == 0
+
+
+def test_correlogram_cache_max_size():
+    spike_samples, spike_clusters = _random_data(5)
+    binsize, winsize_bins = _ccg_params()
+    kwargs = dict(bin_size=binsize, window_size=winsize_bins)
+    cache = CorrelogramCache(spike_samples, spike_clusters,
+                             sample_rate=20000)
+
+    def _ccg(cluster_ids):
+        return subset_correlograms(spike_samples, spike_clusters,
+                                   cluster_ids, sample_rate=20000, **kwargs)
+
+    ae(cache([0, 1], **kwargs), _ccg([0, 1]))
+    # Room for the 9 entries of 3 clusters.
+    size = cache.max_size = 9 * cache.stats['size'] // 4
+    ae(cache([2, 3, 4], **kwargs), _ccg([2, 3, 4]))
+    # The least recently used entries are evicted.
+    assert len(cache) == 9
+    assert cache.stats['size'] <= size
+    assert (0, 0, binsize, winsize_bins) not in cache
+    ae(cache([3, 0], **kwargs), _ccg([3, 0]))
+    assert cache.stats['size'] <= size
+    assert (3, 0, binsize, winsize_bins) in cache
+    assert (2, 2, binsize, winsize_bins) not in cache
+
+
+def test_multi_resolution_correlograms():
+    sr = 20000.
+    spike_samples, spike_clusters = _random_data(4)
+    spike_times = spike_samples / sr
+    cluster_ids = [3, 1, 2]
+    mr = multi_resolution_correlograms(spike_times, spike_clusters,
+                                       cluster_ids, sample_rate=sr,
+                                       window_size=.1)
+    assert isinstance(mr, MultiResolutionCorrelograms)
+
+    for bin_size, window_size in [(.001, .05), (.0005, .1), (.002, .03),
+                                  (.00005, .01)]:
+        assert mr.is_compatible(bin_size, window_size)
+        for symmetrize in (False, True):
+            ae(mr.get(bin_size, window_size, symmetrize=symmetrize),
+               subset_correlograms(spike_times, spike_clusters, cluster_ids,
+                                   sample_rate=sr, bin_size=bin_size,
+                                   window_size=window_size,
+                                   symmetrize=symmetrize))
+
+    # Window too large, or bin size not a multiple of the base bin size.
+    mr = multi_resolution_correlograms(spike_times, spike_clusters,
+                                       cluster_ids, sample_rate=sr,
+                                       bin_size=.001, window_size=.05,
+                                       max_bin_size=.001)
+    assert not mr.is_compatible(.001, .1)
+    assert not mr.is_compatible(.0015, .05)
+    with raises(ValueError):
+        mr.get(.001, .1)
+
+
+def test_correlogram_cache_multi_resolution():
+    sr = 20000.
+    spike_samples, spike_clusters = _random_data(4)
+    spike_times = spike_samples / sr
+    cache = CorrelogramCache(spike_times, spike_clusters, sample_rate=sr,
+                             max_window_size=.1, base_bin_size=.0005)
+
+    def _ccg(bin_size, window_size):
+        return subset_correlograms(spike_times, spike_clusters, [1, 0],
+                                   sample_rate=sr, bin_size=bin_size,
+                                   window_size=window_size)
+
+    ae(cache([1, 0], .001, .05), _ccg(.001, .05))
+    misses = cache.stats['misses']
+    # Sweeping the bin and window sizes does not recompute anything.
+    ae(cache([1, 0], .002, .1), _ccg(.002, .1))
+    ae(cache([1, 0], .0005, .02), _ccg(.0005, .02))
+    assert cache.stats['misses'] == misses
+    assert len(cache) == 4
+
+    # Incompatible parameters are computed directly.
+    ae(cache([1, 0], .0001, .05), _ccg(.0001, .05))
+    assert cache.stats['misses'] == misses + 4
+
+    # Without computing the base resolution.
+    cache.clear()
+    ae(cache([1, 0], .0001, .05), _ccg(.0001, .05))
+    assert len(cache) == 4
+    assert (1, 0) + cache._base not in cache
+
+
+def test_sparse_sum():
+    idx, cnt = _sparse_sum([(np.array([1, 4]), np.array([2, 3])),
+                            (np.array([0, 4, 9]), np.array([1, 1, 1])),
+                            (np.array([4]), np.array([5]))])
+    ae(idx, [0, 1, 4, 9])
+    ae(cnt, [1, 2, 9, 1])
+    idx, cnt = _sparse_sum([(np.zeros(0, dtype=np.int64),
+                             np.zeros(0, dtype=np.int64))])
+    assert not len(idx)
+    assert not len(_sparse_sum([])[0])
+
+
+def test_chunked_correlograms(tempdir):
+    sr = 20000.
+    spike_samples, spike_clusters = _random_data(8)
+    spike_samples[1] = spike_samples[0]
+    spike_times = spike_samples / sr
+    # Cluster 7 has spikes too far from the others.
+    spike_clusters[spike_clusters == 7] = 6
+    spike_times[-1] += 10.
+    spike_clusters[-1] = 7
+    kwargs = dict(sample_rate=sr, bin_size=.001, window_size=.05)
+    expected = correlograms(spike_times, spike_clusters, **kwargs)
+
+    for n_jobs, chunk_size, max_memory in [(1, None, 1 << 30),
+                                           (1, 1000, 1000),
+                                           (2, 1500, 1 << 20)]:
+        sparse = chunked_correlograms(spike_times, spike_clusters,
+                                      n_jobs=n_jobs, chunk_size=chunk_size,
+                                      max_memory=max_memory, **kwargs)
+        assert isinstance(sparse, SparseCorrelograms)
+        ae(sparse.to_dense(), expected)
+        ae(sparse.to_dense(symmetrize=False),
+           correlograms(spike_times, spike_clusters, symmetrize=False,
+                        **kwargs))
+
+    # Several batches of chunks in a given context.
+    sparse = chunked_correlograms(spike_times, spike_clusters, n_jobs=2,
+                                  chunk_size=500, context=Context(tempdir),
+                                  **kwargs)
+    ae(sparse.to_dense(), expected)
+
+    # The pairs of cluster 7 have no counts.
+    assert len(sparse) == 7 * 7
+    ae(sparse.pair(7, 0), np.zeros(26))
+    ae(sparse.pair(7, 7), np.zeros(26))
+    ae(sparse.pair(2, 3), correlograms(spike_times, spike_clusters,
+                                       symmetrize=False, **kwargs)[2, 3])
+
+    # Subset of clusters.
+    sparse = chunked_correlograms(spike_times, spike_clusters,
+                                  cluster_ids=[3, 1], n_jobs=1, **kwargs)
+    ae(sparse.to_dense(),
+       subset_correlograms(spike_times, spike_clusters, [3, 1], **kwargs))
+
+
+def test_chunked_correlograms_memory(monkeypatch):
+    from .. import ccg
+    spike_samples, spike_clusters = _random_data(3)
+    kwargs = dict(sample_rate=1., bin_size=20, window_size=1000)
+    expected = correlograms(spike_samples, spike_clusters, **kwargs)
+
+    # Number of accumulated counts in every sum.
+    sizes = []
+
+    def _sparse_sum(parts):
+        sizes.append(sum(len(i) for i, _ in parts))
+        return ccg_sparse_sum(parts)
+    ccg_sparse_sum = ccg._sparse_sum
+    monkeypatch.setattr(ccg, '_sparse_sum', _sparse_sum)
+
+    # 50 chunks: the counts are summed after every chunk.
+    sparse = chunked_correlograms(spike_samples, spike_clusters, n_jobs=1,
+                                  chunk_size=200, **kwargs)
+    ae(sparse.to_dense(), expected)
+    assert len(sizes) >= 50
+    # The accumulated counts have at most one entry per bin of every pair.
+    assert max(sizes) <= 2 * 3 * 3 * 26
+
+
+def test_fft_correlograms():
+    spike_samples, spike_clusters = _random_data(3)
+    spike_samples, spike_clusters = spike_samples[:2000], spike_clusters[:2000]
+    # Some spikes with identical times.
+    spike_samples[1:10:2] = spike_samples[:10:2]
+    spike_times = spike_samples.astype(np.float64)
+    for bin_size, window_size in ((20, 10000), (7, 1000), (1, 101)):
+        kwargs = dict(sample_rate=1., bin_size=bin_size,
+                      window_size=window_size)
+        for cluster_ids in ([0], [2, 0, 1]):
+            for symmetrize in (False, True):
+                c_exact = subset_correlograms(spike_times, spike_clusters,
+                                              cluster_ids, method='exact',
+                                              symmetrize=symmetrize,
+                                              **kwargs)
+                c_fft = subset_correlograms(spike_times, spike_clusters,
+                                            cluster_ids, method='fft',
+                                            symmetrize=symmetrize, **kwargs)
+                assert c_fft.dtype == c_exact.dtype
+                ae(c_fft, c_exact)
+
+    # Several chunks of time.
+    kwargs = dict(sample_rate=1., bin_size=20, window_size=10000)
+    assert spike_samples[-1] > 10 * _fft_size(20, 251)[1]
+    c_exact = subset_correlograms(spike_times, spike_clusters, [0, 1],
+                                  method='exact', **kwargs)
+    ae(subset_correlograms(spike_times, spike_clusters, [0, 1],
+                           method='fft', **kwargs), c_exact)
+
+    # The default method chooses the fastest method.
+    ae(subset_correlograms(spike_times, spike_clusters, [0, 1], **kwargs),
+       c_exact)
+    assert CorrelogramCache(spike_times, spike_clusters).method == 'auto'
+
+    # No spikes.
+    c = subset_correlograms(spike_times, spike_clusters, [10],
+                            method='fft', **kwargs)
+    assert c.shape == (1, 1, 501)
+
+
+def test_choose_method():
+    # Few spikes per window: exact.
+    spike_samples = np.arange(0, 10 ** 6, 1000)
+    assert _choose_method(spike_samples, 2, 20, 25) == 'exact'
+    # Many spikes per window: FFT.
+    spike_samples = np.arange(0, 10 ** 6, 10)
+    assert _choose_method(spike_samples, 2, 20, 1000) == 'fft'
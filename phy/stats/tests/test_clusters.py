@@ -15,11 +15,20 @@ from ..clusters import (mean,
                         get_unmasked_channels,
                         get_mean_probe_position,
                         get_sorted_main_channels,
+                        get_unmasked_channels_bitmap,
+                        get_sorted_main_channels_padded,
                         get_mean_masked_features_distance,
+                        get_mean_masked_features_distances,
                         get_waveform_amplitude,
+                        SimilarityMatrix,
+                        SpatialClusterIndex,
+                        ClusterStatistics,
+                        BestChannels,
                         )
 from phy.electrode.mea import staggered_positions
-from phy.io.mock import (artificial_features,
+from phy.io.array import _spikes_per_cluster
+from phy.io.mock import (MockClustering,
+                         artificial_features,
                          artificial_masks,
                          artificial_waveforms,
                          )
@@ -109,6 +118,27 @@ def test_sorted_main_channels(masks):
     assert np.all(np.in1d(channels, [5, 7]))
 
 
+def test_sorted_main_channels_padded(n_channels):
+    mean_masks = np.random.rand(10, n_channels)
+    mean_masks[3] = 0
+    unmasked = get_unmasked_channels_bitmap(mean_masks)
+    channels, counts = get_sorted_main_channels_padded(mean_masks)
+    assert channels.shape == (10, counts.max())
+    assert counts[3] == 0
+    for i in range(10):
+        ae(np.nonzero(unmasked[i])[0], get_unmasked_channels(mean_masks[i]))
+        expected = get_sorted_main_channels(
+            mean_masks[i], get_unmasked_channels(mean_masks[i]))
+        ae(channels[i, :counts[i]], expected)
+        assert np.all(channels[i, counts[i]:] == -1)
+
+    channels, counts = get_sorted_main_channels_padded(mean_masks,
+                                                       max_channels=3)
+    assert channels.shape == (10, 3)
+    ae(channels[0], get_sorted_main_channels(
+        mean_masks[0], get_unmasked_channels(mean_masks[0]))[:3])
+
+
 def test_waveform_amplitude(masks, waveforms):
     waveforms *= .1
     masks *= .1
@@ -143,3 +173,312 @@ def test_mean_masked_features_distance(features,
     d_computed = get_mean_masked_features_distance(f0, f1, m0, m1,
                                                    n_features_per_channel)
     ac(d_expected, d_computed)
+
+
+def _cluster_means(n_clusters, n_channels, n_features_per_channel):
+    mean_features = np.random.randn(n_clusters, n_channels,
+                                    n_features_per_channel)
+    mean_masks = np.random.rand(n_clusters, n_channels)
+    return mean_features, mean_masks
+
+
+def test_mean_masked_features_distances(n_channels, n_features_per_channel):
+    mf, mm = _cluster_means(5, n_channels, n_features_per_channel)
+    d = get_mean_masked_features_distances(mf, mm, n_features_per_channel)
+    assert d.shape == (5, 5)
+    for i in range(5):
+        for j in range(5):
+            ac(d[i, j], get_mean_masked_features_distance(
+               mf[i], mf[j], mm[i], mm[j], n_features_per_channel),
+               atol=1e-6)
+
+
+def test_similarity_matrix(n_channels, n_features_per_channel):
+    n = 20
+    mf, mm = _cluster_means(n + 10, n_channels, n_features_per_channel)
+    calls = []
+
+    def mean_features(c):
+        calls.append(c)
+        return mf[c]
+
+    def mean_masks(c):
+        return mm[c]
+
+    def _expected(c, cluster_ids):
+        d = [get_mean_masked_features_distance(mf[c], mf[d], mm[c], mm[d],
+                                               n_features_per_channel)
+             for d in cluster_ids]
+        return sorted(zip(cluster_ids, d), key=lambda x: x[1])
+
+    def _check(c, cluster_ids, max_n=None):
+        out = sm.similarity(c, max_n=max_n)
+        exp = _expected(c, [d for d in cluster_ids if d != c])[:max_n]
+        assert [x[0] for x in out] == [x[0] for x in exp]
+        ac([-x[1] for x in out], [x[1] for x in exp], rtol=1e-5)
+
+    clustering = MockClustering(cluster_ids=np.arange(n))
+    sm = SimilarityMatrix(mean_features, mean_masks, n_features_per_channel)
+    sm.attach(clustering)
+    ae(sm.cluster_ids, np.arange(n))
+    assert len(calls) == n
+    _check(3, range(n))
+    _check(3, range(n), max_n=5)
+    ac(sm.distance(2, 7), get_mean_masked_features_distance(
+       mf[2], mf[7], mm[2], mm[7], n_features_per_channel), rtol=1e-5)
+
+    # Merge 1 and 2 into 20 (the mean features come from another array).
+    clustering.change(added=[20], deleted=[1, 2])
+    assert len(calls) == n + 1
+    assert 1 not in sm
+    _check(20, clustering.cluster_ids)
+    _check(5, clustering.cluster_ids, max_n=3)
+
+    # The queries do not compare the clusters again after an event.
+    synced = []
+    sm.remove = synced.append
+    _check(5, clustering.cluster_ids)
+    assert not synced
+    del sm.remove
+
+    # Undo: the vectors of 1 and 2 are reused.
+    clustering.change(added=[1, 2], deleted=[20])
+    assert len(calls) == n + 1
+    _check(1, range(n))
+
+    # Many new clusters: the matrix grows.
+    clustering.change(added=range(21, n + 10), deleted=[0, 1, 2])
+    _check(25, clustering.cluster_ids, max_n=10)
+
+    # The clusters are synchronized with the clustering before a query.
+    clustering.cluster_ids = np.arange(3, n)
+    _check(4, clustering.cluster_ids)
+
+    # A cluster that is not in the clustering does not get a slot.
+    _check(1, clustering.cluster_ids)
+    ac(sm.distance(1, 4), get_mean_masked_features_distance(
+       mf[1], mf[4], mm[1], mm[4], n_features_per_channel), rtol=1e-5)
+    assert 1 not in sm
+    assert 1 not in [c for c, _ in sm.similarity(4)]
+
+    # Without a clustering.
+    sm = SimilarityMatrix(mean_features, mean_masks, n_features_per_channel,
+                          max_n=2)
+    sm.reset([0, 1, 2, 3])
+    _check(0, range(4), max_n=2)
+    assert len(sm.similarity(0)) == 2
+
+
+def test_similarity_matrix_close_clusters():
+    # Close clusters far from the origin: the expanded form of the
+    # distances cancels out.
+    n, n_channels, n_features_per_channel = 10, 4, 3
+    mf = 1e3 + 1e-4 * np.random.rand(n, n_channels, n_features_per_channel)
+    mm = np.ones((n, n_channels))
+    sm = SimilarityMatrix(lambda c: mf[c], lambda c: mm[c],
+                          n_features_per_channel)
+    sm.reset(range(n))
+    for c in range(n):
+        d = [get_mean_masked_features_distance(mf[c], mf[e], mm[c], mm[e],
+                                               n_features_per_channel)
+             for e in range(n)]
+        exp = [e for e in np.argsort(d, kind='mergesort') if e != c]
+        out = sm.similarity(c)
+        assert [x[0] for x in out] == exp
+        ac([-x[1] for x in out], np.array(d)[exp], rtol=1e-9)
+        ac(sm.distance(c, exp[0]), d[exp[0]], rtol=1e-9)
+        # The near-ties at the cut are ranked exactly.
+        assert [x[0] for x in sm.similarity(c, max_n=3)] == exp[:3]
+
+
+def test_spatial_cluster_index(n_channels, n_features_per_channel):
+    n = 30
+    site_positions = staggered_positions(n_channels)
+    # Every cluster is centered on a single channel.
+    mm = np.zeros((n + 1, n_channels))
+    mm[np.arange(n + 1), np.arange(n + 1) % n_channels] = 1
+    mf = np.random.randn(n + 1, n_channels, n_features_per_channel)
+    calls = []
+
+    def mean_masks(c):
+        calls.append(c)
+        return mm[c]
+
+    def pair_similarity(c0, c1):
+        return -get_mean_masked_features_distance(mf[c0], mf[c1],
+                                                  mm[c0], mm[c1],
+                                                  n_features_per_channel)
+
+    def _nearest(c, cluster_ids, k):
+        d = [np.linalg.norm(site_positions[c % n_channels] -
+                            site_positions[d % n_channels])
+             for d in cluster_ids if d != c]
+        others = [d for d in cluster_ids if d != c]
+        return set(np.array(others)[np.argsort(d, kind='mergesort')][:k])
+
+    clustering = MockClustering(cluster_ids=np.arange(n))
+    index = SpatialClusterIndex(mean_masks, site_positions,
+                                similarity=pair_similarity, n_neighbors=5)
+    index.attach(clustering)
+    ae(index.cluster_ids, np.arange(n))
+
+    # The candidates are the nearest clusters.
+    cand = index.candidates(3)
+    assert len(cand) == 5
+    assert 3 not in cand
+    d = [np.linalg.norm(index.position(c) - index.position(3)) for c in cand]
+    assert d == sorted(d)
+    d_max = np.max(d)
+    for c in range(n):
+        if c not in cand and c != 3:
+            assert (np.linalg.norm(index.position(c) - index.position(3)) >=
+                    d_max - 1e-9)
+    assert index.n_builds == 1
+
+    # The candidates are scored with the exact similarity.
+    sims = index.similarity(3)
+    assert sorted(x[0] for x in sims) == sorted(cand)
+    ac([x[1] for x in sims], sorted([pair_similarity(3, c) for c in cand],
+                                    reverse=True))
+    assert len(index.similarity(3, max_n=2)) == 2
+
+    # Merge 1 and 2 into 30: the tree is rebuilt at the next query.
+    n_calls = len(calls)
+    clustering.change(added=[30], deleted=[1, 2])
+    assert 1 not in index
+    assert 30 in index
+    cand = index.candidates(30)
+    assert 1 not in cand and 2 not in cand
+    assert index.n_builds == 2
+    assert len(calls) == n_calls + 1
+
+    # The queries do not compare the clusters again after an event.
+    synced = []
+    index.remove = synced.append
+    index.similarity(30)
+    assert not synced
+    del index.remove
+
+    # Undo: the positions of 1 and 2 are reused.
+    clustering.change(added=[1, 2], deleted=[30])
+    index.similarity(1)
+    assert len(calls) == n_calls + 1
+
+    # Radius queries.
+    index = SpatialClusterIndex(mean_masks, site_positions, radius=1e6)
+    index.reset(range(10))
+    cand = index.candidates(0)
+    assert sorted(cand) == list(range(1, 10))
+    sims = index.similarity(0)
+    assert [x[0] for x in sims] == cand
+    index.radius = 0.
+    assert index.candidates(0) == []
+
+    # Empty index.
+    index.reset([])
+    assert index.candidates(0) == []
+
+
+def test_cluster_statistics(n_channels, n_samples, n_features_per_channel):
+    n_spikes = 200
+    features = artificial_features(n_spikes, n_channels,
+                                   n_features_per_channel)
+    masks = artificial_masks(n_spikes, n_channels)
+    waveforms = artificial_waveforms(n_spikes, n_samples, n_channels)
+    site_positions = staggered_positions(n_channels)
+    spike_clusters = np.random.randint(0, 5, n_spikes)
+
+    def _check(c):
+        s = clustering.spike_clusters == c
+        mm = mean(masks[s])
+        assert stats.count(c) == s.sum()
+        ac(stats.mean_masks(c), mm)
+        ac(stats.mean_features(c), mean(features[s]))
+        ac(stats.mean_waveforms(c), mean(waveforms[s]))
+        ac(stats.mean_probe_position(c),
+           get_mean_probe_position(mm, site_positions))
+        ac(stats.waveform_amplitude(c),
+           get_waveform_amplitude(mm, mean(waveforms[s])))
+
+    clustering = MockClustering(spike_clusters)
+    stats = ClusterStatistics(spike_clusters, masks=masks,
+                              features=features, waveforms=waveforms,
+                              site_positions=site_positions, chunk_size=7)
+    stats.attach(clustering)
+    stats.update()
+    assert stats.stats['scanned'] == 5
+    for c in range(5):
+        _check(c)
+
+    # Batched statistics.
+    ac(stats.mean_masks([3, 1]), [stats.mean_masks(3), stats.mean_masks(1)])
+    assert stats.mean_probe_position([0, 1, 2]).shape == (3, 2)
+    assert stats.waveform_amplitude([0, 1]).shape == (2, n_channels)
+
+    # Merge 1 and 2 into 5: the sums are added.
+    clustering.merge([1, 2], 5)
+    assert stats.stats['merged'] == 1
+    assert stats.stats['scanned'] == 5
+    _check(5)
+
+    # Split 5 into 6 and 7: the spikes of the new clusters are read.
+    s = np.nonzero(clustering.spike_clusters == 5)[0]
+    assert clustering.assign(s[:10], 6).added == [6, 7]
+    assert stats.stats['scanned'] == 7
+    _check(6)
+    _check(7)
+
+    # Undo twice: the stored rows are reused.
+    clustering.undo()
+    clustering.undo()
+    assert stats.stats['reused'] == 3
+    assert stats.stats['scanned'] == 7
+    _check(1)
+
+    # Missing clusters are computed when they are requested.
+    stats = ClusterStatistics(spike_clusters, masks=masks,
+                              spikes_per_cluster=_spikes_per_cluster(
+                                  spike_clusters))
+    assert 3 not in stats
+    ac(stats.mean_masks(3), mean(masks[spike_clusters == 3]))
+    assert 3 in stats
+    assert stats.stats['n_items'] == 1
+
+    # No clusters.
+    ae(stats._spikes([]), [])
+    assert stats._spikes([]).dtype == np.int64
+
+
+def test_best_channels(n_channels):
+    mm = np.random.rand(12, n_channels)
+    calls = []
+
+    def mean_masks(c):
+        calls.append(c)
+        return mm[c]
+
+    clustering = MockClustering(cluster_ids=np.arange(10))
+    bc = BestChannels(mean_masks).attach(clustering)
+    assert len(calls) == 10
+    for c in range(10):
+        unmasked = get_unmasked_channels(mm[c])
+        ae(bc.best_channels(c), get_sorted_main_channels(mm[c], unmasked))
+        ae(bc.unmasked_channels(c), unmasked)
+    assert len(calls) == 10
+
+    padded = bc.best_channels_padded([4, 2])
+    n = len(bc.best_channels(4))
+    ae(padded[0, :n], bc.best_channels(4))
+    assert np.all(padded[0, n:] == -1)
+    ae(bc.unmasked_bitmap([4, 2]), mm[[4, 2]] > .25)
+
+    # Only the new clusters are computed, the others are kept for undo.
+    clustering.change(added=[10, 11], deleted=[1, 2])
+    assert len(calls) == 12
+    assert 1 in bc
+    clustering.change(added=[1, 2], deleted=[10, 11])
+    assert len(calls) == 12
+
+    # Maximum number of channels.
+    bc = BestChannels(mean_masks, max_channels=2)
+    assert len(bc.best_channels(0)) <= 2
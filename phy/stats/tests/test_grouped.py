@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of grouped reductions."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+from pytest import raises
+
+from ..grouped import grouped_reductions
+from phy.io.array import _spikes_per_cluster
+from phy.io.mock import artificial_features, artificial_spike_clusters
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _expected(arr, spike_clusters, cluster_ids, func):
+    spc = _spikes_per_cluster(spike_clusters)
+    return np.array([func(arr[spc[c]], axis=0) for c in cluster_ids])
+
+
+def test_grouped_reductions_1d():
+    spike_clusters = np.array([2, 3, 2, 2, 5])
+    arr = np.array([1., 2., 3., 5., 7.])
+    out = grouped_reductions(arr, spike_clusters,
+                             reductions=('count', 'sum', 'mean', 'var',
+                                         'min', 'max'))
+    ae(out.cluster_ids, [2, 3, 5])
+    ae(out.count, [3, 1, 1])
+    ae(out.sum, [9, 2, 7])
+    ae(out.mean, [3, 2, 7])
+    ac(out.var, [np.var([1, 3, 5]), 0, 0])
+    ae(out.min, [1, 2, 7])
+    ae(out.max, [5, 2, 7])
+
+    with raises(ValueError):
+        grouped_reductions(arr, spike_clusters, reductions=('median',))
+
+
+def test_grouped_reductions_nd(tempdir):
+    n_spikes, n_channels, n_pcs = 1000, 4, 3
+    features = artificial_features(n_spikes, n_channels, n_pcs)
+    spike_clusters = artificial_spike_clusters(n_spikes, 10)
+    # Memory-mapped input.
+    path = op.join(tempdir, 'features.npy')
+    np.save(path, features)
+    features = np.load(path, mmap_mode='r')
+
+    cluster_ids = [7, 2, 4, 20]
+    out = grouped_reductions(features, spike_clusters,
+                             cluster_ids=cluster_ids,
+                             reductions=('count', 'mean', 'var', 'max'),
+                             chunk_size=77,
+                             )
+    ae(out.cluster_ids, cluster_ids)
+    assert out.mean.shape == (4, n_channels, n_pcs)
+    ae(out.count, [np.sum(spike_clusters == c) for c in cluster_ids])
+    ac(out.mean[:3], _expected(features, spike_clusters, cluster_ids[:3],
+                               np.mean))
+    ac(out.var[:3], _expected(features, spike_clusters, cluster_ids[:3],
+                              np.var))
+    ac(out.max[:3], _expected(features, spike_clusters, cluster_ids[:3],
+                              np.max))
+    # Empty cluster.
+    assert out.count[3] == 0
+    ae(out.mean[3], 0)
+    assert np.all(np.isnan(out.max[3]))
+
+
+def test_grouped_reductions_spike_ids():
+    arr = np.arange(20.)
+    spike_ids = np.array([1, 3, 5, 10, 11])
+    spike_clusters = np.array([0, 1, 0, 1, 1])
+    out = grouped_reductions(arr, spike_clusters, spike_ids=spike_ids,
+                             reductions=('sum',), chunk_size=2)
+    ae(out.sum, [6, 24])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of quality metrics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+
+from phy.io.array import _spikes_per_cluster
+from phy.io.mock import MockClustering
+from phy.utils import EventEmitter
+from ..quality import spike_train_metrics, ClusterMetrics
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _data(n_spikes=5000, n_clusters=10):
+    spike_times = np.cumsum(np.random.exponential(.001, size=n_spikes))
+    spike_clusters = np.random.randint(0, n_clusters, n_spikes)
+    return spike_times, spike_clusters
+
+
+def test_spike_train_metrics():
+    spike_times, spike_clusters = _data()
+    # Cluster 3 is only present at the beginning.
+    spike_clusters[spike_clusters == 3] = 2
+    spike_clusters[:10] = 3
+    spc = _spikes_per_cluster(spike_clusters)
+    duration = spike_times[-1]
+    cluster_ids = [7, 3, 0]
+
+    m = spike_train_metrics(spike_times, spc, cluster_ids,
+                            refractory_period=.005,
+                            isi_bin_size=.002, isi_window_size=.1,
+                            n_presence_bins=50)
+    ae(m.cluster_ids, cluster_ids)
+    assert m.isi.shape == (3, 50)
+
+    for i, c in enumerate(cluster_ids):
+        t = spike_times[spike_clusters == c]
+        isi = np.diff(t)
+        assert m.n_spikes[i] == len(t)
+        ac(m.firing_rate[i], len(t) / duration)
+        ac(m.refractory_violations[i], np.mean(isi < .005))
+        ae(m.isi[i], np.histogram(isi, bins=50, range=(0, .1))[0])
+        bins = np.clip((t / duration * 50).astype(np.int64), 0, 49)
+        ac(m.presence_ratio[i], len(np.unique(bins)) / 50.)
+    assert m.presence_ratio[1] < .1
+    assert m.presence_ratio[0] == 1
+
+    # No clusters.
+    m = spike_train_metrics(spike_times, spc, [])
+    assert m.isi.shape == (0, 50)
+
+
+def test_cluster_metrics():
+    spike_times, spike_clusters = _data()
+    spc = _spikes_per_cluster(spike_clusters)
+    metrics = ClusterMetrics(spike_times, spikes_per_cluster=spc)
+    metrics.update()
+    assert all(c in metrics for c in range(10))
+
+    t = spike_times[spike_clusters == 4]
+    ac(metrics.firing_rate(4), len(t) / spike_times[-1])
+    ac(metrics.refractory_violations(4), np.mean(np.diff(t) < .002))
+    assert 0 < metrics.presence_ratio(4) <= 1
+    assert metrics.isi(4).shape == (50,)
+
+    # Merge 1 and 2 into 10.
+    clustering = MockClustering(spike_clusters)
+    metrics.attach(clustering)
+    clustering.merge([1, 2], 10)
+    assert 10 in metrics
+    assert 1 in metrics
+    t = spike_times[clustering.spike_clusters == 10]
+    ac(metrics.refractory_violations(10), np.mean(np.diff(t) < .002))
+
+
+def test_cluster_metrics_supervisor():
+
+    class Supervisor(EventEmitter):
+        def __init__(self, clustering):
+            super(Supervisor, self).__init__()
+            self.clustering = clustering
+            self.columns = {}
+
+        def add_column(self, func, name=None):
+            self.columns[name] = func
+
+    spike_times, spike_clusters = _data()
+    clustering = MockClustering(spike_clusters)
+    supervisor = Supervisor(clustering)
+
+    metrics = ClusterMetrics(spike_times, spike_clusters)
+    metrics.add_columns(supervisor)
+    supervisor.emit('create_cluster_views')
+    assert sorted(supervisor.columns) == sorted(ClusterMetrics.columns)
+    assert all(c in metrics for c in range(10))
+    rates = [supervisor.columns['firing_rate'](c) for c in range(10)]
+    ac(sum(rates), len(spike_times) / spike_times[-1])
+
+    # The new clusters are computed after a clustering change.
+    clustering.merge([5], 10)
+    assert 10 in metrics
@@ -13,6 +13,7 @@ from scipy.interpolate import interp1d
 
 from ..utils._types import _as_array, Bunch
 from phy.io.array import _pad, _get_padded, _range_from_slice
+from phy.io.traces import _select_traces
 from phy.traces.filter import apply_filter, bandpass_filter
 
 logger = logging.getLogger(__name__)
@@ -257,7 +258,9 @@ class WaveformLoader(object):
         slice_extract = _slice(time_o,
                                self.n_samples_before_after,
                                self._filter_margin)
-        extract = self._traces[slice_extract][:, channels].astype(np.float32)
+        extract = np.asarray(_select_traces(self._traces, slice_extract,
+                                            channels),
+                             dtype=np.float32)
 
         # Pad the extracted chunk if needed.
         if slice_extract.start <= 0:
@@ -11,10 +11,11 @@ Code from http://eli.thegreenplace.net/2012/08/07/fundamental-concepts-of-plugin
 # Imports
 #------------------------------------------------------------------------------
 
-import imp
+from importlib.util import spec_from_file_location, module_from_spec
 import logging
 import os
 import os.path as op
+import sys
 
 from six import with_metaclass
 
@@ -78,6 +79,15 @@ def _iter_plugin_files(dirs):
                 yield op.join(subdir, filename)
 
 
+def _load_source(modname, path):
+    """Import a Python file as a module."""
+    spec = spec_from_file_location(modname, path)
+    mod = module_from_spec(spec)
+    sys.modules[modname] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
 def discover_plugins(dirs):
     """Discover the plugin classes contained in Python files.
 
@@ -96,17 +106,11 @@ def discover_plugins(dirs):
     """
     # Scan all subdirectories recursively.
     for path in _iter_plugin_files(dirs):
-        filename = op.basename(path)
-        subdir = op.dirname(path)
-        modname, ext = op.splitext(filename)
-        file, path, descr = imp.find_module(modname, [subdir])
-        if file:
-            # Loading the module registers the plugin in
-            # IPluginRegistry.
-            try:
-                mod = imp.load_module(modname, file, path, descr)  # noqa
-            except Exception as e:  # pragma: no cover
-                logger.exception(e)
-            finally:
-                file.close()
+        modname, ext = op.splitext(op.basename(path))
+        # Loading the module registers the plugin in
+        # IPluginRegistry.
+        try:
+            _load_source(modname, path)
+        except Exception as e:  # pragma: no cover
+            logger.exception(e)
     return IPluginRegistry.plugins